@@ -15,6 +15,9 @@ DATABASES = {
 
 SINGLE_USER_MODE = False
 
+# update several repositories at once in the background task worker
+BACKGROUND_TASK_RUN_ASYNC = True
+
 ALLOWED_HOSTS = [os.getenv('REPOMAKER_HOSTNAME')]
 SECRET_KEY = os.getenv('REPOMAKER_SECRET_KEY')
 DEBUG = False
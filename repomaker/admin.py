@@ -2,7 +2,7 @@ from django.contrib import admin
 from modeltranslation.admin import TranslationAdmin
 
 from .models import Repository, RemoteRepository, App, RemoteApp, Apk, ApkPointer, \
-    RemoteApkPointer, Category, Screenshot, RemoteScreenshot
+    RemoteApkPointer, Category, Screenshot, RemoteScreenshot, TaskTiming, Upload, ChunkedUpload
 from .models.storage import StorageManager
 
 admin.site.register(Repository)
@@ -15,6 +15,9 @@ admin.site.register(RemoteApkPointer)
 admin.site.register(Category)
 admin.site.register(Screenshot)
 admin.site.register(RemoteScreenshot)
+admin.site.register(TaskTiming)
+admin.site.register(Upload)
+admin.site.register(ChunkedUpload)
 
 for storage in StorageManager.storage_models:
     admin.site.register(storage)
@@ -5,3 +5,9 @@ from django.apps import AppConfig
 
 class RepoMakerConfig(AppConfig):
     name = 'repomaker'
+
+    def ready(self):
+        # sync remote repositories concurrently when processing tasks
+        import background_task.tasks
+        from repomaker.tasks import RemoteSyncRunner
+        background_task.tasks.tasks._runner = RemoteSyncRunner()  # pylint: disable=protected-access
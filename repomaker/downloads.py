@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from django.conf import settings
+from fdroidserver import net
+
+TIMEOUT = 60
+
+_lock = threading.Lock()
+_session = None
+_executor = None
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised by downloads of a thread that ran past the deadline set with deadline().
+    """
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Limits the time that the downloads of the current thread can take within the block.
+    Requests time out at the deadline at the latest and raise DeadlineExceeded once it passed.
+    Other work can stop at the deadline with check_deadline().
+
+    :param seconds: The seconds from now after which downloads get aborted or None for no limit
+    """
+    with _deadline_at(None if seconds is None else time.monotonic() + seconds):
+        yield
+
+
+@contextmanager
+def _deadline_at(end):
+    """
+    Like deadline(), but with the time.monotonic() value of the deadline,
+    so a deadline can be passed on to other threads.
+    """
+    previous = getattr(_local, 'deadline', None)
+    if end is not None:
+        _local.deadline = end if previous is None else min(previous, end)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def get_timeout():
+    """
+    Returns the timeout in seconds for the next request of the current thread.
+
+    :raises: DeadlineExceeded if the deadline of the current thread passed
+    """
+    end = getattr(_local, 'deadline', None)
+    if end is None:
+        return TIMEOUT
+    remaining = end - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Downloads took longer than allowed.")
+    return min(TIMEOUT, remaining)
+
+
+def check_deadline():
+    """
+    Lets work of the current thread other than downloads stop at the deadline as well.
+
+    :raises: DeadlineExceeded if the deadline of the current thread passed
+    """
+    get_timeout()
+
+
+def get_session():
+    """
+    Returns the requests.Session that is shared by all downloads of this process.
+
+    It keeps up to settings.DOWNLOAD_CONNECTIONS_PER_HOST connections to each host alive
+    and blocks further requests to a host until one of its connections becomes free.
+    """
+    global _session  # pylint: disable=global-statement
+    with _lock:
+        if _session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=settings.DOWNLOAD_CONNECTIONS_PER_HOST, pool_block=True)
+            session = requests.Session()
+            session.headers.update(net.HEADERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+
+def get(url, **kwargs):
+    """
+    Makes a GET request to the given URL with a pooled connection.
+
+    :param url: The URL to request
+    :param kwargs: Further arguments to pass to requests
+    :return: The requests.Response
+    """
+    kwargs.setdefault('timeout', get_timeout())
+    return get_session().get(url, **kwargs)
+
+
+def http_get(url, etag=None):
+    """
+    Downloads the content at the given URL like fdroidserver.net.http_get() does,
+    but with a pooled connection.
+
+    If an ETag is given, it does a HEAD request first to see if the content changed.
+
+    :param url: The URL to download from
+    :param etag: The last known ETag of the content or None
+    :return: A tuple of the content or None if it did not change and the new ETag
+    """
+    session = get_session()
+    if etag:
+        r = session.head(url, timeout=get_timeout())
+        r.raise_for_status()
+        if 'ETag' in r.headers and etag == r.headers['ETag']:
+            return None, etag
+
+    r = session.get(url, timeout=get_timeout())
+    r.raise_for_status()
+    return r.content, r.headers.get('ETag')
+
+
+def http_get_all(urls, etags=None, mirror_urls=None):
+    """
+    Downloads the content at all given URLs like http_get() does,
+    but concurrently with up to settings.DOWNLOAD_WORKERS threads shared by the entire process.
+    The downloads keep to the deadline of the calling thread.
+
+    :param urls: A list of URLs to download from
+    :param etags: An optional list with the last known ETag for each URL
+    :param mirror_urls: An optional list with the base URLs of the remote repository
+                        the files are in and its mirrors to download them from
+    :return: A list with a tuple of content and ETag or the exception for each URL
+             in the same order
+    """
+    if etags is None:
+        etags = [None] * len(urls)
+    # the threads of the pool do not know the deadline of this thread
+    end = getattr(_local, 'deadline', None)
+    args = [(url, etag, mirror_urls, end) for url, etag in zip(urls, etags)]
+    if len(urls) <= 1:
+        return [_http_get(arg) for arg in args]
+
+    logging.debug("Downloading %d files", len(urls))
+    return list(_get_executor().map(_http_get, args))
+
+
+def _get_executor():
+    global _executor  # pylint: disable=global-statement
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.DOWNLOAD_WORKERS,
+                                           thread_name_prefix='download')
+        return _executor
+
+
+def _http_get(args):
+    url, etag, mirror_urls, end = args
+    try:
+        with _deadline_at(end):
+            if mirror_urls:
+                from repomaker import mirrors
+                return mirrors.http_get(url, mirror_urls, etag)
+            return http_get(url, etag)
+    except requests.exceptions.RequestException as e:
+        logging.warning("Could not download %s: %s", url, e)
+        return e
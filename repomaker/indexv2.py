@@ -0,0 +1,321 @@
+"""
+Support for the repository index v2 of F-Droid, which fdroidserver does not generate yet.
+
+The index v2 consists of entry.jar with the signed entry.json pointing to index-v2.json
+and to diffs from earlier versions of index-v2.json to the current one.
+The diffs are JSON Merge Patches (RFC 7386), so clients that already have an earlier index
+only need to download the changes.
+"""
+import hashlib
+import json
+import logging
+import os
+import zipfile
+
+ENTRY_VERSION = 20002
+DIFF_DIR = 'diff'
+# the locale of texts and files that are not localized in index v1
+DEFAULT_LOCALE = 'en-US'
+# the number of earlier versions of the index that diffs are generated for
+MAX_DIFFS = 10
+
+SCREENSHOT_TYPES = {
+    'phoneScreenshots': 'phone',
+    'sevenInchScreenshots': 'sevenInch',
+    'tenInchScreenshots': 'tenInch',
+    'tvScreenshots': 'tv',
+    'wearScreenshots': 'wear',
+}
+LOCALIZED_FILES = ['icon', 'featureGraphic', 'promoGraphic', 'tvBanner']
+LOCALIZED_TEXTS = ['name', 'summary', 'description']
+APP_FIELDS = ['added', 'lastUpdated', 'categories', 'authorName', 'authorEmail', 'webSite',
+              'sourceCode', 'issueTracker', 'changelog', 'license']
+
+
+def make_index_v2(repodir, history_dir, sign_jar):
+    """
+    Generates index-v2.json, the diffs to the earlier versions of it and the signed entry.jar
+    from the index-v1.json that fdroidserver generated in the given repo directory.
+
+    :param repodir: The repo directory containing index-v1.json
+    :param history_dir: A private directory keeping the earlier versions of index-v2.json
+    :param sign_jar: The function signing entry.jar
+    """
+    with open(os.path.join(repodir, 'index-v1.json'), 'r', encoding='utf-8') as f:
+        index_v2 = v1_to_v2(json.load(f), repodir)
+    timestamp = index_v2['repo']['timestamp']
+
+    entry = {
+        'timestamp': timestamp,
+        'version': ENTRY_VERSION,
+        'index': _write_json(repodir, '/index-v2.json', index_v2,
+                             len(index_v2['packages'])),
+        'diffs': {},
+    }
+
+    # make diffs from the most recent earlier versions and forget older ones
+    if not os.path.isdir(history_dir):
+        os.makedirs(history_dir)
+    if not os.path.isdir(os.path.join(repodir, DIFF_DIR)):
+        os.makedirs(os.path.join(repodir, DIFF_DIR))
+    old_timestamps = sorted([int(name[:-5]) for name in os.listdir(history_dir)
+                             if name.endswith('.json') and name[:-5].isdigit()
+                             and int(name[:-5]) < timestamp], reverse=True)
+    for old_timestamp in old_timestamps[:MAX_DIFFS]:
+        with open(os.path.join(history_dir, '%d.json' % old_timestamp), 'r',
+                  encoding='utf-8') as f:
+            diff = make_merge_patch(json.load(f), index_v2)
+        name = '/%s/%d.json' % (DIFF_DIR, old_timestamp)
+        entry['diffs'][str(old_timestamp)] = _write_json(repodir, name, diff,
+                                                         len(diff.get('packages', {})))
+    for old_timestamp in old_timestamps[MAX_DIFFS:]:
+        os.remove(os.path.join(history_dir, '%d.json' % old_timestamp))
+    for name in os.listdir(os.path.join(repodir, DIFF_DIR)):
+        if name[:-5] not in entry['diffs']:
+            os.remove(os.path.join(repodir, DIFF_DIR, name))
+    with open(os.path.join(history_dir, '%d.json' % timestamp), 'w', encoding='utf-8') as f:
+        json.dump(index_v2, f)
+
+    # entry.json is the only file that gets signed, it has the hashes of all others
+    _write_json(repodir, '/entry.json', entry)
+    jar_path = os.path.join(repodir, 'entry.jar')
+    with zipfile.ZipFile(jar_path, 'w', zipfile.ZIP_DEFLATED) as jar:
+        jar.write(os.path.join(repodir, 'entry.json'), 'entry.json')
+    sign_jar(jar_path)
+    logging.debug("Generated index v2 with %d diffs", len(entry['diffs']))
+
+
+def _write_json(repodir, name, data, num_packages=None):
+    """
+    Writes the data to the file with the given name in the repo directory.
+
+    :return: The file entry for entry.json
+    """
+    path = os.path.join(repodir, name[1:])
+    content = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(content)
+    file_entry = {
+        'name': name,
+        'sha256': hashlib.sha256(content).hexdigest(),
+        'size': len(content),
+    }
+    if num_packages is not None:
+        file_entry['numPackages'] = num_packages
+    return file_entry
+
+
+def _get_file_entry(repodir, name):
+    """
+    Returns the index v2 entry for the file with the given name in the repo directory,
+    with its hash and size if it exists.
+    """
+    file_entry = {'name': name}
+    path = os.path.join(repodir, name[1:])
+    if os.path.isfile(path):
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                file_hash.update(chunk)
+        file_entry['sha256'] = file_hash.hexdigest()
+        file_entry['size'] = os.path.getsize(path)
+    return file_entry
+
+
+def v1_to_v2(index_v1, repodir):
+    """
+    Converts the given index v1 to index v2.
+
+    :param index_v1: The index v1 in JSON format
+    :param repodir: The repo directory with the files the index refers to
+    :return: The index v2 in JSON format
+    """
+    repo_v1 = index_v1['repo']
+    repo = {
+        'name': {DEFAULT_LOCALE: repo_v1.get('name', '')},
+        'description': {DEFAULT_LOCALE: repo_v1.get('description', '')},
+        'address': repo_v1.get('address', ''),
+        'timestamp': repo_v1['timestamp'],
+        'categories': {},
+    }
+    if repo_v1.get('icon'):
+        repo['icon'] = {DEFAULT_LOCALE: _get_file_entry(repodir, '/icons/' + repo_v1['icon'])}
+    if repo_v1.get('mirrors'):
+        repo['mirrors'] = [{'url': url} for url in repo_v1['mirrors']]
+
+    packages = {}
+    for app in index_v1.get('apps', []):
+        package_name = app['packageName']
+        metadata = {key: app[key] for key in APP_FIELDS if app.get(key)}
+        for category in app.get('categories', []):
+            repo['categories'][category] = {'name': {DEFAULT_LOCALE: category}}
+        for key in LOCALIZED_TEXTS:
+            if app.get(key):
+                metadata.setdefault(key, {})[DEFAULT_LOCALE] = app[key]
+        if app.get('icon'):
+            metadata['icon'] = {DEFAULT_LOCALE: _get_file_entry(repodir,
+                                                                '/icons/' + app['icon'])}
+        for locale, localized in app.get('localized', {}).items():
+            base_name = '/%s/%s/' % (package_name, locale)
+            for key, value in localized.items():
+                if key in LOCALIZED_TEXTS:
+                    metadata.setdefault(key, {})[locale] = value
+                elif key in LOCALIZED_FILES:
+                    metadata.setdefault(key, {})[locale] = _get_file_entry(repodir,
+                                                                           base_name + value)
+                elif key in SCREENSHOT_TYPES:
+                    screenshots = metadata.setdefault('screenshots', {})
+                    screenshots.setdefault(SCREENSHOT_TYPES[key], {})[locale] = [
+                        _get_file_entry(repodir, base_name + key + '/' + name)
+                        for name in value]
+        versions = {}
+        for package in index_v1.get('packages', {}).get(package_name, []):
+            versions[package['hash']] = _package_v1_to_v2(package)
+        packages[package_name] = {'metadata': metadata, 'versions': versions}
+    return {'repo': repo, 'packages': packages}
+
+
+def _package_v1_to_v2(package):
+    manifest = {
+        'versionName': package.get('versionName', ''),
+        'versionCode': package.get('versionCode', 0),
+    }
+    uses_sdk = {key: package[key] for key in ['minSdkVersion', 'targetSdkVersion',
+                                              'maxSdkVersion'] if key in package}
+    if uses_sdk:
+        manifest['usesSdk'] = uses_sdk
+    if package.get('signer'):
+        manifest['signer'] = {'sha256': [package['signer']]}
+    for key_v1, key_v2 in [('uses-permission', 'usesPermission'),
+                           ('uses-permission-sdk-23', 'usesPermissionSdk23')]:
+        if package.get(key_v1):
+            manifest[key_v2] = [{'name': name, 'maxSdkVersion': max_sdk} if max_sdk else
+                                {'name': name} for name, max_sdk in package[key_v1]]
+    if package.get('nativecode'):
+        manifest['nativecode'] = package['nativecode']
+    if package.get('features'):
+        manifest['features'] = [{'name': name} for name in package['features']]
+    version = {
+        'file': {'name': '/' + package['apkName'], 'sha256': package['hash'],
+                 'size': package['size']},
+        'manifest': manifest,
+    }
+    if 'added' in package:
+        version['added'] = package['added']
+    return version
+
+
+def repo_v2_to_v1(repo):
+    """
+    Converts the repo part of index v2 to the one of index v1.
+    """
+    repo_v1 = {
+        'name': _get_localized(repo.get('name'), ''),
+        'description': _get_localized(repo.get('description'), ''),
+        'timestamp': repo['timestamp'],
+    }
+    icon = _get_localized(repo.get('icon'))
+    if icon and icon['name'].startswith('/icons/'):
+        repo_v1['icon'] = icon['name'][len('/icons/'):]
+    if 'mirrors' in repo:
+        repo_v1['mirrors'] = [mirror['url'] for mirror in repo['mirrors']]
+    return repo_v1
+
+
+def app_v2_to_v1(package_name, package):
+    """
+    Converts a package of index v2 to an app of index v1.
+    Files that are not stored where index v1 expects them are left out.
+    """
+    metadata = package.get('metadata', {})
+    app = {key: metadata[key] for key in APP_FIELDS if key in metadata}
+    app['packageName'] = package_name
+    app['name'] = _get_localized(metadata.get('name'), package_name)
+    localized = {}
+    for key in LOCALIZED_TEXTS:
+        for locale, value in metadata.get(key, {}).items():
+            localized.setdefault(locale, {})[key] = value
+    for key in LOCALIZED_FILES:
+        for locale, file_entry in metadata.get(key, {}).items():
+            if key == 'icon' and file_entry['name'].startswith('/icons/'):
+                app['icon'] = file_entry['name'][len('/icons/'):]
+                continue
+            base_name = '/%s/%s/' % (package_name, locale)
+            if file_entry['name'].startswith(base_name):
+                localized.setdefault(locale, {})[key] = file_entry['name'][len(base_name):]
+    for key, screenshot_type in SCREENSHOT_TYPES.items():
+        screenshots = metadata.get('screenshots', {}).get(screenshot_type, {})
+        for locale, file_entries in screenshots.items():
+            base_name = '/%s/%s/%s/' % (package_name, locale, key)
+            names = [file_entry['name'][len(base_name):] for file_entry in file_entries
+                     if file_entry['name'].startswith(base_name)]
+            if names:
+                localized.setdefault(locale, {})[key] = names
+    if localized:
+        app['localized'] = localized
+    return app
+
+
+def packages_v2_to_v1(package_name, package):
+    """
+    Converts the versions of a package of index v2 to the packages of an app of index v1.
+    """
+    packages = []
+    for version in package.get('versions', {}).values():
+        manifest = version.get('manifest', {})
+        package_v1 = {
+            'packageName': package_name,
+            'apkName': version['file']['name'].lstrip('/'),
+            'hash': version['file']['sha256'],
+            'hashType': 'sha256',
+            'size': version['file'].get('size', 0),
+            'versionCode': manifest.get('versionCode', 0),
+            'versionName': manifest.get('versionName', ''),
+        }
+        if 'added' in version:
+            package_v1['added'] = version['added']
+        packages.append(package_v1)
+    return packages
+
+
+def _get_localized(value, default=None):
+    """
+    Returns the value for the default locale or any other one, if it does not exist.
+    """
+    if not value:
+        return default
+    if DEFAULT_LOCALE in value:
+        return value[DEFAULT_LOCALE]
+    return next(iter(value.values()))
+
+
+def make_merge_patch(old, new):
+    """
+    Returns the JSON Merge Patch (RFC 7386) that changes old into new.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    patch = {key: None for key in old if key not in new}
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif old[key] != value:
+            patch[key] = make_merge_patch(old[key], value)
+    return patch
+
+
+def apply_merge_patch(target, patch):
+    """
+    Applies the JSON Merge Patch (RFC 7386) to the target and returns the result.
+    The target gets modified.
+    """
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = apply_merge_patch(target.get(key), value)
+    return target
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomaker', 'default_remote_repositories'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RepositoryChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('package_id', models.CharField(blank=True, max_length=255)),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('repo', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='repomaker.Repository')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomaker', '0002_repositorychange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apk',
+            name='scan_cache',
+            field=models.TextField(blank=True),
+        ),
+    ]
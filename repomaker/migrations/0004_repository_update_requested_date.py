@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomaker', '0003_apk_scan_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='update_requested_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
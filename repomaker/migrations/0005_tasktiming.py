@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 03:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomaker', '0004_repository_update_requested_date'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskTiming',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_name', models.CharField(max_length=255)),
+                ('start_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('duration', models.FloatField(default=0)),
+                ('succeeded', models.BooleanField(default=True)),
+                ('phases', models.TextField(blank=True)),
+                ('apk', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='repomaker.Apk')),
+                ('remote_repo', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='repomaker.RemoteRepository')),
+                ('repo', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='repomaker.Repository')),
+            ],
+            options={
+                'ordering': ['-start_date'],
+            },
+        ),
+    ]
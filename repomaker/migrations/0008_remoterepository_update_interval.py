@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+# noinspection PyPep8Naming
+def stop_repeating_updates(apps, schema_editor):
+    # updates of remote repositories schedule their next update themselves now
+    Task = apps.get_model('background_task', 'Task')
+    db_alias = schema_editor.connection.alias
+    Task.objects.using(db_alias).filter(task_name='repomaker.tasks.update_remote_repo') \
+        .update(repeat=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('background_task', '0002_auto_20170927_1109'),
+        ('repomaker', '0007_chunkedupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='remoterepository',
+            name='max_update_interval',
+            field=models.PositiveIntegerField(blank=True, help_text='Overrides settings.REMOTE_UPDATE_MAX_INTERVAL', null=True),
+        ),
+        migrations.AddField(
+            model_name='remoterepository',
+            name='min_update_interval',
+            field=models.PositiveIntegerField(blank=True, help_text='Overrides settings.REMOTE_UPDATE_MIN_INTERVAL', null=True),
+        ),
+        migrations.AddField(
+            model_name='remoterepository',
+            name='next_update_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='remoterepository',
+            name='update_interval',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(stop_repeating_updates, migrations.RunPython.noop),
+    ]
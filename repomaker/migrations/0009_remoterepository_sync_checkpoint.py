@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomaker', '0008_remoterepository_update_interval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='remoterepository',
+            name='sync_checkpoint_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='remoterepository',
+            name='sync_checkpoint_package',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
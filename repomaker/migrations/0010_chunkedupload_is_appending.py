@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomaker', '0009_remoterepository_sync_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='is_appending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
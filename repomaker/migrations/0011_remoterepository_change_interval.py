@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repomaker', '0010_chunkedupload_is_appending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='remoterepository',
+            name='change_interval',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
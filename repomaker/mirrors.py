@@ -0,0 +1,239 @@
+"""
+Downloads files of remote repositories from their mirrors.
+
+URLs are always stored with the URL of the repository itself
+and only resolved against a mirror when a download starts.
+Every mirror has a health and latency score that is kept for the lifetime of the process.
+Downloads are spread across the healthy mirrors, preferring the ones with a lower latency,
+and switch to the next mirror when one fails, so a single failing mirror does not fail a task.
+"""
+import logging
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+from repomaker import downloads
+
+# the latency in seconds that is assumed for mirrors that were not used yet
+DEFAULT_LATENCY = 0.5
+# the weight of the latest latency in the moving average of a mirror's latency
+LATENCY_WEIGHT = 0.3
+
+_lock = threading.Lock()
+_mirrors = dict()
+
+
+class Mirror:
+    """
+    The health and latency score of a mirror.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.latency = DEFAULT_LATENCY
+        self.failures = 0  # the number of failures since the last success
+        self.retry_at = 0  # the time before which the mirror is not used if others are healthy
+
+    def is_healthy(self, now):
+        return self.retry_at <= now
+
+
+def get_mirror(url):
+    """
+    Returns the Mirror with the given base URL, creating it if it is not known yet.
+    """
+    with _lock:
+        if url not in _mirrors:
+            _mirrors[url] = Mirror(url)
+        return _mirrors[url]
+
+
+def record_success(url, latency):
+    """
+    Marks the mirror with the given base URL as healthy and updates its latency.
+
+    :param latency: The seconds it took until the mirror responded
+    """
+    mirror = get_mirror(url)
+    with _lock:
+        mirror.latency += LATENCY_WEIGHT * (latency - mirror.latency)
+        mirror.failures = 0
+        mirror.retry_at = 0
+
+
+def record_failure(url, error=None):
+    """
+    Marks the mirror with the given base URL as unhealthy, so it is not used for a while.
+    The time it is avoided starts with settings.MIRROR_RETRY_DELAY
+    and doubles with every further failure up to settings.MIRROR_MAX_RETRY_DELAY.
+    """
+    mirror = get_mirror(url)
+    with _lock:
+        mirror.failures += 1
+        delay = min(settings.MIRROR_RETRY_DELAY * 2 ** (mirror.failures - 1),
+                    settings.MIRROR_MAX_RETRY_DELAY)
+        mirror.retry_at = time.monotonic() + delay
+    logging.warning("Mirror %s failed, not using it for %d seconds. %s", url, delay, error)
+
+
+def get_ordered(mirror_urls):
+    """
+    Returns the given base URLs of mirrors in the order they should be tried.
+
+    Healthy mirrors come first in a random order that prefers mirrors with a lower latency,
+    so downloads get spread across them.
+    Unhealthy mirrors follow in the order in which they can be used again.
+    """
+    now = time.monotonic()
+    mirrors = [get_mirror(url) for url in mirror_urls]
+    with _lock:
+        healthy = [mirror for mirror in mirrors if mirror.is_healthy(now)]
+        unhealthy = sorted([mirror for mirror in mirrors if not mirror.is_healthy(now)],
+                           key=lambda mirror: mirror.retry_at)
+        weights = [1 / max(mirror.latency, 0.001) for mirror in healthy]
+    ordered = []
+    while healthy:
+        i = random.choices(range(len(healthy)), weights)[0]
+        ordered.append(healthy.pop(i).url)
+        weights.pop(i)
+    return ordered + [mirror.url for mirror in unhealthy]
+
+
+def resolve(url, mirror_urls, exclude=()):
+    """
+    Resolves the given URL of a repository file against its mirrors.
+
+    :param url: The URL of the file in the repository itself
+    :param mirror_urls: The base URLs of the repository and its mirrors
+    :param exclude: Base URLs of mirrors that should not be used
+    :return: A list of tuples with the base URL of a mirror and the URL of the file on it
+             in the order they should be tried.
+             The base URL is None if the file is not in the repository.
+    """
+    for base_url in mirror_urls:
+        if url.startswith(base_url + '/'):
+            path = url[len(base_url):]
+            return [(mirror_url, mirror_url + path) for mirror_url in get_ordered(mirror_urls)
+                    if mirror_url not in exclude]
+    return [(None, url)]
+
+
+def _call(url, mirror_urls, func, exclude=()):
+    """
+    Calls func with the URL of the file on each mirror until it succeeds
+    and records the health and latency of the mirrors that were tried.
+
+    HTTP errors other than 404 and server errors are raised right away,
+    because all mirrors are expected to respond the same way.
+
+    :return: A tuple of the result of func and the base URL of the mirror that was used
+    """
+    error = None
+    for mirror_url, mirror_file_url in resolve(url, mirror_urls, exclude):
+        start = time.monotonic()
+        try:
+            result = func(mirror_file_url)
+        except requests.exceptions.HTTPError as e:
+            status_code = e.response.status_code if e.response is not None else 500
+            if mirror_url is None or status_code < 500 and status_code != 404:
+                raise
+            if status_code >= 500:
+                record_failure(mirror_url, e)
+            # else the mirror might just not have synced the file yet
+            error = e
+            continue
+        except requests.exceptions.RequestException as e:
+            if mirror_url is None:
+                raise
+            record_failure(mirror_url, e)
+            error = e
+            continue
+        if mirror_url is not None:
+            record_success(mirror_url, time.monotonic() - start)
+        return result, mirror_url
+    if error is None:
+        raise requests.exceptions.ConnectionError("No mirror left to download %s from." % url)
+    raise error
+
+
+def _get(url, allowed_status_codes=(), **kwargs):
+    r = downloads.get(url, **kwargs)
+    if r.status_code not in allowed_status_codes:
+        try:
+            r.raise_for_status()
+        except requests.exceptions.HTTPError:
+            r.close()
+            raise
+    return r
+
+
+def get(url, mirror_urls, allowed_status_codes=(), exclude=(), **kwargs):
+    """
+    Makes a GET request for the given URL to the first mirror that responds
+    like downloads.get() does.
+
+    :param url: The URL of the file in the repository itself
+    :param mirror_urls: The base URLs of the repository and its mirrors
+    :param allowed_status_codes: HTTP error status codes that are returned instead of raised
+    :param exclude: Base URLs of mirrors that should not be used
+    :return: A tuple of the requests.Response and the base URL of the mirror that was used.
+             Pass the base URL to record_failure() if reading the response fails.
+    """
+    return _call(url, mirror_urls,
+                 lambda mirror_file_url: _get(mirror_file_url, allowed_status_codes, **kwargs),
+                 exclude)
+
+
+def head(url, mirror_urls):
+    """
+    Makes a HEAD request for the given URL to the first mirror that responds.
+
+    :return: The requests.Response
+    """
+    def _head(mirror_file_url):
+        r = downloads.get_session().head(mirror_file_url, timeout=downloads.get_timeout())
+        r.raise_for_status()
+        return r
+    return _call(url, mirror_urls, _head)[0]
+
+
+def http_get(url, mirror_urls, etag=None):
+    """
+    Downloads the content at the given URL from the first mirror that has it
+    like downloads.http_get() does.
+
+    Note that mirrors might use different ETags for the same content.
+
+    :return: A tuple of the content or None if it did not change and the new ETag
+    """
+    return _call(url, mirror_urls,
+                 lambda mirror_file_url: downloads.http_get(mirror_file_url, etag))[0]
+
+
+def download(url, mirror_urls, f, chunk_size=64 * 1024):
+    """
+    Streams the file at the given URL into the given binary file object.
+    If a mirror fails while the file is streamed, the file is downloaded again from the next.
+
+    :return: The closed requests.Response
+    """
+    start = f.tell()
+    failed = set()
+    while True:
+        r, mirror_url = get(url, mirror_urls, exclude=failed, stream=True)
+        try:
+            with r:
+                for chunk in r.iter_content(chunk_size):
+                    downloads.get_timeout()  # raises if the deadline passed
+                    f.write(chunk)
+            return r
+        except requests.exceptions.RequestException as e:
+            if mirror_url is None or len(failed) + 1 >= len(mirror_urls):
+                raise
+            record_failure(mirror_url, e)
+            failed.add(mirror_url)
+            f.seek(start)
+            f.truncate()
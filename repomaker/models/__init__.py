@@ -5,5 +5,8 @@ from .category import Category
 from .remoteapp import RemoteApp
 from .remoterepository import RemoteRepository
 from .repository import Repository
+from .repositorychange import RepositoryChange
 from .screenshot import Screenshot, RemoteScreenshot
 from .storage import S3Storage, SshStorage, GitStorage
+from .tasktiming import TaskTiming
+from .upload import Upload, ChunkedUpload
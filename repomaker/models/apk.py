@@ -1,26 +1,42 @@
 import fdroidserver
 import hashlib
+import json
 import logging
 import os
 import zipfile
 from datetime import datetime
-from io import BytesIO
 
 import magic  # this is python-magic in requirements.txt
 import requests
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models.signals import post_delete, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from fdroidserver import update
 
-from repomaker import tasks
-from repomaker.models.repository import AbstractRepository
-from repomaker.storage import get_apk_file_path, RepoStorage
+from repomaker import mirrors, tasks
+from repomaker.models.repository import AbstractRepository, FDROIDSERVER_LOCK
+from repomaker.scan import ApkScanError, InvalidSignatureError, scan_apk, scan_apks
+from repomaker.storage import get_apk_file_path, get_blob_path, RepoStorage
+from repomaker.utils import timed_phase
 from .apkpointer import ApkPointer, RemoteApkPointer
 from .app import IMAGE, VIDEO, AUDIO, DOCUMENT, BOOK, APK
 
+# number of bytes to download at once, so big APK files are not kept in memory
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# number of bytes to read at once when analyzing files, big reads are faster for big files
+ANALYSIS_CHUNK_SIZE = 1024 * 1024
+
+# number of bytes at the start of a file that are used to detect its type
+MAGIC_HEAD_SIZE = 1024 * 1024
+
+# keys of a scan result that depend on the repository the APK is in
+REPO_SPECIFIC_SCAN_KEYS = ['apkName', 'added', 'srcname', 'type']
+
 
 class Apk(models.Model):
     package_id = models.CharField(max_length=255, blank=True)
@@ -33,6 +49,7 @@ class Apk(models.Model):
     hash_type = models.CharField(max_length=32, blank=True)
     added_date = models.DateTimeField(default=timezone.now)
     is_downloading = models.BooleanField(default=False)
+    scan_cache = models.TextField(blank=True)  # JSON encoded result of scanning the APK file
 
     def __str__(self):
         return self.package_id + " " + str(self.version_code) + " " + self.file.name
@@ -49,36 +66,182 @@ class Apk(models.Model):
         Starts a blocking download of the APK file if it is still missing
         and then saves it.
 
+        The file is streamed to disk and its hash is checked against the known hash, if any,
+        before the file gets scanned. Interrupted downloads are resumed by the next call.
+
+        If the file has the sha256 hash from the signed index of a remote repository,
+        the information from that index is trusted and the file is not scanned here,
+        see settings.DOWNLOAD_TRUST_REMOTE_INDEX.
+
+        If the URL points into a remote repository, the file is downloaded from its mirrors.
+
         This also updates all pointers and links/copies the file to them.
+        If the downloaded file is invalid, it is deleted together with this Apk and its pointers.
+        If no mirror has a file with the expected hash, this Apk and its pointers are kept,
+        so the download can be tried again later.
         """
         if self.file:
             return
 
-        # download and store file
+        # download and store file, retrying right away does not help if no mirror has the file
         file_name = url.rsplit('/', 1)[-1]
-        r = requests.get(url, timeout=60)
-        if r.status_code != requests.codes.ok:
-            # TODO delete self and ApkPointer when this fails permanently
-            r.raise_for_status()
-        self.file.save(file_name, BytesIO(r.content), save=True)
-
-        # initialize the APK and delete it if there was a problem
         try:
-            apk = self.initialize()
+            with timed_phase('download') as phase:
+                phase.count = self._download_file(url, file_name, self._get_mirror_urls(url))
         except ValidationError as e:
-            logging.warning('Deleting invalid APK file: %s', e)
-            ApkPointer.objects.filter(apk=self).all().delete()
-            RemoteApkPointer.objects.filter(apk=self).all().delete()
-            self.delete()
+            logging.warning('Could not download APK file: %s', e)
             return
 
+        if self.is_described_by_remote_index() and settings.DOWNLOAD_TRUST_REMOTE_INDEX:
+            # the file is scanned and its icons extracted when a repository gets updated
+            apk = self
+        else:
+            # initialize the APK and delete it if there was a problem
+            try:
+                with timed_phase('scan_apks', 1):
+                    apk = self.initialize()
+            except ValidationError as e:
+                logging.warning('Deleting invalid APK file: %s', e)
+                ApkPointer.objects.filter(apk=self).all().delete()
+                RemoteApkPointer.objects.filter(apk=self).all().delete()
+                self.delete()
+                return
+
         # update apk pointers
         pointers = ApkPointer.objects.filter(apk=apk).all()
         for pointer in pointers:
             pointer.link_file_from_apk()
             pointer.repo.update_async()
 
-    def initialize(self, repo=None, app=None):
+    def is_described_by_remote_index(self):
+        """
+        Returns True if this Apk was created from the signed index of a remote repository
+        with a sha256 hash that its downloaded file has to match.
+        """
+        return bool(self.package_id) and bool(self.hash) and self.hash_type == 'sha256' and \
+            RemoteApkPointer.objects.filter(apk=self).exists()
+
+    def _get_mirror_urls(self, url):
+        """
+        Returns the base URLs of the remote repository that has this APK at the given URL
+        and of its mirrors or an empty list if there is none.
+        """
+        pointer = RemoteApkPointer.objects.filter(apk=self, url=url) \
+            .select_related('app__repo').first()
+        if pointer is None:
+            return []
+        return pointer.app.repo.get_mirror_urls()
+
+    def _download_file(self, url, file_name, mirror_urls=(), failed_mirror_urls=frozenset()):
+        """
+        Streams the file at the given URL into a partial file next to its final location
+        and only moves it there, if it has the expected hash.
+
+        If a previous download was interrupted, its partial file is kept
+        and resumed with an HTTP Range request.
+        If a mirror fails while streaming, the download is resumed from the next mirror.
+        If the file does not have the expected hash, it is downloaded again from the next mirror.
+
+        :raises: ValidationError if no mirror has a file with the expected hash
+        :return: The number of bytes that were downloaded
+        """
+        path = self.file.storage.path(get_apk_file_path(self, file_name))
+        part_path = path + '.part'
+        if not os.path.isdir(os.path.dirname(part_path)):
+            os.makedirs(os.path.dirname(part_path))
+
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        r, mirror_url = mirrors.get(url, mirror_urls, exclude=failed_mirror_urls,
+                                    allowed_status_codes=[requests.codes.range_not_satisfiable],
+                                    headers=headers, stream=True)
+        if offset and r.status_code == requests.codes.range_not_satisfiable:
+            # the partial file can not be resumed, e.g. because the remote file changed
+            r.close()
+            os.remove(part_path)
+            return self._download_file(url, file_name, mirror_urls, failed_mirror_urls)
+        if r.status_code not in (requests.codes.ok, requests.codes.partial_content):
+            # TODO delete self and ApkPointer when this fails permanently
+            r.raise_for_status()
+        if r.status_code != requests.codes.partial_content:
+            offset = 0  # the server does not support ranges and sends the entire file
+
+        hash_type = self.hash_type if self.hash_type in hashlib.algorithms_available \
+            else 'sha256'
+        file_hash = hashlib.new(hash_type)
+        if offset:
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    file_hash.update(chunk)
+
+        # the partial file is kept when the download fails, so the next attempt can resume it
+        size = 0
+        try:
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    file_hash.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except requests.exceptions.RequestException as e:
+            if mirror_url is None or len(failed_mirror_urls) + 1 >= len(mirror_urls):
+                raise
+            mirrors.record_failure(mirror_url, e)
+            return size + self._download_file(url, file_name, mirror_urls,
+                                              failed_mirror_urls | {mirror_url})
+        finally:
+            r.close()
+
+        # reject the file without parsing it, if it is not what the remote index promised
+        if self.hash and self.hash_type == hash_type and self.hash != file_hash.hexdigest():
+            os.remove(part_path)
+            error = ValidationError(_('Downloaded file %s does not have the expected hash')
+                                    % file_name)
+            if mirror_url is not None:
+                mirrors.record_failure(mirror_url, error)
+                if len(failed_mirror_urls) + 1 < len(mirror_urls):
+                    return size + self._download_file(url, file_name, mirror_urls,
+                                                      failed_mirror_urls | {mirror_url})
+            raise error
+
+        name = self.file.storage.get_available_name(get_apk_file_path(self, file_name))
+        os.rename(part_path, self.file.storage.path(name))
+        self.file.name = name
+        self._store_as_blob()
+        self.save()
+        return size
+
+    def _store_as_blob(self):
+        """
+        Moves the file of this Apk into the content-addressed store keyed by its sha256 hash,
+        so every file is stored only once and repositories can hardlink it from there.
+        If the store has this file already, also under a different file name,
+        the file of this Apk is replaced by it.
+
+        Attention: This does not save the object.
+
+        :return: True if the file was moved, False if it can not be stored by its hash
+                 or is in the store already
+        """
+        if not self.file or not self.hash or self.hash_type != 'sha256':
+            return False
+        name = get_blob_path(self.hash, os.path.basename(self.file.name))
+        if os.path.dirname(self.file.name) == os.path.dirname(name):
+            return False
+        path = self.file.storage.path(name)
+        stored_names = sorted(os.listdir(os.path.dirname(path))) \
+            if os.path.isdir(os.path.dirname(path)) else []
+        if stored_names:
+            # the file has the same content as the stored one
+            os.remove(self.file.path)
+            name = os.path.join(os.path.dirname(name), stored_names[0])
+        else:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(self.file.path, path)
+        self.file.name = name
+        return True
+
+    def initialize(self, repo=None, app=None, scan_result=None):
         """
         Initializes this object based on information retrieved from self.file.
 
@@ -86,6 +249,8 @@ class Apk(models.Model):
                      are created as well.
         :param app: If an App is passed here, the Apk needs to be an update for this app,
                     otherwise a ValidationError will be raised.
+        :param scan_result: The result of scanning the APK file with scan_files(),
+                            if it was scanned already
         :raises: ValidationError if Apk can not be initialized. Delete it, if you get this error!
         :return: An instance of this Apk objects or a different one if it existed already
         """
@@ -95,7 +260,7 @@ class Apk(models.Model):
         ext = os.path.splitext(self.file.name)[1]
         if ext == '.apk':
             try:
-                repo_file = self._get_info_from_apk()
+                repo_file = self._get_info_from_apk(scan_result)
             except fdroidserver.exception.BuildException as e:
                 raise ValidationError(e)
             except zipfile.BadZipFile as e:
@@ -109,6 +274,8 @@ class Apk(models.Model):
         apk_set = Apk.objects.filter(package_id=repo_file['packageName'], hash=repo_file['hash'])
         if not apk_set.exists():
             self.apply_json_package_info(repo_file)
+            if ext == '.apk':
+                self.set_scan_result(repo_file)
             self.save()
             apk = self
         elif apk_set.count() == 1 and self == apk_set[0]:
@@ -126,6 +293,15 @@ class Apk(models.Model):
         else:
             raise RuntimeError('More than one APK with package ID %s' % repo_file['packageName'])
 
+        # remember the scan result, so repositories don't need to scan the APK again
+        if ext == '.apk' and not apk.scan_cache:
+            apk.set_scan_result(repo_file)
+            apk.save()
+
+        # store the file only once, so repositories can link it without storing it again
+        if apk._store_as_blob():  # pylint: disable=protected-access
+            apk.save()
+
         if repo is not None:
             if ApkPointer.objects.filter(apk=apk, repo=repo).exists():
                 raise ValidationError(_('This APK already exists in the current repo.'))
@@ -134,38 +310,76 @@ class Apk(models.Model):
 
         return apk
 
-    def _get_info_from_apk(self):
+    def _get_info_from_apk(self, scan_result=None):
         """
         Scans the APK file and returns a dictionary of information.
-        It also extracts icons and stores them in the repository on disk.
 
+        :param scan_result: The result of scanning the APK file with scan_apks(),
+                            if it was scanned already
         :return: A dict of APK information or None
         """
-        AbstractRepository().get_config()
+        if scan_result is None:
+            # the APK can be scanned while any config is applied, see FDROIDSERVER_LOCK
+            with FDROIDSERVER_LOCK:
+                AbstractRepository().get_config()
+            try:
+                scan_result = scan_apk(self.file.path)
+            except ApkScanError as e:
+                scan_result = e
 
-        # Verify that the signature is correct
-        if not fdroidserver.verify_apk_signature(self.file.path):
+        if isinstance(scan_result, InvalidSignatureError):
             raise ValidationError(_('Invalid APK signature'))
+        if isinstance(scan_result, ApkScanError):
+            raise ValidationError(str(scan_result))
 
-        # scan APK and extract information about it
-        try:
-            repo_file = fdroidserver.scan_apk(self.file.path)
-            repo_file['type'] = APK
-        except fdroidserver.exception.BuildException as e:
-            raise ValidationError(e)
-
+        repo_file = scan_result
+        repo_file['type'] = APK
         if 'packageName' not in repo_file:
             raise ValidationError(_('Invalid APK.'))
 
         return repo_file
 
+    @staticmethod
+    def get_by_hash(file_hash, package_id=None):
+        """
+        Returns an Apk with a stored file that has the given sha256 hash,
+        so the file does not need to be uploaded or downloaded again.
+
+        :param file_hash: The sha256 hash of the file as hex string
+        :param package_id: If given, the Apk also needs to have this package ID
+        :return: The Apk or None if there is none with this hash
+        """
+        if not file_hash:
+            return None
+        apks = Apk.objects.filter(hash=file_hash.lower(), hash_type='sha256').exclude(file='')
+        if package_id:
+            apks = apks.filter(package_id=package_id)
+        return apks.first()
+
+    @staticmethod
+    def scan_files(apks):
+        """
+        Scans the APK files of the given Apks in parallel, see repomaker.scan.scan_apks().
+
+        :return: A dict with the scan results keyed by the primary key of the Apk,
+                 Apks with other files are left out
+        """
+        apks = [apk for apk in apks if os.path.splitext(apk.file.name)[1] == '.apk']
+        # the APKs can be scanned while any config is applied, see FDROIDSERVER_LOCK
+        with FDROIDSERVER_LOCK:
+            AbstractRepository().get_config()
+        scan_results = scan_apks([apk.file.path for apk in apks])
+        return {apk.pk: scan_result for apk, scan_result in zip(apks, scan_results)}
+
     def _get_info_from_file(self):
+        # read the file only once, it might be a big video
+        file_hash, size, head = analyze_file(self.file.path)
         repo_file = {
             'sig': None,
-            'hash': sha256sum(self.file.path),
+            'hash': file_hash,
             'hashType': 'sha256',
-            'size': self.file.size,
-            'type': self._get_type()
+            'size': size,
+            'type': self._get_type(head)
         }
         file_name = os.path.basename(self.file.name)
         match = fdroidserver.common.STANDARD_FILE_NAME_REGEX.match(file_name)
@@ -181,10 +395,11 @@ class Apk(models.Model):
 
         return repo_file
 
-    def _get_type(self):
+    def _get_type(self, head=None):
         """
         Retrieves the file's type as str with mime-type checking if known to not be an APK.
         If you need extra file-types, please make sure to add them safely(!) here.
+        :param head: The bytes at the start of the file, if they were read already
         :raises: ValidationError if doesn't match type on white-list.
         """
         ext = os.path.splitext(self.file.name)[1]
@@ -193,7 +408,10 @@ class Apk(models.Model):
                 ext == '.js' or ext == '.html':
             raise ValidationError(_('Unsupported File Type'))
         # allow a white-list of mime-types
-        mime = magic.from_file(self.file.path, mime=True)
+        if head is None:
+            mime = magic.from_file(self.file.path, mime=True)
+        else:
+            mime = magic.from_buffer(head, mime=True)
         mime_start = mime.split('/', 1)[0]
         if mime_start == 'image':
             return IMAGE
@@ -228,6 +446,46 @@ class Apk(models.Model):
         if 'sig' in package_info:
             self.signature = package_info['sig']
 
+    def get_scan_result(self):
+        """
+        Returns the cached result of scanning this APK file with fdroidserver
+        without the information that depends on a repository.
+
+        :return: A dict in the format of fdroidserver's apkcache or None
+                 if there is no usable scan result
+        """
+        if not self.scan_cache:
+            return None
+        try:
+            cache = json.loads(self.scan_cache)
+        except ValueError as e:
+            logging.warning("Ignoring invalid scan cache of APK %d: %s", self.pk, e)
+            return None
+        if cache.get('METADATA_VERSION') != update.METADATA_VERSION or \
+                cache.get('allow_disabled_algorithms') != update.disabled_algorithms_allowed():
+            return None  # scan result is outdated
+        scan_result = cache['apk']
+        if scan_result.get('hash') != self.hash:
+            return None
+        if 'antiFeatures' in scan_result:
+            scan_result['antiFeatures'] = set(scan_result['antiFeatures'])
+        return scan_result
+
+    def set_scan_result(self, scan_result):
+        """
+        Caches the result of scanning this APK file with fdroidserver,
+        so it does not need to be scanned again for every repository it is in.
+
+        Attention: This does not save the object.
+        """
+        scan_result = {key: value for key, value in scan_result.items()
+                       if key not in REPO_SPECIFIC_SCAN_KEYS}
+        self.scan_cache = json.dumps({
+            'METADATA_VERSION': update.METADATA_VERSION,
+            'allow_disabled_algorithms': update.disabled_algorithms_allowed(),
+            'apk': scan_result,
+        }, default=_encode_scan_result)
+
     def delete_if_no_pointers(self):
         apk_pointers_exist = ApkPointer.objects.filter(apk=self).exists()
         remote_apk_pointers_exist = RemoteApkPointer.objects.filter(apk=self).exists()
@@ -247,17 +505,40 @@ def apk_pre_delete_handler(**kwargs):
 def apk_post_delete_handler(**kwargs):
     apk = kwargs['instance']
     if apk.file:
+        if Apk.objects.filter(file=apk.file.name).exists():
+            return  # the file in the content-addressed store is still used by another Apk
         logging.info("Deleting APK: %s", apk.file.name)
         apk.file.delete(save=False)
 
 
+def _encode_scan_result(obj):
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
 def sha256sum(filename):
     """Calculate the sha256 of the given file."""
+    return analyze_file(filename, head_size=0)[0]
+
+
+def analyze_file(filename, head_size=MAGIC_HEAD_SIZE):
+    """
+    Reads the given file once and computes everything needed to add it to a repository.
+
+    :param filename: The path to the file
+    :param head_size: The number of bytes at the start of the file to return
+    :return: A tuple of the sha256 hash of the file, its size and the bytes at its start
+    """
     sha = hashlib.sha256()
-    with open(filename, 'rb') as f:
-        while True:
-            t = f.read(16384)
-            if len(t) == 0:
-                break
-            sha.update(t)
-    return sha.hexdigest()
+    size = 0
+    head = bytearray()
+    buf = bytearray(ANALYSIS_CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(filename, 'rb', buffering=0) as f:
+        for length in iter(lambda: f.readinto(buf), 0):
+            sha.update(view[:length])
+            if size < head_size:
+                head += view[:min(length, head_size - size)]
+            size += length
+    return sha.hexdigest(), size, bytes(head)
@@ -45,9 +45,6 @@ class ApkPointer(AbstractApkPointer):
         if not self.apk or not self.apk.package_id or not self.repo:
             raise RuntimeError('Trying to initialize incomplete ApkPointer.')
 
-        # Link/Copy file from Apk to this pointer
-        self.link_file_from_apk()
-
         # check if app exists already in repo and if so, get latest version
         latest_version = self.apk.version_code
         apps = App.objects.filter(repo=self.repo, package_id=self.apk.package_id)
@@ -79,6 +76,10 @@ class ApkPointer(AbstractApkPointer):
             raise RuntimeError('More than one app in repo %d with package ID %s' %
                                (self.repo.pk, self.apk.package_id))
 
+        # Link/Copy file from Apk to this pointer,
+        # only after validation, so no file is left behind for rejected APKs
+        self.link_file_from_apk()
+
         # apply latest info to the app itself
         if self.apk.version_code == latest_version:
             # update app name
@@ -115,6 +116,9 @@ class ApkPointer(AbstractApkPointer):
         if not self.apk.file:
             raise RuntimeError('Trying to link to a non-existing APK.')
         target = get_apk_file_path(self, os.path.basename(self.apk.file.name))
+        if ApkPointer.objects.filter(file=target).exclude(pk=self.pk).exists():
+            # don't replace the file of another APK with the same name
+            target = self.apk.file.storage.get_available_name(target)
         target = self.apk.file.storage.link(source, target)
 
         # store the target filename in this pointer
@@ -9,9 +9,10 @@ from django.templatetags.static import static
 from django.urls import reverse
 from django.utils import timezone, translation
 from django.utils.translation import ugettext_lazy as _
-from fdroidserver import metadata, net
+from fdroidserver import metadata
 from modeltranslation.utils import get_language
 
+from repomaker import downloads
 from repomaker.storage import get_icon_file_path_for_app, \
     get_graphic_asset_file_path
 from repomaker.utils import clean, to_universal_language_code
@@ -35,6 +36,7 @@ TYPE_CHOICES = (
     (OTHER, _('Other')),
 )
 APP_DEFAULT_ICON = os.path.join('repomaker', 'images', 'default-app-icon.png')
+GRAPHIC_ASSETS = ['feature_graphic', 'high_res_icon', 'tv_banner']
 
 
 class AbstractApp(models.Model):
@@ -212,10 +214,8 @@ class App(AbstractApp):
                     del localized[language_code]
 
     def _get_screenshot_dict(self):
-        from . import Screenshot
         localized = dict()
-        screenshots = Screenshot.objects.filter(app=self).all()
-        for s in screenshots:
+        for s in self.screenshot_set.all():  # uses prefetched screenshots if available
             # upper-case region part of language code for compatibility
             language_code = to_universal_language_code(s.language_code)
             if language_code not in localized:
@@ -257,40 +257,48 @@ class App(AbstractApp):
     def download_graphic_assets_from_remote_app(self, remote_app):
         """
         Does a blocking download of the RemoteApp's graphic assets and replaces the local ones.
+        The graphic assets of all languages are downloaded concurrently.
 
         Attention: This assumes that all translations exist already.
         """
         from .remoteapp import RemoteApp
+        # collect the graphic assets of all languages
+        remote_apps = dict()
+        assets = []
         for language_code in remote_app.get_available_languages():
-            # get the translation for current language_code
             with translation.override(language_code):
-                remote_app = RemoteApp.objects.get(pk=remote_app.pk)
-                if remote_app.feature_graphic_url:
-                    graphic, etag = net.http_get(remote_app.feature_graphic_url,
-                                                 remote_app.feature_graphic_etag)
-                    if graphic is not None:
-                        self.feature_graphic.delete()
-                        graphic_name = os.path.basename(remote_app.feature_graphic_url)
-                        self.feature_graphic.save(graphic_name, BytesIO(graphic), save=False)
-                        remote_app.feature_graphic_etag = etag
-                if remote_app.high_res_icon_url:
-                    graphic, etag = net.http_get(remote_app.high_res_icon_url,
-                                                 remote_app.high_res_icon_etag)
-                    if graphic is not None:
-                        self.high_res_icon.delete()
-                        graphic_name = os.path.basename(remote_app.high_res_icon_url)
-                        self.high_res_icon.save(graphic_name, BytesIO(graphic), save=False)
-                        remote_app.high_res_icon_etag = etag
-                if remote_app.tv_banner_url:
-                    graphic, etag = net.http_get(remote_app.tv_banner_url,
-                                                 remote_app.tv_banner_etag)
-                    if graphic is not None:
-                        self.tv_banner.delete()
-                        graphic_name = os.path.basename(remote_app.tv_banner_url)
-                        self.tv_banner.save(graphic_name, BytesIO(graphic), save=False)
-                        remote_app.tv_banner_etag = etag
+                remote_apps[language_code] = RemoteApp.objects.get(pk=remote_app.pk)
+                for graphic in GRAPHIC_ASSETS:
+                    url = getattr(remote_apps[language_code], graphic + '_url')
+                    if url:
+                        etag = getattr(remote_apps[language_code], graphic + '_etag')
+                        assets.append((language_code, graphic, url, etag))
+
+        results = downloads.http_get_all([asset[2] for asset in assets],
+                                         [asset[3] for asset in assets],
+                                         remote_app.repo.get_mirror_urls())
+
+        error = None
+        for language_code, remote in remote_apps.items():
+            with translation.override(language_code):
+                for asset, result in zip(assets, results):
+                    if asset[0] != language_code:
+                        continue
+                    if isinstance(result, Exception):
+                        error = error or result
+                        continue
+                    content, etag = result
+                    if content is None:
+                        continue  # graphic asset did not change
+                    graphic, url = asset[1], asset[2]
+                    getattr(self, graphic).delete()
+                    getattr(self, graphic).save(os.path.basename(url), BytesIO(content),
+                                                save=False)
+                    setattr(remote, graphic + '_etag', etag)
                 self.save()
-                remote_app.save()
+                remote.save()
+        if error is not None:
+            raise error  # to retry the failed downloads later
 
     # noinspection PyTypeChecker
     def update_from_tracked_remote_app(self, remote_apk_pointer):
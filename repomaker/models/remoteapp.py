@@ -9,9 +9,10 @@ from django.db.models.signals import post_delete
 from django.dispatch import receiver
 from django.utils import timezone, translation
 from django.utils.translation import ugettext_lazy as _
-from fdroidserver import net
+from modeltranslation import settings as modeltranslation_settings
+from modeltranslation.utils import build_localized_fieldname
 
-from repomaker import tasks
+from repomaker import mirrors, tasks
 from repomaker.tasks import PRIORITY_REMOTE_APP_ICON
 from repomaker.utils import clean
 from .app import AbstractApp
@@ -34,11 +35,34 @@ class RemoteApp(AbstractApp):
     def update_from_json(self, app):
         """
         Updates the data for this app and ensures that at least one translation exists.
+        :param app: A JSON app object from the repository v1 index.
+        :return: True if app changed, False otherwise
+        """
+        if not self.apply_json(app):
+            return False
+        self.save()
+        if 'categories' in app:
+            self._update_categories(app['categories'])
+        if 'localized' in app:
+            self._update_screenshots(app['localized'])
+        # do the icon last, because we require the app to be saved, so a pk exists
+        if 'icon' in app:
+            # Schedule icon updating task, because it takes too long within this task
+            # pylint: disable=unexpected-keyword-arg
+            tasks.update_remote_app_icon(self.pk, app['icon'], priority=PRIORITY_REMOTE_APP_ICON)
+        return True
+
+    def apply_json(self, app):
+        """
+        Applies the data of the given JSON app to this app and its translations without saving it,
+        so that many apps can be saved at once.
+        Categories, screenshots and the icon are left to the caller.
+
         :param app: A JSON app object from the repository v1 index.
         :return: True if app changed, False otherwise
         """
         if 'lastUpdated' not in app:
-            logging.warning("App %s is missing 'lastUpdated' in index")
+            logging.warning("App %s is missing 'lastUpdated' in index", app.get('packageName'))
             return False
 
         # don't update if app hasn't changed since last update
@@ -50,7 +74,7 @@ class RemoteApp(AbstractApp):
             self.last_updated_date = last_update
 
         if 'name' not in app:
-            logging.warning("App %s is missing 'name' in index")
+            logging.warning("App %s is missing 'name' in index", app.get('packageName'))
             return False
         self.name = app['name']
         if 'summary' in app and not self._move_to_localized(app, 'summary'):
@@ -61,27 +85,32 @@ class RemoteApp(AbstractApp):
             self.author_name = app['authorName']
         if 'webSite' in app:
             self.website = app['webSite']
-        if 'categories' in app:
-            self._update_categories(app['categories'])
         if 'added' in app:
             date_added = datetime.datetime.fromtimestamp(app['added'] / 1000, timezone.utc)
             if self.added_date > date_added:
                 self.added_date = date_added
-        self.save()
         if 'localized' in app:
-            self._update_translations(app['localized'])
-            self._update_screenshots(app['localized'])
+            self._update_translations(app['localized'], save=False)
         if len(self.get_available_languages()) == 0:
             # no localization available, translate in default language
             self.default_translate()
-            self.save()
-        # do the icon last, because we require the app to be saved, so a pk exists
-        if 'icon' in app:
-            # Schedule icon updating task, because it takes too long within this task
-            # pylint: disable=unexpected-keyword-arg
-            tasks.update_remote_app_icon(self.pk, app['icon'], priority=PRIORITY_REMOTE_APP_ICON)
         return True
 
+    @staticmethod
+    def get_json_fields():
+        """
+        Returns the names of all fields that apply_json() can change,
+        including the fields of all translations.
+        """
+        fields = ['name', 'summary_override', 'description_override', 'author_name', 'website',
+                  'added_date', 'last_updated_date', 'available_languages']
+        for field in ['summary', 'description', 'feature_graphic_url', 'high_res_icon_url',
+                      'tv_banner_url']:
+            fields.append(field)
+            fields += [build_localized_fieldname(field, language)
+                       for language in modeltranslation_settings.AVAILABLE_LANGUAGES]
+        return fields
+
     @staticmethod
     def _move_to_localized(app, key):
         """
@@ -108,7 +137,7 @@ class RemoteApp(AbstractApp):
         :param icon_name: The file name of the icon
         """
         url = self.repo.url + '/icons-640/' + icon_name
-        icon, etag = net.http_get(url, self.icon_etag)
+        icon, etag = mirrors.http_get(url, self.repo.get_mirror_urls(), self.icon_etag)
         if icon is None:
             return  # icon did not change
 
@@ -133,7 +162,7 @@ class RemoteApp(AbstractApp):
                 # Drop the unknown category, don't create new categories automatically here
                 pass
 
-    def _update_translations(self, localized):
+    def _update_translations(self, localized, save=True):
         # TODO also support 'name, 'whatsNew' and 'video'
         supported_fields = ['summary', 'description', 'featureGraphic', 'icon', 'tvBanner']
         available_languages = self.get_available_languages()
@@ -147,11 +176,11 @@ class RemoteApp(AbstractApp):
                 self.translate(language_code)
 
             with translation.override(language_code):
-                self.apply_translation(original_language_code, app_translation)
+                self.apply_translation(original_language_code, app_translation, save)
 
     # pylint: disable=attribute-defined-outside-init
     # noinspection PyAttributeOutsideInit
-    def apply_translation(self, original_language_code, new_translation):
+    def apply_translation(self, original_language_code, new_translation, save=True):
         # textual metadata
         if 'summary' in new_translation:
             self.summary = new_translation['summary']
@@ -165,7 +194,8 @@ class RemoteApp(AbstractApp):
             self.high_res_icon_url = url + new_translation['icon']
         if 'tvBanner' in new_translation:
             self.tv_banner_url = url + new_translation['tvBanner']
-        self.save()
+        if save:
+            self.save()
 
     def _update_screenshots(self, localized):
         from repomaker.models import RemoteScreenshot
@@ -178,6 +208,20 @@ class RemoteApp(AbstractApp):
                 # add screenshot (ignores unsupported types such as summary)
                 RemoteScreenshot.add(language_code, t, self, type_url, files)
 
+    def get_screenshots_from_json(self, localized):
+        """
+        Returns new unsaved RemoteScreenshots for all supported screenshots
+        in the given localized JSON object, like _update_screenshots() would add them.
+        """
+        from repomaker.models import RemoteScreenshot
+        screenshots = []
+        for original_language_code, types in localized.items():
+            language_code = original_language_code.lower()
+            for t, files in types.items():
+                type_url = self._get_base_url(original_language_code, t)
+                screenshots += RemoteScreenshot.from_json(language_code, t, self, type_url, files)
+        return screenshots
+
     def _get_base_url(self, locale, asset_type=None):
         """
         Returns the base URL for the given locale and asset type with a trailing slash
@@ -235,8 +279,9 @@ class RemoteApp(AbstractApp):
         tasks.download_remote_graphic_assets(app.id, self.id)
 
         # schedule download of remote screenshots if available
-        for remote in RemoteScreenshot.objects.filter(app=self).all():
-            remote.download_async(app)
+        screenshots = RemoteScreenshot.objects.filter(app=self).all()
+        if screenshots:
+            RemoteScreenshot.download_all_async(screenshots, app)
 
         return app
 
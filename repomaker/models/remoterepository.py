@@ -2,7 +2,10 @@ import datetime
 import json
 import logging
 import os
+import random
+import urllib.parse
 from io import BytesIO
+from shutil import rmtree
 
 import django.db.transaction
 from allauth.account.signals import user_signed_up
@@ -10,14 +13,17 @@ from background_task.tasks import Task
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_delete
 from django.dispatch import receiver
 from django.utils import timezone
-from fdroidserver import index, net
-from repomaker import tasks
-from repomaker.models.repository import AbstractRepository
+from repomaker import downloads, mirrors, remoteindex, remotesync, tasks
+from repomaker.models.repository import AbstractRepository, FDROIDSERVER_LOCK
 from repomaker.storage import get_remote_repo_path
-from repomaker.tasks import PRIORITY_REMOTE_REPO
-from repomaker.utils import clean
+from repomaker.tasks import PRIORITY_REMOTE_APP_ICON, PRIORITY_REMOTE_REPO
+from repomaker.utils import clean, timed_phase
+
+# the weight of the latest time between changes in the moving average of a remote repository
+CHANGE_INTERVAL_WEIGHT = 0.3
 
 
 class RemoteRepository(AbstractRepository):
@@ -28,10 +34,45 @@ class RemoteRepository(AbstractRepository):
     mirrors = models.TextField(blank=True)
     disabled = models.BooleanField(default=False)
     last_change_date = models.DateTimeField()
+    # seconds between updates adapted to how often the repository changes, see schedule_update()
+    update_interval = models.PositiveIntegerField(null=True, blank=True)
+    # moving average of the seconds between changes of the repository, see adapt_update_interval()
+    change_interval = models.FloatField(null=True, blank=True)
+    min_update_interval = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Overrides settings.REMOTE_UPDATE_MIN_INTERVAL")
+    max_update_interval = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Overrides settings.REMOTE_UPDATE_MAX_INTERVAL")
+    next_update_date = models.DateTimeField(null=True, blank=True)
+    # the last app saved by a sync that did not finish and the date of the index it synced
+    sync_checkpoint_package = models.CharField(max_length=255, blank=True, null=True)
+    sync_checkpoint_date = models.DateTimeField(null=True, blank=True)
 
     def get_path(self):
         return os.path.join(settings.MEDIA_ROOT, get_remote_repo_path(self))
 
+    def get_private_path(self):
+        return os.path.join(settings.PRIVATE_REPO_ROOT, get_remote_repo_path(self))
+
+    def get_index_path(self):
+        """
+        Returns the path of the last index v2 that the apps were updated from.
+        """
+        return os.path.join(self.get_private_path(), 'index-v2.json')
+
+    def get_mirror_urls(self):
+        """
+        Returns the base URLs of this repository and of its mirrors to download files from,
+        starting with the URL of this repository.
+        """
+        urls = [self.url] if self.url else []
+        if self.mirrors:
+            for url in json.loads(self.mirrors):
+                url = url.rstrip('/')
+                # onion services can not be reached without Tor
+                if url not in urls and not urllib.parse.urlsplit(url).netloc.endswith('.onion'):
+                    urls.append(url)
+        return urls
+
     def update_async(self):
         """
         Schedules the repository to be updated asynchronously from remote location
@@ -41,38 +82,125 @@ class RemoteRepository(AbstractRepository):
         self.update_scheduled = True
         self.save()
         # pylint: disable=unexpected-keyword-arg
-        tasks.update_remote_repo(self.id, repeat=Task.DAILY, priority=PRIORITY_REMOTE_REPO)
+        tasks.update_remote_repo(self.id, priority=PRIORITY_REMOTE_REPO)
+
+    def get_update_interval_bounds(self):
+        """
+        Returns a tuple of the minimum and maximum seconds between updates of this repository.
+        """
+        min_interval = self.min_update_interval or settings.REMOTE_UPDATE_MIN_INTERVAL
+        max_interval = self.max_update_interval or settings.REMOTE_UPDATE_MAX_INTERVAL
+        return min_interval, max(min_interval, max_interval)
+
+    def adapt_update_interval(self, previous_change_date):
+        """
+        Adapts the interval between updates to how often this repository actually changes.
+
+        If the repository changed since the last update, the time between its last two changes
+        is added to a moving average of the time between its changes
+        and the interval becomes half of that, so it is updated about twice per change.
+        If it did not change, e.g. because its index still had the same ETag,
+        the interval grows by half, so rarely changing repositories are updated less often.
+
+        :param previous_change_date: The last_change_date before the update
+        """
+        interval = self.update_interval or settings.REMOTE_UPDATE_INTERVAL
+        if previous_change_date is not None and self.last_change_date > previous_change_date:
+            if previous_change_date > datetime.datetime.fromtimestamp(0, timezone.utc):
+                time_between_changes = self.last_change_date - previous_change_date
+                if self.change_interval is None:
+                    self.change_interval = time_between_changes.total_seconds()
+                else:
+                    self.change_interval += CHANGE_INTERVAL_WEIGHT * \
+                        (time_between_changes.total_seconds() - self.change_interval)
+                interval = self.change_interval / 2
+            else:
+                interval /= 2  # the first change that was seen
+        else:
+            interval *= 1.5
+        min_interval, max_interval = self.get_update_interval_bounds()
+        self.update_interval = int(min(max(interval, min_interval), max_interval))
+
+    def schedule_update(self):
+        """
+        Schedules the next update of this repository after its update interval.
+
+        The time is moved randomly by up to settings.REMOTE_UPDATE_JITTER of the interval,
+        so the updates of remote repositories that were added together spread out.
+        Updates that were scheduled for later before get dropped.
+        """
+        interval = self.update_interval or settings.REMOTE_UPDATE_INTERVAL
+        jitter = settings.REMOTE_UPDATE_JITTER
+        delay = interval * random.uniform(1 - jitter, 1 + jitter)
+        self.next_update_date = timezone.now() + datetime.timedelta(seconds=delay)
+        self.save(update_fields=['update_interval', 'change_interval', 'next_update_date'])
+
+        # the running update is locked and updates requested meanwhile are due already
+        Task.objects.get_task('repomaker.tasks.update_remote_repo', args=(self.id,)) \
+            .filter(locked_by=None, run_at__gt=timezone.now()).delete()
+        # pylint: disable=unexpected-keyword-arg
+        tasks.update_remote_repo(self.id, schedule=self.next_update_date,
+                                 priority=PRIORITY_REMOTE_REPO)
 
     def update_index(self, update_apps=True):
         """
         Downloads the remote index and passes it to update()
+        without loading the entire index into memory.
+        If the apps were updated from an index v2 before,
+        only the changes since then are downloaded and updated.
+
+        When run by a remotesync.RemoteSyncExecutor,
+        other remote repositories can use the database while the index downloads
+        and the update stops between chunks of apps once the deadline of the sync passed.
 
         :raises: VerificationException() if the index can not be validated anymore
         """
-        self.get_config()
-        repo_index, etag = index.download_repo_index(self.get_fingerprint_url(),
-                                                     etag=self.index_etag)
+        with FDROIDSERVER_LOCK:
+            self.get_config()
+        url = self.get_fingerprint_url()
+        mirror_urls = self.get_mirror_urls()
+        with timed_phase('download_index', 1), remotesync.database_unlocked():
+            repo_index, etag = remoteindex.download_repo_index(
+                url, etag=self.index_etag, last_index_path=self.get_index_path(),
+                mirror_urls=mirror_urls)
         if repo_index is None:
             logging.info("Remote repo ETag for '%s' did not change, not updating.", str(self))
             return  # the index did not change since last time
 
+        try:
+            self._update_from_index(repo_index, etag, update_apps)
+        finally:
+            # the index is read from a temporary file that is removed when it gets closed
+            if hasattr(repo_index, 'close'):
+                repo_index.close()
+
+    def _update_from_index(self, repo_index, etag, update_apps):
+        previous_change_date = self.last_change_date
         try:
             self._update(repo_index, update_apps)  # also saves at the end
         except Exception as e:
-            # reset date of last change, so the update will be re-tried
-            self.last_change_date = datetime.datetime.fromtimestamp(0, timezone.utc)
+            # keep the date of the last complete update, so the update will be re-tried
+            # and resumes after the apps that were saved already
+            self.last_change_date = previous_change_date
             raise e
 
         if update_apps:  # TODO improve this once the workflow has been designed
             self.index_etag = etag  # don't set etag when only adding the repo, so it fetches again
             self.save()
+            # the next update only needs the changes since this index
+            remoteindex.store_repo_index(repo_index, self.get_index_path())
 
-    @django.db.transaction.atomic
     def _update(self, repo_index, update_apps):
         """
-        Updates this remote repository with the given index
+        Updates this remote repository with the given index.
+
+        The apps are saved in a transaction for each chunk of them,
+        so the database is not locked for the entire update.
+        The date of the last change is only set once all apps were saved.
 
-        :param repo_index: The repository index v1 in JSON format
+        :param repo_index: The repository index v1 in JSON format or a RepoIndex.
+                           If it has 'removed' package names,
+                           only its apps are updated and the removed ones deleted.
         :param update_apps: False if apps should not be updated as well
         """
         # bail out if the repo did not change since last update
@@ -87,13 +215,12 @@ class RemoteRepository(AbstractRepository):
         self.description = clean(repo_index['repo']['description'])
         if 'mirrors' in repo_index['repo']:
             self.mirrors = json.dumps(repo_index['repo']['mirrors'])
-        if update_apps:
-            self.last_change_date = repo_change
-        else:
+        if not update_apps:
             # apps will be updated asynchronously soon, so this allows the update to pass
             self.last_change_date = datetime.datetime.fromtimestamp(0, timezone.utc)
         if not self.public_key:
-            self.public_key = repo_index['repo']['pubkey']  # added by index.download_repo_index()
+            # added by remoteindex.download_repo_index()
+            self.public_key = repo_index['repo']['pubkey']
 
         # download and save repository icon
         try:
@@ -104,11 +231,17 @@ class RemoteRepository(AbstractRepository):
         self.save()
 
         if update_apps:
-            self._update_apps(repo_index['apps'], repo_index['packages'])
+            with timed_phase('update_apps', len(repo_index['apps'])):
+                self._update_apps(repo_index['apps'], repo_index['packages'],
+                                  repo_index.get('removed'), repo_change)
+            self.last_change_date = repo_change
+            self.sync_checkpoint_package = None
+            self.sync_checkpoint_date = None
+            self.save()
 
     def _update_icon(self, icon_name):
         url = self.url + '/icons/' + icon_name
-        icon, etag = net.http_get(url, self.icon_etag)
+        icon, etag = mirrors.http_get(url, self.get_mirror_urls(), self.icon_etag)
         if icon is None:
             return  # icon did not change
         if not self.pk:
@@ -117,76 +250,221 @@ class RemoteRepository(AbstractRepository):
         self.icon_etag = etag
         self.icon.save(icon_name, BytesIO(icon), save=False)
 
-    def _update_apps(self, apps, packages):
+    def _update_apps(self, apps, packages, removed=None, index_date=None):
+        """
+        Updates the apps of this repository and their packages from the given index.
+
+        The apps are compared to the existing ones in memory and only the changed ones
+        get saved in chunks of settings.REMOTE_SYNC_CHUNK_SIZE apps,
+        so the number of queries does not grow with the number of apps in a chunk.
+        Each chunk is saved in its own transaction together with a checkpoint,
+        so an update of the same index that failed before resumes after the last saved chunk.
+
+        :param apps: An iterable of JSON app objects from the repository v1 index
+        :param packages: A dict with a list of JSON package objects for each package name
+        :param removed: A list of package names of apps to remove
+                        or None to remove all apps that are not in the given apps
+        :param index_date: The date of the index or None if no checkpoints should be used
+        """
         from repomaker.models.remoteapp import RemoteApp
+        existing_apps = dict()
+        for remote_app in RemoteApp.objects.filter(repo=self):
+            remote_app.repo = self  # prevents a query per app when building URLs
+            existing_apps[remote_app.package_id] = remote_app
+
+        # skip the apps up to the checkpoint, the same index has them in the same order
+        checkpoint = None
+        if index_date is not None and self.sync_checkpoint_date == index_date:
+            checkpoint = self.sync_checkpoint_package
+            logging.info("Resuming update of %s after %s", str(self), checkpoint)
+
         # update the apps from this repo and remember all package names we have seen
-        package_names = []
+        package_names = set()
+        changed_apps = []
         for app in apps:
+            downloads.check_deadline()  # the index gets parsed while iterating over its apps
             if app['packageName'] not in packages:
                 logging.info("App %s has no packages, so ignore it.", app['packageName'])
                 continue
-
-            # query for existing remote apps, if this repo was already saved
-            if self.pk:
-                query_set = RemoteApp.objects.filter(repo=self, package_id=app['packageName'])
+            package_names.add(app['packageName'])
+            if checkpoint is not None:
+                if app['packageName'] == checkpoint:
+                    checkpoint = None
+                continue
 
             # update existing app or create a new one
-            if self.pk and query_set.exists():
-                remote_app = query_set.get()
-            else:
+            remote_app = existing_apps.get(app['packageName'])
+            if remote_app is None:
                 remote_app = RemoteApp(package_id=app['packageName'], repo=self)
-            package_names.append(app['packageName'])
-            changed = remote_app.update_from_json(app)  # this also saves the remote_app
+                existing_apps[remote_app.package_id] = remote_app
+            if not remote_app.apply_json(app):
+                continue  # TODO test what happens when only a package gets added
 
-            if not changed:  # TODO test what happens when only a package gets added
-                continue
+            changed_apps.append((remote_app, app))
+            if len(changed_apps) >= settings.REMOTE_SYNC_CHUNK_SIZE:
+                self._save_apps(changed_apps, packages, index_date)
+                changed_apps = []
+        if checkpoint is not None:
+            logging.warning("Checkpoint %s not found in index of %s, updating all apps.",
+                            checkpoint, str(self))
+            self.sync_checkpoint_date = None
+            self._update_apps(apps, packages, removed, index_date)
+            return
+        if changed_apps:
+            self._save_apps(changed_apps, packages, index_date)
 
-            # update packages belonging to app
-            for package in packages[app['packageName']]:
-                self._update_package(remote_app, package)
+        # remove apps that no longer exist
+        if removed is None:
+            self._remove_old_apps(package_names)
+        else:
+            chunk_size = settings.REMOTE_SYNC_CHUNK_SIZE
+            for i in range(0, len(removed), chunk_size):
+                downloads.check_deadline()
+                remote_apps = RemoteApp.objects.filter(repo=self,
+                                                       package_id__in=removed[i:i + chunk_size])
+                with django.db.transaction.atomic():
+                    for remote_app in remote_apps:
+                        remote_app.delete()
 
-            # update tracking apps and add latest package, if there are any
-            tracking_apps = remote_app.app_set.all()
-            if tracking_apps.count() > 0:
-                remote_pointer = remote_app.get_latest_apk_pointer()
-                for tracking_app in tracking_apps:
-                    tracking_app.update_from_tracked_remote_app(remote_pointer)
+    @django.db.transaction.atomic
+    def _save_apps(self, changed_apps, packages, index_date=None):
+        """
+        Saves the given changed apps together with their categories, screenshots and packages
+        and updates the local apps tracking them.
 
-        # remove apps that no longer exist
-        self._remove_old_apps(package_names)
+        :param changed_apps: A list of tuples with a RemoteApp and the JSON app object
+                             that was applied to it
+        :param packages: A dict with a list of JSON package objects for each package name
+        :param index_date: The date of the index to save the last app as checkpoint for
+                           or None to not save a checkpoint
+        """
+        from repomaker.models import Apk, App, Category, RemoteApkPointer, RemoteScreenshot
+        from repomaker.models.remoteapp import RemoteApp
 
-    def _update_package(self, app, package_info):
-        from repomaker.models import Apk, RemoteApkPointer
+        # save apps and get the primary keys of the new ones
+        old_apps = [remote_app for remote_app, _ in changed_apps if remote_app.pk]
+        new_apps = [remote_app for remote_app, _ in changed_apps if not remote_app.pk]
+        RemoteApp.objects.bulk_update(old_apps, RemoteApp.get_json_fields())
+        RemoteApp.objects.bulk_create(new_apps)
+        if new_apps:
+            app_ids = dict(RemoteApp.objects.filter(
+                repo=self, package_id__in=[remote_app.package_id for remote_app in new_apps]
+            ).values_list('package_id', 'pk'))
+            for remote_app in new_apps:
+                remote_app.pk = app_ids[remote_app.package_id]
+                remote_app._state.adding = False  # pylint: disable=protected-access
+        remote_apps = {remote_app.pk: remote_app for remote_app, _ in changed_apps}
 
-        apks = Apk.objects.filter(package_id=package_info['packageName'], hash=package_info['hash'])
-        if apks.exists():
-            apk = apks.get()
-        else:
-            apk = Apk()
-            apk.apply_json_package_info(package_info)
-            apk.save()
+        # add categories, but don't create new categories automatically here
+        category_names = {name for _, app in changed_apps for name in app.get('categories', [])}
+        categories = dict(Category.objects.filter(user=None, name__in=category_names)
+                          .values_list('name', 'pk'))
+        through = RemoteApp.category.through
+        links = set(through.objects.filter(remoteapp_id__in=remote_apps)
+                    .values_list('remoteapp_id', 'category_id'))
+        new_links = []
+        for remote_app, app in changed_apps:
+            for name in app.get('categories', []):
+                # TODO not only add, but also remove old categories again
+                link = (remote_app.pk, categories.get(name))
+                if link[1] is not None and link not in links:
+                    links.add(link)
+                    new_links.append(through(remoteapp_id=link[0], category_id=link[1]))
+        through.objects.bulk_create(new_links)
 
-        pointers = RemoteApkPointer.objects.filter(apk=apk, app=app)
-        if not pointers.exists():
-            RemoteApkPointer.objects.create(apk=apk, app=app,
-                                            url=self.url + "/" + package_info['apkName'])
+        # add screenshots
+        screenshot_keys = set(RemoteScreenshot.objects.filter(app_id__in=remote_apps)
+                              .values_list('app_id', 'language_code', 'type', 'url'))
+        new_screenshots = []
+        for remote_app, app in changed_apps:
+            if 'localized' not in app:
+                continue
+            # TODO not only add, but also remove old screenshots again
+            for screenshot in remote_app.get_screenshots_from_json(app['localized']):
+                key = (screenshot.app_id, screenshot.language_code, screenshot.type,
+                       screenshot.url)
+                if key not in screenshot_keys:
+                    screenshot_keys.add(key)
+                    new_screenshots.append(screenshot)
+        RemoteScreenshot.objects.bulk_create(new_screenshots)
+
+        # add packages that are not known yet, the index might read them from a file
+        packages = {remote_app.package_id: packages[remote_app.package_id]
+                    for remote_app in remote_apps.values()}
+        package_names = set(packages.keys())
+        apks = {(apk.package_id, apk.hash): apk
+                for apk in Apk.objects.filter(package_id__in=package_names)}
+        new_apks = dict()
+        for package_name in package_names:
+            for package_info in packages[package_name]:
+                key = (package_info['packageName'], package_info['hash'])
+                if key not in apks and key not in new_apks:
+                    apk = Apk()
+                    apk.apply_json_package_info(package_info)
+                    new_apks[key] = apk
+        if new_apks:
+            Apk.objects.bulk_create(new_apks.values())
+            apks = {(apk.package_id, apk.hash): apk
+                    for apk in Apk.objects.filter(package_id__in=package_names)}
+
+        # point the apps to their packages
+        pointers = set(RemoteApkPointer.objects.filter(app_id__in=remote_apps)
+                       .values_list('app_id', 'apk_id'))
+        new_pointers = []
+        for remote_app in remote_apps.values():
+            for package_info in packages[remote_app.package_id]:
+                apk = apks[(package_info['packageName'], package_info['hash'])]
+                if (remote_app.pk, apk.pk) not in pointers:
+                    pointers.add((remote_app.pk, apk.pk))
+                    new_pointers.append(RemoteApkPointer(
+                        apk=apk, app=remote_app, url=self.url + "/" + package_info['apkName']))
+        RemoteApkPointer.objects.bulk_create(new_pointers)
+
+        # update tracking apps and add latest package, if there are any
+        for tracking_app in App.objects.filter(tracked_remote_id__in=remote_apps):
+            tracking_app.tracked_remote = remote_apps[tracking_app.tracked_remote_id]
+            remote_pointer = tracking_app.tracked_remote.get_latest_apk_pointer()
+            tracking_app.update_from_tracked_remote_app(remote_pointer)
+
+        # Schedule a single task updating all icons, because it takes too long within this task
+        icons = [[remote_app.pk, app['icon']] for remote_app, app in changed_apps
+                 if 'icon' in app]
+        if icons:
+            # pylint: disable=unexpected-keyword-arg
+            tasks.update_remote_app_icons(icons, priority=PRIORITY_REMOTE_APP_ICON)
+
+        if index_date is not None:
+            self.sync_checkpoint_package = changed_apps[-1][0].package_id
+            self.sync_checkpoint_date = index_date
+            self.save(update_fields=['sync_checkpoint_package', 'sync_checkpoint_date'])
 
     def _remove_old_apps(self, packages):
         """
         Removes old apps from the database and this repository.
 
-        :param packages: A list of package names that should not be removed
+        :param packages: A set of package names that should not be removed
         """
         from repomaker.models.remoteapp import RemoteApp
-        old_apps = RemoteApp.objects.filter(repo=self)
-        for app in old_apps.all():
-            if app.package_id not in packages:
-                app.delete()
+        old_apps = [app for app in RemoteApp.objects.filter(repo=self)
+                    if app.package_id not in packages]
+        chunk_size = settings.REMOTE_SYNC_CHUNK_SIZE
+        for i in range(0, len(old_apps), chunk_size):
+            downloads.check_deadline()
+            with django.db.transaction.atomic():
+                for app in old_apps[i:i + chunk_size]:
+                    app.delete()
 
     class Meta(AbstractRepository.Meta):
         verbose_name_plural = "Remote Repositories"
 
 
+@receiver(post_delete, sender=RemoteRepository)
+def remote_repository_post_delete_handler(**kwargs):
+    remote_repo = kwargs['instance']
+    if os.path.exists(remote_repo.get_private_path()):
+        rmtree(remote_repo.get_private_path())
+
+
 @receiver(user_signed_up)
 def after_user_signed_up(**kwargs):
     # add new user to all pre-installed repositories
@@ -1,13 +1,16 @@
 import fdroidserver
 import logging
 import os
+import pickle
+import threading
+import zipfile
+from contextlib import contextmanager
 from io import BytesIO
-from shutil import copy, rmtree
+from shutil import rmtree
 
 import qrcode
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.base import ContentFile
 from django.db import models
 from django.db.models.signals import post_delete
@@ -16,14 +19,22 @@ from django.template.loader import render_to_string
 from django.templatetags.static import static
 from django.urls import reverse
 from django.utils import timezone
-from fdroidserver import common, deploy, update
-from repomaker import tasks
+from fdroidserver import common, deploy, signindex, update
+from repomaker import indexv2, tasks
 from repomaker.storage import REPO_DIR, get_repo_file_path, get_repo_root_path, \
-    get_icon_file_path
+    copy_if_changed, get_icon_file_path, write_if_changed
+from repomaker.scan import ApkScanError, scan_apks
 from repomaker.tasks import PRIORITY_REPO
+from repomaker.utils import QueryCounter, timed_phase
 
 REPO_DEFAULT_ICON = os.path.join('repomaker', 'images', 'default-repo-icon.png')
 
+# fdroidserver keeps its configuration in module globals, so only one thread at a time
+# can apply a repository's config and use the parts of fdroidserver that depend on it.
+# The paths of the tools fdroidserver runs are the same in every config,
+# so APK files can be scanned without it while any config is applied.
+FDROIDSERVER_LOCK = threading.RLock()
+
 
 class AbstractRepository(models.Model):
     name = models.CharField(max_length=255)
@@ -76,14 +87,20 @@ class AbstractRepository(models.Model):
             self.icon.delete(save=False)
 
     def get_config(self):
+        """
+        Returns the fdroidserver config for this repository and applies it to fdroidserver.
+        Callers need to hold the FDROIDSERVER_LOCK until they are done with fdroidserver.
+        """
+        config = self.build_config()
+        apply_config(config)
+        return config
+
+    def build_config(self):
+        """
+        Returns the fdroidserver config for this repository without applying it.
+        """
         config = {}
         common.fill_config_defaults(config)
-        common.config = config
-        common.options = Options
-        deploy.config = config
-        deploy.options = Options
-        update.config = config
-        update.options = Options
         return config
 
 
@@ -94,6 +111,7 @@ class Repository(AbstractRepository):
     key_pass = models.CharField(max_length=64)
     created_date = models.DateTimeField(default=timezone.now)
     last_publication_date = models.DateTimeField(null=True, blank=True)
+    update_requested_date = models.DateTimeField(null=True, blank=True)
 
     def get_absolute_url(self):
         return reverse('repo', kwargs={'repo_id': self.pk})
@@ -104,8 +122,8 @@ class Repository(AbstractRepository):
     def get_path(self):
         return os.path.join(settings.MEDIA_ROOT, get_repo_root_path(self))
 
-    def get_config(self):
-        config = super().get_config()
+    def build_config(self):
+        config = super().build_config()
         config.update({
             'repo_url': self.url,
             'repo_name': self.name,
@@ -132,6 +150,27 @@ class Repository(AbstractRepository):
             os.makedirs(repo_local_path)
         os.chdir(repo_local_path)
 
+    @contextmanager
+    def working_directory(self):
+        """
+        Context manager that changes into the path of this repository
+        and restores the previous working directory when leaving it.
+
+        Only use this for the parts of fdroidserver that can not be given absolute paths,
+        i.e. publishing to some storage types, and while holding the FDROIDSERVER_LOCK.
+        The working directory is shared by all threads of the process.
+        """
+        try:
+            cwd = os.getcwd()
+        except FileNotFoundError:
+            cwd = None  # the previous working directory was deleted
+        self.chdir()
+        try:
+            yield
+        finally:
+            if cwd is not None and os.path.isdir(cwd):
+                os.chdir(cwd)
+
     def create(self):
         """
         Creates the repository on disk including the keystore.
@@ -147,16 +186,14 @@ class Repository(AbstractRepository):
         self.key_store_pass = common.genpassword()
         self.key_pass = self.key_store_pass
 
-        self.chdir()
-        config = self.get_config()
-
         # Ensure icon directories exist
-        for icon_dir in update.get_all_icon_dirs(REPO_DIR):
+        for icon_dir in update.get_all_icon_dirs(self.get_repo_path()):
             if not os.path.exists(icon_dir):
                 os.makedirs(icon_dir)
 
         # Generate keystore
-        pubkey, fingerprint = common.genkeystore(config)
+        with FDROIDSERVER_LOCK:
+            pubkey, fingerprint = common.genkeystore(self.get_config())
         # pubkey is returned as bytes in fdroidserver 2.1.x
         self.public_key = pubkey.decode('ascii')
         self.fingerprint = fingerprint.replace(" ", "")
@@ -188,9 +225,11 @@ class Repository(AbstractRepository):
         # save in database/media location
         f = BytesIO()
         try:
-            if self.qrcode:
-                self.qrcode.delete(save=False)
             img.save(f, format='png')
+            if self.qrcode and os.path.isfile(self.qrcode.path):
+                # update the existing file only if the QR code changed
+                write_if_changed(self.qrcode.path, f.getvalue())
+                return
             self.qrcode.save('assets/qrcode.png', ContentFile(f.getvalue()), False)
         finally:
             f.close()
@@ -207,15 +246,14 @@ class Repository(AbstractRepository):
         qr_page_string = render_to_string('repomaker/repo_page/qr_code.html', {'repo': self})
         qr_page_string = qr_page_string.replace('/static/repomaker/css/repo/', '')
 
-        with open(os.path.join(self.get_repo_path(), 'index.html'), 'w', encoding='utf8') as f:
-            f.write(repo_page_string)  # Write repo page to file
+        # Write pages to files, unchanged files are not touched, so they won't be published again
+        write_if_changed(os.path.join(self.get_repo_path(), 'index.html'), repo_page_string)
 
         repo_page_assets = os.path.join(self.get_repo_path(), 'assets')
         if not os.path.exists(repo_page_assets):
             os.makedirs(repo_page_assets)
 
-        with open(os.path.join(repo_page_assets, 'qr_code.html'), 'w', encoding='utf8') as f:
-            f.write(qr_page_string)  # Write repo qr page to file
+        write_if_changed(os.path.join(repo_page_assets, 'qr_code.html'), qr_page_string)
 
         # copy page assets
         self._copy_page_assets()
@@ -223,6 +261,7 @@ class Repository(AbstractRepository):
     def _copy_page_assets(self):
         """
         Copies various assets required for the repo page.
+        Assets that are in place already are left alone.
         """
         repo_page_assets = os.path.join(self.get_repo_path(), 'assets')
         files = [
@@ -258,100 +297,391 @@ class Repository(AbstractRepository):
 
         # Copy all files
         for source, target in files:
-            copy(source, target)
+            copy_if_changed(source, target)
 
     def set_url(self, url):
         self.url = url
         self._generate_qrcode()
         self._generate_page()
-        self.save()
+        # only save what changed to keep requests that arrived in the meantime
+        self.save(update_fields=['url', 'qrcode'])
 
     def update_async(self):
         """
         Schedules the repository to be updated (and published)
+        after settings.REPO_UPDATE_QUIET_PERIOD has passed without further update requests.
+
+        Requests arriving while an update is scheduled already or while one is running
+        are merged into a single follow-up update.
         """
-        if self.update_scheduled:
-            return  # no need to update a repo twice with same data
+        now = timezone.now()
+        self.update_requested_date = now
+        # use queries instead of save() to not overwrite state changed by a running update task
+        repos = Repository.objects.filter(pk=self.pk)
+        if repos.filter(update_scheduled=True).update(update_requested_date=now):
+            self.update_scheduled = True
+            return  # the scheduled update will include this request and wait for the quiet period
+        repos.update(update_scheduled=True, update_requested_date=now)
         self.update_scheduled = True
-        self.save()
-        tasks.update_repo(self.id, priority=PRIORITY_REPO)  # pylint: disable=unexpected-keyword-arg
+        tasks.update_repo(self.id, priority=PRIORITY_REPO,  # pylint: disable=unexpected-keyword-arg
+                          schedule=settings.REPO_UPDATE_QUIET_PERIOD)
 
-    def update(self):
+    def update(self, incremental=False):
         """
         Updates the repository on disk, generates index, categories, etc.
 
         You normally don't need to call this directly
         as it is meant to be run in a background task scheduled by update_async().
+
+        :param incremental: If True, only the apps recorded in the change journal
+                            are re-scanned and re-rendered, everything else is re-used
+                            from the last update. Falls back to a full update
+                            if there is no previous update to build upon.
+        :return: The number of database queries the update needed
         """
-        from repomaker.models import App, ApkPointer
+        from repomaker.models import RepositoryChange
         from repomaker.models.storage import StorageManager
-        self.chdir()
-        config = self.get_config()
-        StorageManager.add_to_config(self, config)
+        with QueryCounter() as queries:
+            # remember what changed until now, changes made while updating are kept for next time
+            changed_packages, latest_change = RepositoryChange.get_changes(self)
+            state = self._read_update_state() if incremental else None
+
+            config = self.build_config()
+            StorageManager.add_to_config(self, config)
+
+            # ensure that this repo's main URL is set prior to updating
+            if not self.url and len(config['mirrors']) > 0:
+                self.set_url(config['mirrors'][0])
+
+            # Gather information about all the apk files in the repo directory, using
+            # cached data if possible.
+            with FDROIDSERVER_LOCK:
+                apply_config(config)
+                with _apkcache_file(self._get_apkcache_path()):
+                    apkcache = update.get_cache()
+            knownapks = _KnownApks()
+
+            if state is None:
+                apps, apks, cache_changed = self._get_all_apps(apkcache, knownapks)
+            else:
+                apps, apks = state
+                cache_changed = self._update_changed_apps(apps, apks, changed_packages,
+                                                          apkcache, knownapks)
+
+            # remember apps and packages before fdroidserver starts modifying them
+            state = pickle.dumps((apps, apks))
+
+            categories = set()
+            for app in apps.values():
+                categories.update(app.Categories)
+
+            update.read_added_date_from_all_apks(apps, apks)
+            update.apply_info_from_latest_apk(apps, apks)
+
+            # Make the index for the repo
+            repo_path = self.get_repo_path()
+            with FDROIDSERVER_LOCK:
+                apply_config(config)
+                with timed_phase('make_index', len(apks)), _timed_index_signing():
+                    fdroidserver.make_index(apps, apks, repo_path, False)
+                    update.make_categories_txt(repo_path, categories)
+                    self._make_index_v2()
+
+            # Update cache if it changed
+            if cache_changed:
+                with FDROIDSERVER_LOCK, _apkcache_file(self._get_apkcache_path()):
+                    update.write_cache(apkcache)
+
+            # Save state for the next incremental update and forget the changes that are included
+            self._write_update_state(state)
+            RepositoryChange.clear(self, latest_change)
+
+            # Update repo page
+            with timed_phase('generate_page'):
+                self._generate_page()
+
+        logging.info("Updated repo %d with %d database queries", self.pk, queries.count)
+        return queries.count
+
+    def _make_index_v2(self):
+        """
+        Generates the index v2 with diffs to its earlier versions from the index v1,
+        so clients only need to download what changed since they last updated.
+        Must only be used while holding the FDROIDSERVER_LOCK with this repository's config.
+        """
+        repo_path = self.get_repo_path()
+        if not os.path.isfile(os.path.join(repo_path, 'index-v1.json')):
+            logging.warning("Repo %d has no index v1 to generate index v2 from.", self.pk)
+            return
+        indexv2.make_index_v2(repo_path, os.path.join(self.get_private_path(), 'index-v2'),
+                              signindex.sign_jar)
 
-        # ensure that this repo's main URL is set prior to updating
-        if not self.url and len(config['mirrors']) > 0:
-            self.set_url(config['mirrors'][0])
+    def _get_apkcache_path(self):
+        return os.path.join(self.get_path(), 'tmp', 'apkcache.json')
 
-        # Gather information about all the apk files in the repo directory, using
-        # cached data if possible.
-        apkcache = update.get_cache()
+    def _get_all_apps(self, apkcache, knownapks):
+        """
+        Scans all files in the repo directory and applies app metadata from the database.
 
-        # Process all apks in the main repo
-        knownapks = common.KnownApks()
-        apks, cache_changed = update.process_apks(apkcache, REPO_DIR, knownapks, False)
+        :return: A tuple of a dict with metadata apps keyed by package ID,
+                 a list of packages and True if the apkcache changed
+        """
+        pointers_by_hash = self._get_pointers_by_hash()
+        pointers = [pointer for p in pointers_by_hash.values() for pointer in p]
+
+        with timed_phase('scan_apks') as phase:
+            # Scan new APKs in parallel and re-use scan results of APKs that were already scanned,
+            # e.g. for other repositories
+            self._scan_apks(apkcache, pointers)
+            cache_changed = self._apply_scan_cache(apkcache, knownapks, pointers)
+
+            # Process all apks in the main repo
+            apks, apk_cache_changed = update.process_apks(apkcache, self.get_repo_path(),
+                                                          knownapks, False)
+            cache_changed = cache_changed or apk_cache_changed
+            self._store_scan_results(apks, pointers)
+            phase.count = len(apks)
 
         # Apply app metadata from database
+        metadata_apps = self._get_metadata_apps()
         apps = {}
-        categories = set()
         for apk in apks:
-            try:
-                app = App.objects.get(repo=self, package_id=apk['packageName']).to_metadata_app()
-                apps[app.id] = app
-                categories.update(app.Categories)
-            except ObjectDoesNotExist:
+            if apk['packageName'] in metadata_apps:
+                apps[apk['packageName']] = metadata_apps[apk['packageName']]
+            else:
                 logging.warning("App '%s' not found in database", apk['packageName'])
 
         # Scan non-apk files in the repo
-        files, file_cache_changed = update.scan_repo_files(apkcache, REPO_DIR, knownapks, False)
+        files, file_cache_changed = update.scan_repo_files(apkcache, self.get_repo_path(),
+                                                           knownapks, False)
 
         # Apply metadata from database
         for file in files:
-            pointers = ApkPointer.objects.filter(repo=self, apk__hash=file['hash'])
-            if not pointers.exists():
+            pointers = pointers_by_hash.get(file['hash'], [])
+            if not pointers:
                 logging.warning("App with hash '%s' not found in database", file['hash'])
-            elif pointers.count() > 1:
+            elif len(pointers) > 1:
                 logging.error("Repo %d has more than one app with hash '%s'", self.pk, file['hash'])
             else:
                 # add app to list of apps to be included in index
                 pointer = pointers[0]
-                app = pointer.app.to_metadata_app()
-                apps[pointer.app.package_id] = app
-                categories.update(app.Categories)
+                apps[pointer.app.package_id] = metadata_apps[pointer.app.package_id]
+                apks.append(self._apply_pointer_to_repo_file(pointer, file))
 
-                # update package data and add to repo files
-                file['name'] = pointer.app.name
-                file['versionCode'] = pointer.apk.version_code
-                file['versionName'] = pointer.apk.version_name
-                file['packageName'] = pointer.apk.package_id
-                apks.append(file)
+        return apps, apks, cache_changed or file_cache_changed
 
-        update.read_added_date_from_all_apks(apps, apks)
-        update.apply_info_from_latest_apk(apps, apks)
+    def _update_changed_apps(self, apps, apks, changed_packages, apkcache, knownapks):
+        """
+        Re-scans the files and re-renders the metadata of all changed apps
+        and replaces their old information in :param apps and :param apks.
 
-        # Sort the app list by name
-        sortedids = sorted(apps.keys(), key=lambda app_id: apps[app_id].Name.upper())
+        :return: True if the apkcache changed
+        """
+        from repomaker.models import ApkPointer
+        if not changed_packages:
+            return False
+
+        # forget old information about changed apps
+        for package_id in changed_packages:
+            apps.pop(package_id, None)
+        apks[:] = [apk for apk in apks if apk['packageName'] not in changed_packages]
+
+        # scan only the files belonging to changed apps
+        ada = update.disabled_algorithms_allowed()
+        pointers = ApkPointer.objects.filter(repo=self, apk__package_id__in=changed_packages) \
+            .select_related('apk', 'app')
+        pointers = [pointer for pointer in pointers if pointer.file and pointer.app]
+        with timed_phase('scan_apks', len(pointers)):
+            self._scan_apks(apkcache, pointers)
+            cache_changed = self._apply_scan_cache(apkcache, knownapks, pointers)
+            for pointer in pointers:
+                file_name = os.path.basename(pointer.file.name)
+                if file_name.endswith('.apk'):
+                    skip, apk, apk_cache_changed = update.process_apk(apkcache, file_name,
+                                                                      self.get_repo_path(),
+                                                                      knownapks, False, ada, True)
+                    if skip:
+                        continue
+                    cache_changed = cache_changed or apk_cache_changed
+                    apks.append(apk)
+                else:
+                    apks.append(self._apply_pointer_to_repo_file(pointer, {
+                        'apkName': file_name,
+                        'hash': pointer.apk.hash,
+                        'hashType': pointer.apk.hash_type,
+                        'size': pointer.apk.size,
+                        'added': timezone.make_naive(pointer.apk.added_date),
+                    }))
+            self._store_scan_results(apks, pointers)
+
+        # re-render metadata of changed apps
+        package_ids = {apk['packageName'] for apk in apks}
+        for package_id, app in self._get_metadata_apps(changed_packages).items():
+            if package_id in package_ids:
+                apps[package_id] = app
+        return cache_changed
+
+    def _get_metadata_apps(self, package_ids=None):
+        """
+        Loads the apps of this repository together with their categories, screenshots
+        and translations in a constant number of queries.
 
-        # Make the index for the repo
-        fdroidserver.make_index(apps, apks, REPO_DIR, False)
-        update.make_categories_txt(REPO_DIR, categories)
+        :param package_ids: If given, only apps with these package IDs are loaded
+        :return: A dict with fdroidserver metadata apps keyed by package ID
+        """
+        from repomaker.models import App
+        with timed_phase('load_metadata') as phase:
+            apps = App.objects.filter(repo=self).prefetch_related('category', 'screenshot_set')
+            if package_ids is not None:
+                apps = apps.filter(package_id__in=package_ids)
+            metadata_apps = {app.package_id: app.to_metadata_app() for app in apps}
+            phase.count = len(metadata_apps)
+        return metadata_apps
+
+    def _get_pointers_by_hash(self):
+        """
+        Loads all APK pointers of this repository that belong to an app in a single query.
 
-        # Update cache if it changed
-        if cache_changed or file_cache_changed:
-            update.write_cache(apkcache)
+        :return: A dict with lists of pointers keyed by the hash of their file
+        """
+        from repomaker.models import ApkPointer
+        pointers_by_hash = {}
+        pointers = ApkPointer.objects.filter(repo=self, apk__isnull=False, app__isnull=False) \
+            .select_related('apk', 'app')
+        for pointer in pointers:
+            pointers_by_hash.setdefault(pointer.apk.hash, []).append(pointer)
+        return pointers_by_hash
+
+    def _scan_apks(self, apkcache, pointers):
+        """
+        Scans the APK files of the given pointers that were neither scanned for this repository
+        nor for any other one in parallel and stores the results with their APKs.
+        """
+        apks = {}
+        for pointer in pointers:
+            file_name = os.path.basename(pointer.file.name)
+            if not file_name.endswith('.apk') or pointer.apk.pk in apks:
+                continue
+            if apkcache.get(file_name, {}).get('hash') == pointer.apk.hash:
+                continue  # scan result is in apkcache already
+            path = os.path.join(self.get_repo_path(), file_name)
+            if os.path.isfile(path) and pointer.apk.get_scan_result() is None:
+                apks[pointer.apk.pk] = (pointer.apk, path)
+        if not apks:
+            return
 
-        # Update repo page
-        self._generate_page()
+        ada = update.disabled_algorithms_allowed()
+        scan_results = scan_apks([path for _, path in apks.values()], ada)
+        for (apk, _), scan_result in zip(apks.values(), scan_results):
+            if isinstance(scan_result, ApkScanError):
+                continue  # fdroidserver will skip this APK file when processing it
+            apk.set_scan_result(scan_result)
+            apk.save(update_fields=['scan_cache'])
+
+    def _apply_scan_cache(self, apkcache, knownapks, pointers):
+        """
+        Adds the scan results stored with the APKs of the given pointers to :param apkcache,
+        so APK files that were scanned before, e.g. for another repository, are not scanned again.
+        Only the icons of an APK get extracted, if they are still missing in this repository.
+
+        :return: True if the apkcache changed
+        """
+        cache_changed = False
+        for pointer in pointers:
+            file_name = os.path.basename(pointer.file.name)
+            if not file_name.endswith('.apk') or not pointer.apk.scan_cache:
+                continue
+            if apkcache.get(file_name, {}).get('hash') == pointer.apk.hash:
+                continue  # scan result is in apkcache already
+            if not os.path.isfile(os.path.join(self.get_repo_path(), file_name)):
+                continue  # file is still missing
+            scan_result = pointer.apk.get_scan_result()
+            if scan_result is None:
+                continue
+            scan_result['apkName'] = file_name
+            if not self._has_icons(scan_result):
+                self._extract_icons(scan_result)
+            scan_result['added'] = knownapks.recordapk(file_name, scan_result['packageName'])
+            apkcache[file_name] = scan_result
+            cache_changed = True
+        return cache_changed
+
+    @staticmethod
+    def _store_scan_results(apks, pointers):
+        """
+        Stores the scan results of the APK files in :param apks with their APKs,
+        so other repositories don't need to scan them again.
+        """
+        apks_by_hash = {pointer.apk.hash: pointer.apk for pointer in pointers}
+        for repo_file in apks:
+            if not repo_file['apkName'].endswith('.apk'):
+                continue
+            apk = apks_by_hash.get(repo_file['hash'])
+            if apk is None or apk.get_scan_result() is not None:
+                continue
+            apk.set_scan_result(repo_file)
+            apk.save(update_fields=['scan_cache'])
+
+    def _has_icons(self, scan_result):
+        if not scan_result.get('icons'):
+            return False
+        for density, icon_name in scan_result['icons'].items():
+            icon_dir = update.get_icon_dir(self.get_repo_path(), density)
+            if not os.path.isfile(os.path.join(icon_dir, icon_name)):
+                return False
+        return True
+
+    def _extract_icons(self, scan_result):
+        """
+        Extracts the icons of the APK described by :param scan_result into the repository
+        the same way fdroidserver does it when scanning an APK.
+        """
+        repo_path = self.get_repo_path()
+        for icon_dir in update.get_all_icon_dirs(repo_path):
+            if not os.path.exists(icon_dir):
+                os.makedirs(icon_dir)
+        scan_result['icons'] = {}
+        icon_name = "%s.%s.png" % (scan_result['packageName'], scan_result['versionCode'])
+        with zipfile.ZipFile(os.path.join(repo_path, scan_result['apkName']), 'r') as apk_zip:
+            empty_densities = update.extract_apk_icons(icon_name, scan_result, apk_zip, repo_path)
+        update.fill_missing_icon_densities(empty_densities, icon_name, scan_result, repo_path)
+
+    @staticmethod
+    def _apply_pointer_to_repo_file(pointer, repo_file):
+        """
+        Updates the package information of the given non-APK :param repo_file
+        with the information from the database.
+        """
+        repo_file['name'] = pointer.app.name
+        repo_file['versionCode'] = pointer.apk.version_code
+        repo_file['versionName'] = pointer.apk.version_name
+        repo_file['packageName'] = pointer.apk.package_id
+        return repo_file
+
+    def _get_update_state_path(self):
+        return os.path.join(self.get_private_path(), 'update-state.pickle')
+
+    def _read_update_state(self):
+        """
+        Returns the apps and packages saved by the last update or None if there are none
+        or they can not be read, e.g. because they were saved by an older version.
+        """
+        path = self._get_update_state_path()
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("Could not read update state of repo %d: %s", self.pk, e)
+            return None
+
+    def _write_update_state(self, state):
+        path = self._get_update_state_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(state)
 
     def publish(self):
         """
@@ -365,10 +695,14 @@ class Repository(AbstractRepository):
         if len(remote_storage) == 0:
             return  # bail out if there is no remote storage to publish to
 
-        # Publish to remote storage
-        self.chdir()  # expected by update_awsbucket()
+        # Publish to remote storage, each storage applies its own config
         for storage in remote_storage:
-            storage.publish()
+            with FDROIDSERVER_LOCK, timed_phase('publish ' + str(storage), 1):
+                if storage.publishes_from_working_directory:
+                    with self.working_directory():
+                        storage.publish()
+                else:
+                    storage.publish()
 
         # Update the publication date
         self.last_publication_date = timezone.now()
@@ -377,6 +711,65 @@ class Repository(AbstractRepository):
         verbose_name_plural = "Repositories"
 
 
+def apply_config(config):
+    """
+    Applies the given config to fdroidserver.
+    Callers need to hold the FDROIDSERVER_LOCK until they are done with fdroidserver.
+    """
+    common.config = config
+    common.options = Options
+    deploy.config = config
+    deploy.options = Options
+    update.config = config
+    update.options = Options
+
+
+@contextmanager
+def _apkcache_file(path):
+    """
+    Makes fdroidserver read and write its APK cache at the given path
+    instead of relative to the working directory.
+    Must only be used while holding the FDROIDSERVER_LOCK.
+    """
+    get_cache_file = update.get_cache_file
+    update.get_cache_file = lambda: path
+    try:
+        yield
+    finally:
+        update.get_cache_file = get_cache_file
+
+
+class _KnownApks(common.KnownApks):
+    """
+    fdroidserver's record of when APK files were added that is only kept in memory.
+    Repomaker never saves it, so it is not read relative to the working directory either.
+    """
+
+    def __init__(self):  # pylint: disable=super-init-not-called
+        self.path = None
+        self.apks = {}
+        self.changed = False
+
+
+@contextmanager
+def _timed_index_signing():
+    """
+    Times the signing of index files by fdroidserver as a phase of its own.
+    Must only be used while holding the FDROIDSERVER_LOCK.
+    """
+    sign_jar = signindex.sign_jar
+
+    def timed_sign_jar(jar, *args, **kwargs):
+        with timed_phase('sign_index', 1):
+            return sign_jar(jar, *args, **kwargs)
+
+    signindex.sign_jar = timed_sign_jar
+    try:
+        yield
+    finally:
+        signindex.sign_jar = sign_jar
+
+
 @receiver(post_delete, sender=Repository)
 def repository_post_delete_handler(**kwargs):
     repo = kwargs['instance']
@@ -387,6 +780,9 @@ def repository_post_delete_handler(**kwargs):
     repo_private_path = repo.get_private_path()
     if os.path.exists(repo_private_path):
         rmtree(repo_private_path)
+    # changes might have been recorded while deleting the repository's apps
+    from repomaker.models import RepositoryChange
+    RepositoryChange.objects.filter(repo_id=repo.pk).delete()
 
 
 class Options:
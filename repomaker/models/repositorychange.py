@@ -0,0 +1,105 @@
+import logging
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .apkpointer import ApkPointer
+from .app import App
+from .repository import Repository
+from .screenshot import Screenshot
+
+
+class RepositoryChange(models.Model):
+    """
+    An entry in the change journal of a local repository.
+
+    Whenever an app, its APKs, screenshots or translations change, the app's package ID
+    is recorded here, so the next incremental repository update knows what to re-build.
+    """
+    repo = models.ForeignKey(Repository, on_delete=models.CASCADE)
+    package_id = models.CharField(max_length=255, blank=True)
+    created_date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return str(self.repo) + " - " + self.package_id
+
+    @staticmethod
+    def record(repo_id, package_id):
+        """
+        Records that the app with the given package ID changed in the given repository.
+        """
+        if not repo_id or not package_id:
+            return
+        RepositoryChange.objects.create(repo_id=repo_id, package_id=package_id)
+
+    @staticmethod
+    def get_changes(repo):
+        """
+        Returns a tuple with the set of changed package IDs of the given repository
+        and the latest journal entry or None if there were no changes.
+        """
+        latest = RepositoryChange.objects.filter(repo=repo).order_by('-pk').first()
+        if latest is None:
+            return set(), None
+        changes = RepositoryChange.objects.filter(repo=repo, pk__lte=latest.pk)
+        return set(changes.values_list('package_id', flat=True)), latest
+
+    @staticmethod
+    def clear(repo, latest):
+        """
+        Removes all journal entries of the given repository up to the given latest entry.
+        Changes that were recorded after that entry are kept for the next update.
+        """
+        if latest is None:
+            return
+        RepositoryChange.objects.filter(repo=repo, pk__lte=latest.pk).delete()
+
+
+@receiver(post_save, sender=App)
+@receiver(post_delete, sender=App)
+def app_changed_handler(**kwargs):
+    app = kwargs['instance']
+    RepositoryChange.record(app.repo_id, app.package_id)
+
+
+@receiver(m2m_changed, sender=App.category.through)
+def app_category_changed_handler(**kwargs):
+    if not kwargs['action'].startswith('post_'):
+        return
+    instance = kwargs['instance']
+    if isinstance(instance, App):
+        RepositoryChange.record(instance.repo_id, instance.package_id)
+    elif kwargs['pk_set']:
+        for app in App.objects.filter(pk__in=kwargs['pk_set']):
+            RepositoryChange.record(app.repo_id, app.package_id)
+
+
+@receiver(post_save, sender=ApkPointer)
+@receiver(post_delete, sender=ApkPointer)
+def apk_pointer_changed_handler(**kwargs):
+    pointer = kwargs['instance']
+    try:
+        if pointer.apk and pointer.apk.package_id:
+            package_id = pointer.apk.package_id
+        elif pointer.app:
+            package_id = pointer.app.package_id
+        else:
+            return
+    except ObjectDoesNotExist:
+        logging.debug("Not recording change of APK Pointer %s that is gone already", pointer.pk)
+        return
+    RepositoryChange.record(pointer.repo_id, package_id)
+
+
+@receiver(post_save, sender=Screenshot)
+@receiver(post_delete, sender=Screenshot)
+def screenshot_changed_handler(**kwargs):
+    screenshot = kwargs['instance']
+    try:
+        app = screenshot.app
+    except ObjectDoesNotExist:
+        return  # app was deleted and recorded the change already
+    RepositoryChange.record(app.repo_id, app.package_id)
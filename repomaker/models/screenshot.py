@@ -2,13 +2,12 @@ import logging
 import os
 from io import BytesIO
 
-import requests
 from django.db import models
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
-from repomaker import tasks
+from repomaker import downloads, tasks
 from repomaker.storage import get_screenshot_file_path, RepoStorage
 from repomaker.utils import to_universal_language_code
 from .app import App
@@ -74,16 +73,21 @@ class RemoteScreenshot(AbstractScreenshot):
         """
         Creates and saves one or more new RemoteScreenshots if the given s_type is supported.
         """
-        if not is_supported_type(s_type):
-            return
-        for file in files:
-            url = base_url + file
+        for screenshot in RemoteScreenshot.from_json(language_code, s_type, app, base_url, files):
             if not RemoteScreenshot.objects.filter(language_code=language_code, type=s_type,
-                                                   app=app, url=url).exists():
-                screenshot = RemoteScreenshot(language_code=language_code, type=s_type, app=app,
-                                              url=url)
+                                                   app=app, url=screenshot.url).exists():
                 screenshot.save()
 
+    @staticmethod
+    def from_json(language_code, s_type, app, base_url, files):
+        """
+        Returns new unsaved RemoteScreenshots if the given s_type is supported.
+        """
+        if not is_supported_type(s_type):
+            return []
+        return [RemoteScreenshot(language_code=language_code, type=s_type, app=app,
+                                 url=base_url + file) for file in files]
+
     def download_async(self, app):
         """
         Downloads this RemoteScreenshot asynchronously and creates a local Screenshot if successful.
@@ -95,10 +99,33 @@ class RemoteScreenshot(AbstractScreenshot):
         Does a blocking download of this RemoteScreenshot
         and creates a local Screenshot if successful.
         """
-        screenshot = Screenshot(language_code=self.language_code, type=self.type, app_id=app_id)
-        r = requests.get(self.url, timeout=60)
-        if r.status_code == requests.codes.ok:
-            screenshot.file.save(os.path.basename(self.url), BytesIO(r.content), save=True)
+        RemoteScreenshot.download_all([self], app_id)
+
+    @staticmethod
+    def download_all_async(screenshots, app):
+        """
+        Downloads the given RemoteScreenshots asynchronously in a single background task
+        and creates a local Screenshot for each successful download.
+        """
+        tasks.download_remote_screenshots([screenshot.pk for screenshot in screenshots], app.pk)
+
+    @staticmethod
+    def download_all(screenshots, app_id):
+        """
+        Does a blocking download of the given RemoteScreenshots with concurrent, pooled connections
+        and creates a local Screenshot for each successful download.
+        """
+        if not screenshots:
+            return
+        results = downloads.http_get_all([screenshot.url for screenshot in screenshots],
+                                         mirror_urls=screenshots[0].app.repo.get_mirror_urls())
+        for remote_screenshot, result in zip(screenshots, results):
+            if isinstance(result, Exception):
+                continue  # already logged by http_get_all()
+            screenshot = Screenshot(language_code=remote_screenshot.language_code,
+                                    type=remote_screenshot.type, app_id=app_id)
+            screenshot.file.save(os.path.basename(remote_screenshot.url), BytesIO(result[0]),
+                                 save=True)
 
 
 def is_supported_type(s_type):
@@ -30,6 +30,8 @@ UL = '\u00a1-\uffff'  # unicode letters range (must be a unicode string, not a r
 class AbstractStorage(models.Model):
     repo = models.ForeignKey(Repository, on_delete=models.CASCADE)
     disabled = models.BooleanField(default=False)
+    # fdroidserver publishes to some storage types only from the repository's path
+    publishes_from_working_directory = False
 
     @staticmethod
     def get_name():
@@ -72,6 +74,7 @@ class S3Storage(AbstractStorage):
     detail_url_name = 'storage_s3'
     edit_url_name = 'storage_s3_update'
     delete_url_name = 'storage_s3_delete'
+    publishes_from_working_directory = True
 
     def __str__(self):
         return 's3://' + str(self.bucket)
@@ -236,6 +239,7 @@ class GitStorage(AbstractSshStorage):
     detail_url_name = 'storage_git'
     edit_url_name = 'storage_git_update'
     delete_url_name = 'storage_git_delete'
+    publishes_from_working_directory = True
 
     def get_remote_url(self):
         return 'git@%s:%s.git' % (self.host, self.path)
@@ -308,6 +312,7 @@ class StorageManager:
 
 class DefaultStorage:
     is_default = True
+    publishes_from_working_directory = False
 
     def __init__(self, repo, path, url):
         self.repo = repo
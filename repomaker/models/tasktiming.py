@@ -0,0 +1,71 @@
+import json
+
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+
+from .apk import Apk
+from .remoterepository import RemoteRepository
+from .repository import Repository
+
+
+class TaskTiming(models.Model):
+    """
+    The measured durations of one run of a background task and of its phases.
+    """
+    task_name = models.CharField(max_length=255)
+    repo = models.ForeignKey(Repository, on_delete=models.CASCADE, null=True, blank=True)
+    remote_repo = models.ForeignKey(RemoteRepository, on_delete=models.CASCADE, null=True,
+                                    blank=True)
+    apk = models.ForeignKey(Apk, on_delete=models.SET_NULL, null=True, blank=True)
+    start_date = models.DateTimeField(default=timezone.now)
+    duration = models.FloatField(default=0)
+    succeeded = models.BooleanField(default=True)
+    phases = models.TextField(blank=True)
+
+    def __str__(self):
+        return "%s - %s (%.3fs)" % (self.task_name, self.start_date, self.duration)
+
+    def get_phases(self):
+        """
+        Returns a list of dicts with name, duration in seconds and item count of each phase.
+        """
+        if not self.phases:
+            return []
+        return json.loads(self.phases)
+
+    def to_dict(self):
+        return {
+            'task': self.task_name,
+            'start': self.start_date.isoformat(),
+            'duration': self.duration,
+            'succeeded': self.succeeded,
+            'phases': self.get_phases(),
+        }
+
+    @staticmethod
+    def record(task_name, timer, succeeded=True, **kwargs):
+        """
+        Stores the durations measured by the given PhaseTimer
+        and removes the oldest timings of the same task and object
+        beyond settings.TASK_TIMING_HISTORY.
+
+        :param task_name: The name of the task that was measured
+        :param timer: The PhaseTimer used to measure the task
+        :param succeeded: False if the task failed
+        :param kwargs: The object the task was run for, e.g. repo=repo
+        :return: The new TaskTiming
+        """
+        phases = [{'name': name, 'duration': phase['duration'], 'count': phase['count']}
+                  for name, phase in timer.phases.items()]
+        timing = TaskTiming.objects.create(task_name=task_name, start_date=timer.start_date,
+                                           duration=timer.duration, succeeded=succeeded,
+                                           phases=json.dumps(phases), **kwargs)
+        old_timings = TaskTiming.objects.filter(task_name=task_name, **kwargs) \
+            .order_by('-start_date', '-pk').values_list('pk', flat=True)[
+                settings.TASK_TIMING_HISTORY:]
+        TaskTiming.objects.filter(pk__in=list(old_timings)).delete()
+        return timing
+
+    class Meta:
+        ordering = ['-start_date']
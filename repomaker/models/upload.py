@@ -0,0 +1,368 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
+from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from django.utils.translation import ugettext_lazy as _
+
+from repomaker import tasks
+from repomaker.storage import get_apk_file_path
+from repomaker.tasks import PRIORITY_UPLOAD
+from .apk import Apk
+from .app import App
+from .repository import Repository
+
+PENDING = 'pending'
+ADDED = 'added'
+FAILED = 'failed'
+
+# how long the state of finished uploads and unfinished chunked uploads is kept
+UPLOAD_STATE_RETENTION = timedelta(days=1)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# the sha256 hashes of the partial files of chunked uploads computed by this process so far,
+# keyed by the primary key of the ChunkedUpload with the offset the hash was computed up to
+_part_hashes = dict()
+_part_hashes_lock = threading.Lock()
+
+
+class UploadConflictError(Exception):
+    """
+    Raised when another request is already appending to the same chunked upload
+    or has appended the chunk in the meantime.
+    """
+
+
+class Upload(models.Model):
+    """
+    Files uploaded to a local repository that get added to it in a background task,
+    so the upload request does not need to wait until all files are scanned.
+    """
+    repo = models.ForeignKey(Repository, on_delete=models.CASCADE)
+    app = models.ForeignKey(App, on_delete=models.CASCADE, null=True, blank=True)
+    created_date = models.DateTimeField(default=timezone.now)
+    files = models.TextField(blank=True)  # JSON encoded list with the state of each file
+
+    def __str__(self):
+        return "%s - %s" % (self.repo, self.created_date)
+
+    def get_files(self):
+        """
+        Returns a list of dicts with the name, state, the primary key of the Apk
+        and the error message of each uploaded file.
+        """
+        if not self.files:
+            return []
+        return json.loads(self.files)
+
+    def is_finished(self):
+        return all(f['state'] != PENDING for f in self.get_files())
+
+    def to_dict(self):
+        files = self.get_files()
+        processed = len([f for f in files if f['state'] != PENDING])
+        return {
+            'id': self.pk,
+            'repo': self.repo_id,
+            'app': self.app_id,
+            'finished': processed == len(files),
+            'total': len(files),
+            'processed': processed,
+            'files': [{'name': f['name'], 'state': f['state'], 'error': f['error']}
+                      for f in files],
+        }
+
+    @staticmethod
+    def create(repo, uploaded_files, app=None):
+        """
+        Stores the given uploaded files and creates an Upload for them.
+        Call process() or process_async() to add them to the repository afterwards.
+
+        This also removes finished uploads older than UPLOAD_STATE_RETENTION.
+
+        :param repo: The Repository to add the files to
+        :param uploaded_files: A list of Django's UploadedFile
+        :param app: If an App is passed here, all files need to be updates for this app
+        :return: The new Upload
+        """
+        apks = [(uploaded_file.name, Apk.objects.create(file=uploaded_file))
+                for uploaded_file in uploaded_files]
+        return Upload.create_for_apks(repo, apks, app)
+
+    @staticmethod
+    def create_for_existing_file(repo, name, file_hash, app=None):
+        """
+        Creates an Upload for an Apk that has a file with the given sha256 hash already,
+        so the file does not need to be uploaded again.
+
+        :param name: The name of the file that would have been uploaded
+        :return: The new Upload or None if there is no such Apk
+        """
+        apk = Apk.get_by_hash(file_hash)
+        if apk is None:
+            return None
+        return Upload.create_for_apks(repo, [(name, apk)], app, existing=True)
+
+    @staticmethod
+    def create_for_apks(repo, apks, app=None, existing=False):
+        """
+        Creates an Upload for Apks that have their file stored already.
+
+        This also removes finished uploads older than UPLOAD_STATE_RETENTION.
+
+        :param apks: A list of tuples with the name of the uploaded file and its Apk
+        :param existing: True if the Apks existed before, so they are not deleted
+                         when they can not be added to the repository
+        :return: The new Upload
+        """
+        old_uploads = Upload.objects.filter(repo=repo,
+                                            created_date__lt=timezone.now() -
+                                            UPLOAD_STATE_RETENTION)
+        for upload in old_uploads:
+            if upload.is_finished():
+                upload.delete()
+
+        files = [{'name': name, 'apk': apk.pk, 'state': PENDING, 'error': None,
+                  'existing': existing} for name, apk in apks]
+        return Upload.objects.create(repo=repo, app=app, files=json.dumps(files))
+
+    def process_async(self):
+        """
+        Adds the uploaded files to the repository in a background task.
+        """
+        tasks.process_upload(self.pk, priority=PRIORITY_UPLOAD)
+
+    def process(self):
+        """
+        Scans the pending files of this upload in parallel and adds them to the repository
+        one by one. The state of each file is saved as soon as it is known.
+        Files that can not be added get deleted.
+
+        :return: A list of the Apks that were added
+        """
+        files = self.get_files()
+        pending = [f for f in files if f['state'] == PENDING]
+        apks = Apk.objects.in_bulk([f['apk'] for f in pending])
+        # files that were scanned before, e.g. for another repository, are not scanned again
+        scan_results = {pk: apk.get_scan_result() for pk, apk in apks.items()}
+        scan_results.update(Apk.scan_files([apk for apk in apks.values()
+                                            if scan_results[apk.pk] is None]))
+
+        added = []
+        for f in pending:
+            apk = apks.get(f['apk'])
+            try:
+                if apk is None:
+                    raise ValidationError(_('The uploaded file does not exist anymore.'))
+                # this also creates a pointer and attaches the app
+                apk = apk.initialize(self.repo, self.app, scan_results.get(apk.pk))
+                f['apk'] = apk.pk  # an existing Apk might have been reused
+                f['state'] = ADDED
+                added.append(apk)
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning(e)
+                if apk is not None and apk.pk and not f.get('existing'):
+                    apk.delete()
+                f['state'] = FAILED
+                f['error'] = ' '.join(e) if isinstance(e, ValidationError) else str(e)
+            self.files = json.dumps(files)
+            self.save(update_fields=['files'])
+
+        if added:
+            self.repo.update_async()  # schedule repository update
+        return added
+
+
+@receiver(post_delete, sender=Upload)
+def upload_post_delete_handler(**kwargs):
+    upload = kwargs['instance']
+    # delete the files that were not added to the repository yet
+    for f in upload.get_files():
+        if f['state'] == PENDING and not f.get('existing'):
+            for apk in Apk.objects.filter(pk=f['apk']):
+                apk.delete_if_no_pointers()
+
+
+class ChunkedUpload(models.Model):
+    """
+    A single file that is uploaded in chunks, so an interrupted upload can be resumed.
+
+    The chunks are appended to a partial file next to the final location of the file
+    and its sha256 hash is computed while they arrive.
+    Only one request at a time can append to the file, see claim().
+    """
+    repo = models.ForeignKey(Repository, on_delete=models.CASCADE)
+    app = models.ForeignKey(App, on_delete=models.CASCADE, null=True, blank=True)
+    file_name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    hash = models.CharField(max_length=64, blank=True)  # sha256 hash announced by the client
+    offset = models.BigIntegerField(default=0)  # the number of bytes received so far
+    is_appending = models.BooleanField(default=False)
+    created_date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return "%s - %s (%d/%d)" % (self.repo, self.file_name, self.offset, self.size)
+
+    def to_dict(self):
+        return {
+            'id': self.pk,
+            'name': self.file_name,
+            'size': self.size,
+            'offset': self.offset,
+        }
+
+    @staticmethod
+    def start(repo, name, size, file_hash='', app=None):
+        """
+        Starts a chunked upload of a file and removes unfinished ones
+        older than UPLOAD_STATE_RETENTION.
+
+        :param name: The name of the file
+        :param size: The size of the file in bytes
+        :param file_hash: The sha256 hash of the file, if known, to verify the uploaded file
+        :param app: If an App is passed here, the file needs to be an update for this app
+        :return: The new ChunkedUpload
+        """
+        for old_upload in ChunkedUpload.objects.filter(created_date__lt=timezone.now() -
+                                                       UPLOAD_STATE_RETENTION):
+            old_upload.delete()
+        if size < 0:
+            raise ValidationError(_('Invalid file size'))
+        name = get_valid_filename(os.path.basename(name))
+        return ChunkedUpload.objects.create(repo=repo, app=app, file_name=name, size=size,
+                                            hash=file_hash.lower())
+
+    def get_part_path(self):
+        file_name = '%s.%d.part' % (self.file_name, self.pk)
+        return Apk.file.field.storage.path(get_apk_file_path(Apk(), file_name))
+
+    def claim(self):
+        """
+        Claims this upload for the current request, if no other request appends to it
+        and it has not changed since it was loaded.
+        The claim is released with release() or when the upload gets deleted.
+
+        :raises: UploadConflictError if the upload could not be claimed
+        """
+        claimed = ChunkedUpload.objects \
+            .filter(pk=self.pk, offset=self.offset, is_appending=False) \
+            .update(is_appending=True)
+        if claimed == 0:
+            raise UploadConflictError(self.file_name)
+        self.is_appending = True
+
+    def release(self):
+        """
+        Releases the claim of the current request and saves the offset.
+        """
+        ChunkedUpload.objects.filter(pk=self.pk).update(offset=self.offset, is_appending=False)
+        self.is_appending = False
+
+    def append(self, stream):
+        """
+        Appends the data read from the given stream to the partial file
+        and saves the new offset.
+
+        :param stream: A file-like object with the chunk starting at self.offset
+        :raises: ValidationError if the file gets bigger than announced
+        :raises: UploadConflictError if another request appends to this upload
+                 or it changed since it was loaded
+        """
+        self.claim()
+        try:
+            path = self.get_part_path()
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            file_hash = self._get_hash()
+            offset = self.offset
+            with open(path, 'ab') as f:
+                f.truncate(offset)  # remove data of a chunk that was interrupted
+                for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+                    offset += len(chunk)
+                    if offset > self.size:
+                        raise ValidationError(_('Uploaded file %s is bigger than announced')
+                                              % self.file_name)
+                    f.write(chunk)
+                    file_hash.update(chunk)
+            self.offset = offset
+            with _part_hashes_lock:
+                _part_hashes[self.pk] = (offset, file_hash)
+        finally:
+            self.release()
+
+    def finish(self):
+        """
+        Moves the completely uploaded file to its final location
+        and creates an Upload that adds it to the repository.
+        This ChunkedUpload gets deleted afterwards.
+
+        :raises: ValidationError if the file does not have the announced hash
+        :raises: UploadConflictError if another request appends to or finishes this upload
+        :return: The new Upload
+        """
+        if self.offset != self.size:
+            raise RuntimeError('Trying to finish an incomplete upload')
+        self.claim()
+        try:
+            return self._finish()
+        except Exception:
+            self.release()  # does nothing if the upload was deleted already
+            raise
+
+    def _finish(self):
+        if not os.path.isfile(self.get_part_path()):
+            open(self.get_part_path(), 'wb').close()  # nothing was uploaded for an empty file
+        if self.hash and self.hash != self._get_hash().hexdigest():
+            self.delete()
+            raise ValidationError(_('Uploaded file %s does not have the expected hash')
+                                  % self.file_name)
+
+        apk = Apk.objects.create()
+        name = apk.file.storage.get_available_name(get_apk_file_path(apk, self.file_name))
+        os.rename(self.get_part_path(), apk.file.storage.path(name))
+        apk.file.name = name
+        apk.save()
+        upload = Upload.create_for_apks(self.repo, [(self.file_name, apk)], self.app)
+        self.delete()
+        return upload
+
+    def _get_hash(self):
+        """
+        Returns the sha256 hash of the partial file up to self.offset.
+        It is only computed from the file, if this process did not receive all chunks so far.
+        """
+        with _part_hashes_lock:
+            offset, file_hash = _part_hashes.pop(self.pk, (None, None))
+        if offset == self.offset:
+            return file_hash
+
+        file_hash = hashlib.sha256()
+        remaining = self.offset
+        if remaining:
+            with open(self.get_part_path(), 'rb') as f:
+                for chunk in iter(lambda: f.read(min(UPLOAD_CHUNK_SIZE, remaining)), b''):
+                    file_hash.update(chunk)
+                    remaining -= len(chunk)
+                    if not remaining:
+                        break
+        if remaining:
+            raise ValidationError(_('Uploaded file %s is incomplete') % self.file_name)
+        return file_hash
+
+
+@receiver(post_delete, sender=ChunkedUpload)
+def chunked_upload_post_delete_handler(**kwargs):
+    chunked_upload = kwargs['instance']
+    with _part_hashes_lock:
+        _part_hashes.pop(chunked_upload.pk, None)
+    if os.path.isfile(chunked_upload.get_part_path()):
+        os.remove(chunked_upload.get_part_path())
@@ -0,0 +1,587 @@
+import codecs
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import urllib.parse
+import zipfile
+from binascii import hexlify
+from collections.abc import Mapping
+from contextlib import contextmanager
+
+import requests
+from fdroidserver import common, index
+from fdroidserver.exception import VerificationException
+
+from repomaker import mirrors
+from repomaker.indexv2 import app_v2_to_v1, apply_merge_patch, packages_v2_to_v1, \
+    repo_v2_to_v1
+
+# the number of bytes that are read from or written to files at once
+INDEX_CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def download_repo_index(url_str, etag=None, last_index_path=None, mirror_urls=None):
+    """
+    Downloads and verifies the index of a remote repository
+    like fdroidserver.index.download_repo_index() does,
+    but without ever keeping the entire index in memory.
+
+    Index v2 is preferred and index v1 used for repositories that do not have it.
+    If the given last index v2 is still known to the repository,
+    only the diff to the current index gets downloaded and applied to it.
+
+    The index is streamed into a temporary file and only read from there when it is used.
+    All files are downloaded from the healthiest mirror and verified no matter where they are from.
+    fdroidserver needs to be configured, but only verifies the signature
+    while holding the FDROIDSERVER_LOCK, so several indexes can be downloaded at once.
+
+    :param url_str: The URL of the repository including its fingerprint
+    :param etag: The ETag of the last index that was downloaded or None
+    :param last_index_path: The path of the index v2 stored by store_repo_index() or None
+    :param mirror_urls: The base URLs of the repository's mirrors or None
+    :raises: VerificationException() if the index can not be verified
+    :return: A tuple of the RepoIndex or None if the index did not change and the new ETag
+    """
+    url = urllib.parse.urlsplit(url_str)
+    query = urllib.parse.parse_qs(url.query)
+    if 'fingerprint' not in query:
+        raise VerificationException("No fingerprint in URL.")
+    fingerprint = re.sub(r'[^0-9A-F]', r'', query['fingerprint'][0].upper())
+
+    path = url.path
+    for file_name in ['/index-v1.jar', '/entry.jar']:
+        if path.endswith(file_name):
+            path = path[:-len(file_name)]
+    base_url = urllib.parse.SplitResult(url.scheme, url.netloc, path.rstrip('/'), '',
+                                        '').geturl()
+    mirror_urls = [base_url] + [mirror_url for mirror_url in mirror_urls or []
+                                if mirror_url != base_url]
+
+    try:
+        if _is_unchanged(base_url + '/entry.jar', mirror_urls, etag):
+            return None, etag
+        with _download_jar(base_url + '/entry.jar', mirror_urls, fingerprint) as \
+                (jar, public_key, etag):
+            entry = json.loads(jar.read('entry.json').decode('utf-8'))
+    except requests.exceptions.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+        logging.info("%s has no index v2, using index v1.", base_url)
+        return _download_repo_index_v1(base_url, mirror_urls, fingerprint, etag)
+
+    # the temporary file gets removed as soon as it is closed,
+    # which is up to the caller once the index was returned
+    json_file = tempfile.TemporaryFile()
+    try:
+        last_timestamp = _get_timestamp(last_index_path)
+        if last_timestamp == entry['timestamp']:
+            patch = {}  # the index did not change, but its ETag
+        elif str(last_timestamp) in entry.get('diffs', {}):
+            with tempfile.TemporaryFile() as diff_file:
+                _download_file(base_url, mirror_urls, entry['diffs'][str(last_timestamp)],
+                               diff_file)
+                diff_file.seek(0)
+                patch = json.loads(diff_file.read().decode('utf-8'))
+        else:
+            patch = None
+            _download_file(base_url, mirror_urls, entry['index'], json_file)
+
+        if patch is None:
+            repo_index = RepoIndexV2(json_file)
+        else:
+            with open(last_index_path, 'rb') as f:
+                _apply_merge_patch_to_index(f, patch, json_file)
+            repo_index = RepoIndexV2(json_file, patch.get('packages', {}))
+    except BaseException:
+        json_file.close()
+        raise
+    repo_index['repo']['pubkey'] = hexlify(public_key).decode()
+    repo_index['repo']['fingerprint'] = fingerprint
+    return repo_index, etag
+
+
+def store_repo_index(repo_index, path):
+    """
+    Stores a copy of the given index v2 at the given path,
+    so only its changes need to be downloaded next time.
+    An earlier copy gets removed if the given index is no index v2.
+    """
+    if isinstance(repo_index, RepoIndexV2):
+        repo_index.save(path)
+    elif os.path.isfile(path):
+        os.remove(path)
+
+
+def _download_repo_index_v1(base_url, mirror_urls, fingerprint, etag):
+    url = base_url + '/index-v1.jar'
+    if _is_unchanged(url, mirror_urls, etag):
+        return None, etag
+    json_file = tempfile.TemporaryFile()
+    try:
+        # the jar file is removed when leaving this block, also if there was an error
+        with _download_jar(url, mirror_urls, fingerprint) as (jar, public_key, etag):
+            with jar.open('index-v1.json') as f:
+                shutil.copyfileobj(f, json_file, INDEX_CHUNK_SIZE)
+        repo_index = RepoIndex(json_file)
+    except BaseException:
+        json_file.close()
+        raise
+    repo_index['repo']['pubkey'] = hexlify(public_key).decode()
+    repo_index['repo']['fingerprint'] = fingerprint
+    return repo_index, etag
+
+
+def _is_unchanged(url, mirror_urls, etag):
+    """
+    Returns True if the file at the given URL still has the given ETag.
+    """
+    if not etag:
+        return False
+    r = mirrors.head(url, mirror_urls)
+    return 'ETag' in r.headers and etag == r.headers['ETag']
+
+
+@contextmanager
+def _download_jar(url, mirror_urls, fingerprint):
+    """
+    Downloads the signed jar at the given URL into a temporary file
+    and verifies that it was signed with the key of the given fingerprint.
+
+    :return: A tuple of the opened jar, the public key and the ETag
+    """
+    with tempfile.NamedTemporaryFile(suffix='.jar') as jar_file:
+        r = mirrors.download(url, mirror_urls, jar_file, INDEX_CHUNK_SIZE)
+        jar_file.flush()
+
+        from repomaker.models.repository import FDROIDSERVER_LOCK
+        with FDROIDSERVER_LOCK:
+            logging.debug("Verifying signature of %s", url)
+            common.verify_jar_signature(jar_file.name)
+        with zipfile.ZipFile(jar_file.name) as jar:
+            public_key, public_key_fingerprint = index.get_public_key_from_jar(jar)
+            if fingerprint != public_key_fingerprint:
+                raise VerificationException("The repository's fingerprint does not match.")
+            yield jar, public_key, r.headers.get('ETag')
+
+
+def _download_file(base_url, mirror_urls, file_entry, f):
+    """
+    Downloads a file listed in entry.json into the given file object
+    and verifies its sha256 hash.
+    """
+    start = f.tell()
+    mirrors.download(base_url + file_entry['name'], mirror_urls, f, INDEX_CHUNK_SIZE)
+    f.seek(start)
+    file_hash = hashlib.sha256()
+    for chunk in iter(lambda: f.read(INDEX_CHUNK_SIZE), b''):
+        file_hash.update(chunk)
+    if file_hash.hexdigest() != file_entry['sha256']:
+        raise VerificationException("%s does not have the hash listed in entry.json." %
+                                    file_entry['name'])
+
+
+def _get_timestamp(path):
+    """
+    Returns the timestamp of the index v2 at the given path or None if there is none.
+    """
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        reader = _JsonReader(f)
+        try:
+            for key in reader.iter_object():
+                if key == 'repo':
+                    return reader.read_value().get('timestamp')
+                reader.skip_value()
+        except ValueError as e:
+            logging.warning("Could not read stored index %s: %s", path, e)
+    return None
+
+
+def _apply_merge_patch_to_index(f, patch, new_file):
+    """
+    Applies a diff from entry.json to the index v2 read from f
+    and writes the result to new_file, one package at a time.
+    """
+    patch = dict(patch)
+    package_patches = dict(patch.pop('packages', None) or {})
+    writer = _JsonObjectWriter(new_file)
+    reader = _JsonReader(f)
+    for key in reader.iter_object():
+        if key != 'packages':
+            value = reader.read_value()
+            if key in patch:
+                value = apply_merge_patch(value, patch.pop(key))
+            if value is not None:
+                writer.write(key, value)
+            continue
+        writer.write_key(key)
+        packages_writer = _JsonObjectWriter(new_file)
+        for package_name in reader.iter_object():
+            package = reader.read_value()
+            if package_name in package_patches:
+                package = apply_merge_patch(package, package_patches.pop(package_name))
+            if package is not None:
+                packages_writer.write(package_name, package)
+        # add the new packages
+        for package_name, package_patch in package_patches.items():
+            if package_patch is not None:
+                packages_writer.write(package_name, apply_merge_patch({}, package_patch))
+        package_patches = {}
+        packages_writer.close()
+    for key, value in patch.items():
+        if value is not None:
+            writer.write(key, apply_merge_patch({}, value))
+    if package_patches:
+        writer.write('packages', {package_name: apply_merge_patch({}, package_patch)
+                                  for package_name, package_patch in package_patches.items()
+                                  if package_patch is not None})
+    writer.close()
+
+
+class _JsonObjectWriter:
+    """
+    Writes a JSON object to a binary file object member by member.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self._empty = True
+        f.write(b'{')
+
+    def write_key(self, key):
+        """
+        Writes the key of the next member, the caller needs to write its value.
+        """
+        self._file.write(('%s%s:' % ('' if self._empty else ',', json.dumps(key)))
+                         .encode('utf-8'))
+        self._empty = False
+
+    def write(self, key, value):
+        self.write_key(key)
+        self._file.write(json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+    def close(self):
+        self._file.write(b'}')
+
+
+class _Index(Mapping):
+    """
+    An index that is read from a file when its apps and packages are used,
+    so it can be passed to code expecting the index v1 as a dict.
+
+    'repo' is a dict, 'apps' an iterable of app dicts and 'packages' a mapping
+    of package names to lists of package dicts.
+    Only the positions of the apps and packages in the file are kept in memory.
+    """
+
+    def __init__(self, f, data):
+        self._file = f
+        self._data = data
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def close(self):
+        self._file.close()
+
+
+class RepoIndex(_Index):
+    """
+    A repository index v1 read from a file.
+    """
+
+    def __init__(self, f):
+        """
+        :param f: A binary file object with the JSON index that is closed together with this
+        """
+        super().__init__(f, {'repo': {}, 'apps': _Apps(f), 'packages': _Packages(f)})
+        reader = _JsonReader(f)
+        for key in reader.iter_object():
+            if key == 'apps':
+                self._data['apps'].scan(reader)
+            elif key == 'packages':
+                self._data['packages'].scan(reader)
+            elif key == 'repo':
+                self._data['repo'] = reader.read_value()
+            else:
+                reader.skip_value()
+
+
+class RepoIndexV2(_Index):
+    """
+    A repository index v2 that is converted to index v1 when its apps and packages are used,
+    so it can be synced like index v1.
+
+    If only some packages changed since the last index,
+    'apps' yields only the changed apps and 'removed' has the names of the removed ones.
+    """
+
+    def __init__(self, f, changed_packages=None):
+        """
+        :param f: A binary file object with the JSON index that is closed together with this
+        :param changed_packages: A dict of the packages that changed with None for removed
+                                 packages, if only those should be synced
+        """
+        packages = _PackagesV2(f)
+        super().__init__(f, {'repo': {}, 'packages': packages})
+        if changed_packages is None:
+            self._data['apps'] = _AppsV2(packages)
+        else:
+            self._data['apps'] = _AppsV2(packages, [package_name for package_name, package
+                                                    in changed_packages.items() if package])
+            self._data['removed'] = [package_name for package_name, package
+                                     in changed_packages.items() if package is None]
+        reader = _JsonReader(f)
+        for key in reader.iter_object():
+            if key == 'packages':
+                packages.scan(reader)
+            elif key == 'repo':
+                self._data['repo'] = repo_v2_to_v1(reader.read_value())
+            else:
+                reader.skip_value()
+
+    def save(self, path):
+        """
+        Saves a copy of this index at the given path.
+        """
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self._file.seek(0)
+        with open(path + '.tmp', 'wb') as f:
+            shutil.copyfileobj(self._file, f, INDEX_CHUNK_SIZE)
+        os.replace(path + '.tmp', path)
+
+
+class _Apps:
+    """
+    Yields the apps of an index one by one, parsing each of them only when it is needed.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self._position = None
+        self._count = 0
+
+    def scan(self, reader):
+        self._position = reader.position
+        for _ in reader.iter_array():
+            reader.skip_value()
+            self._count += 1
+
+    def __iter__(self):
+        if self._position is None:
+            return
+        reader = _JsonReader(self._file, self._position)
+        for _ in reader.iter_array():
+            yield reader.read_value()
+
+    def __len__(self):
+        return self._count
+
+
+class _Packages(Mapping):
+    """
+    Reads the list of packages of a single app from the index when it is requested.
+    """
+
+    def __init__(self, f):
+        self._file = f
+        self._spans = dict()  # the start and end position of the packages by package name
+
+    def scan(self, reader):
+        for package_name in reader.iter_object():
+            self._spans[package_name] = reader.skip_value()
+
+    def __getitem__(self, package_name):
+        start, end = self._spans[package_name]
+        self._file.seek(start)
+        return json.loads(self._file.read(end - start).decode('utf-8'))
+
+    def __contains__(self, package_name):
+        return package_name in self._spans
+
+    def __iter__(self):
+        return iter(self._spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+
+class _AppsV2:
+    """
+    Yields the packages of an index v2 one by one as apps of index v1.
+    """
+
+    def __init__(self, packages, package_names=None):
+        self._packages = packages
+        self._package_names = package_names
+
+    def __iter__(self):
+        package_names = self._package_names
+        if package_names is None:
+            package_names = iter(self._packages)
+        for package_name in package_names:
+            if package_name in self._packages:
+                yield app_v2_to_v1(package_name, self._packages.get_package(package_name))
+
+    def __len__(self):
+        if self._package_names is None:
+            return len(self._packages)
+        return len(self._package_names)
+
+
+class _PackagesV2(_Packages):
+    """
+    Reads the versions of a single package from the index v2 when it is requested
+    and returns them as packages of index v1.
+    """
+
+    def get_package(self, package_name):
+        """
+        Returns the package as it is in index v2.
+        """
+        return super().__getitem__(package_name)
+
+    def __getitem__(self, package_name):
+        return packages_v2_to_v1(package_name, self.get_package(package_name))
+
+
+class _JsonReader:
+    """
+    Reads JSON values one after the other from a binary file object,
+    keeping only the value that is currently read in memory.
+
+    The values themselves are decoded by the json module,
+    this only walks through the objects and arrays containing them.
+    It supports JSON as specified in RFC 8259 encoded as UTF-8 without a byte order mark.
+    Like the json module, it accepts NaN and Infinity and keeps the last of duplicate keys.
+    Anything after the value that is walked through is not read.
+    Malformed input raises a ValueError.
+    """
+
+    def __init__(self, f, position=0):
+        self._file = f
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._index = 0  # the index of the next character in the buffer
+        self._read_position = position  # the position in the file up to which was read
+        self._eof = False
+        self.position = position  # the position of the next character in the file
+
+    def _fill(self):
+        """
+        Reads more data into the buffer, at least as much as is left in it,
+        so values bigger than INDEX_CHUNK_SIZE do not need to be decoded too often.
+
+        :return: False if the end of the file was reached before
+        """
+        if self._eof:
+            return False
+        # other readers might use the same file in between
+        self._file.seek(self._read_position)
+        data = self._file.read(max(INDEX_CHUNK_SIZE, len(self._buffer) - self._index))
+        self._read_position += len(data)
+        self._eof = not data
+        self._buffer = self._buffer[self._index:] + self._decoder.decode(data, final=self._eof)
+        self._index = 0
+        return True
+
+    def _consume(self, end):
+        """
+        Moves to the given index of the buffer.
+        """
+        self.position += len(self._buffer[self._index:end].encode('utf-8'))
+        self._index = end
+
+    def _peek(self):
+        """
+        Skips whitespace and returns the next character without consuming it.
+        """
+        while True:
+            self._consume(WHITESPACE.match(self._buffer, self._index).end())
+            if self._index < len(self._buffer) or not self._fill():
+                return self._buffer[self._index:self._index + 1]
+
+    def _expect(self, characters):
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of '%s' at position %d in index, but found '%s'" %
+                             (characters, self.position, character))
+        self._consume(self._index + 1)
+        return character
+
+    def read_value(self):
+        """
+        Reads the next JSON value and returns it.
+        """
+        return self._read_value()[0]
+
+    def skip_value(self):
+        """
+        Reads the next JSON value without returning it.
+
+        :return: A tuple of the start and end position of the value in the file
+        """
+        return self._read_value()[1]
+
+    def _read_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._index)
+                # a number at the end of the buffer might continue in the file
+                if end < len(self._buffer) or not self._fill():
+                    break
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+        start = self.position
+        self._consume(end)
+        return value, (start, self.position)
+
+    def iter_object(self):
+        """
+        Yields the keys of the next JSON object.
+        The caller needs to read or skip each value before continuing.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            self._consume(self._index + 1)
+            return
+        while True:
+            position = self.position
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError("Expected a string as key at position %d in index" % position)
+            self._expect(':')
+            yield key
+            if self._expect(',}') == '}':
+                return
+
+    def iter_array(self):
+        """
+        Yields once for every element of the next JSON array.
+        The caller needs to read or skip each element before continuing.
+        """
+        self._expect('[')
+        if self._peek() == ']':
+            self._consume(self._index + 1)
+            return
+        while True:
+            yield
+            if self._expect(',]') == ']':
+                return
@@ -0,0 +1,161 @@
+"""
+Syncs several remote repositories at once.
+
+Syncing a remote repository mostly waits for its index to download,
+so the syncs run on a pool of threads and a slow remote repository does not hold up the others.
+SQLite does not handle concurrent writes well, so only one sync at a time uses the database.
+It holds the database lock for its entire run
+and only releases it while it downloads with database_unlocked().
+The lock is also held on a file, so syncs in other processes wait for it as well.
+"""
+import fcntl
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+from repomaker import downloads
+
+# the file in settings.PRIVATE_REPO_ROOT that gets locked together with the database lock
+LOCK_FILE_NAME = 'remotesync.lock'
+
+_database_lock = threading.Lock()
+_lock_file = None
+_local = threading.local()
+
+
+def _acquire():
+    global _lock_file  # pylint: disable=global-statement
+    _database_lock.acquire()
+    try:
+        os.makedirs(settings.PRIVATE_REPO_ROOT, exist_ok=True)
+        lock_file = open(os.path.join(settings.PRIVATE_REPO_ROOT, LOCK_FILE_NAME), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except OSError:
+            lock_file.close()
+            raise
+    except OSError:
+        _database_lock.release()
+        raise
+    _lock_file = lock_file
+
+
+def _release():
+    global _lock_file  # pylint: disable=global-statement
+    lock_file = _lock_file
+    _lock_file = None
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+    finally:
+        _database_lock.release()
+
+
+@contextmanager
+def database_lock():
+    """
+    Holds the lock that allows the current thread to use the database within the block.
+    Other threads and processes wait for it until the block is left.
+    """
+    _acquire()
+    _local.holding = True
+    try:
+        yield
+    finally:
+        _local.holding = False
+        _release()
+
+
+@contextmanager
+def database_unlocked():
+    """
+    Releases the database lock within the block, if the current thread holds it,
+    so other syncs can use the database while this one does not.
+    The database must not be used within the block.
+    """
+    if not getattr(_local, 'holding', False):
+        yield
+        return
+    _local.holding = False
+    _release()
+    try:
+        yield
+    finally:
+        _acquire()
+        _local.holding = True
+
+
+class RemoteSyncExecutor:
+    """
+    Runs syncs of remote repositories on a pool of threads.
+
+    At most settings.REMOTE_SYNC_WORKERS syncs run at once
+    and at most settings.REMOTE_SYNC_WORKERS_PER_HOST of them for the same host,
+    so a host with many repositories does not get all the connections.
+    Each sync gets aborted after settings.REMOTE_SYNC_TIMEOUT seconds,
+    its downloads time out and its other work checks the deadline with downloads.check_deadline().
+    """
+
+    def __init__(self):
+        self.max_workers = settings.REMOTE_SYNC_WORKERS
+        self.max_workers_per_host = settings.REMOTE_SYNC_WORKERS_PER_HOST
+        self.timeout = settings.REMOTE_SYNC_TIMEOUT
+        self._running = dict()  # the host of each running sync by its future
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix='remote-sync')
+
+    def is_full(self):
+        return len(self._running) >= self.max_workers
+
+    def can_submit(self, host):
+        """
+        Returns whether a sync of a remote repository on the given host can start right away.
+        """
+        if self.is_full():
+            return False
+        return list(self._running.values()).count(host) < self.max_workers_per_host
+
+    def submit(self, host, func, *args):
+        """
+        Runs func with the given arguments in a thread of the pool.
+        It holds the database lock while it runs.
+
+        :param host: The host of the remote repository that gets synced
+        """
+        future = self._executor.submit(self._run, func, *args)
+        self._running[future] = host
+
+    def _run(self, func, *args):
+        try:
+            with downloads.deadline(self.timeout), database_lock():
+                func(*args)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.error("Could not sync remote repository: %s", e)
+        finally:
+            # every thread has its own database connection
+            connection.close()
+
+    def wait(self):
+        """
+        Waits until at least one of the running syncs finished.
+
+        :return: False if no sync was running, True otherwise
+        """
+        if not self._running:
+            return False
+        done, _ = wait(self._running.keys(), return_when=FIRST_COMPLETED)
+        for future in done:
+            del self._running[future]
+        return True
+
+    def shutdown(self):
+        """
+        Waits for all running syncs and frees the threads of the pool.
+        """
+        self._executor.shutdown(wait=True)
+        self._running.clear()
@@ -0,0 +1,82 @@
+import logging
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import fdroidserver
+from django.conf import settings
+from fdroidserver import common, update
+
+
+class ApkScanError(Exception):
+    """
+    Raised when an APK file can not be scanned or has an invalid signature.
+    """
+
+
+class InvalidSignatureError(ApkScanError):
+    pass
+
+
+def scan_apk(path, allow_disabled_algorithms=False):
+    """
+    Verifies the signature of the given APK file and scans it with fdroidserver.
+
+    :param path: The path to the APK file
+    :param allow_disabled_algorithms: Whether to accept signatures with disabled algorithms
+                                      and mark the APK as known vulnerable instead
+    :raises: ApkScanError if the APK file is invalid
+    :return: A dict of APK information as returned by fdroidserver's scan_apk()
+    """
+    if fdroidserver.verify_apk_signature(path):
+        anti_features = []
+    elif allow_disabled_algorithms and common.verify_old_apk_signature(path):
+        anti_features = ['KnownVuln', 'DisabledAlgorithm']
+    else:
+        raise InvalidSignatureError(path)
+
+    try:
+        scan_result = fdroidserver.scan_apk(path)
+    except (fdroidserver.exception.BuildException, zipfile.BadZipFile) as e:
+        raise ApkScanError(str(e))
+    scan_result['antiFeatures'].update(anti_features)
+    return scan_result
+
+
+def scan_apks(paths, allow_disabled_algorithms=False):
+    """
+    Scans the given APK files like scan_apk() does, but in parallel processes
+    if settings.APK_SCAN_WORKERS allows more than one.
+
+    The fdroidserver config needs to be applied already, see AbstractRepository.get_config().
+
+    :param paths: A list of paths to APK files
+    :param allow_disabled_algorithms: See scan_apk()
+    :raises: AssertionError if no fdroidserver config is applied
+    :return: A list with the scan result or the ApkScanError for each path in the same order
+    """
+    if common.config is None:
+        raise AssertionError("fdroidserver config needs to be applied before scanning APKs")
+    workers = min(settings.APK_SCAN_WORKERS, len(paths))
+    args = [(path, allow_disabled_algorithms) for path in paths]
+    if workers <= 1:
+        return [_scan_apk(arg) for arg in args]
+
+    logging.debug("Scanning %d APK files with %d processes", len(paths), workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(common.config,)) as executor:
+        return list(executor.map(_scan_apk, args))
+
+
+def _init_worker(config):
+    # worker processes might not have inherited the fdroidserver configuration
+    common.config = config
+    update.config = config
+
+
+def _scan_apk(args):
+    path, allow_disabled_algorithms = args
+    try:
+        return scan_apk(path, allow_disabled_algorithms)
+    except ApkScanError as e:
+        logging.warning("Could not scan APK file %s: %s", path, e)
+        return e
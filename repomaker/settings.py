@@ -191,6 +191,60 @@ if not DEBUG:
 
 MAX_ATTEMPTS = 23  # the number of attempts for marking a task as permanently failed
 
+# run tasks on a pool of threads, so one worker can update several repositories at once
+# SQLite does not handle concurrent writes well, so this is only recommended for other databases
+# remote repositories get synced concurrently with REMOTE_SYNC_WORKERS either way
+BACKGROUND_TASK_RUN_ASYNC = False
+BACKGROUND_TASK_ASYNC_THREADS = 4
+
+# seconds to wait after the last change of a repository before updating it,
+# so that all changes made in that time end up in a single update
+REPO_UPDATE_QUIET_PERIOD = 10
+
+# the number of timing measurements to keep per background task and repository
+TASK_TIMING_HISTORY = 50
+
+# APK Scanning
+
+# the number of processes scanning APK files in parallel, 1 scans them in the current process
+APK_SCAN_WORKERS = os.cpu_count() or 1
+
+# Downloads
+
+# the number of files that are downloaded in parallel from all hosts together
+DOWNLOAD_WORKERS = 8
+# the number of connections that are kept alive and used in parallel for each host
+DOWNLOAD_CONNECTIONS_PER_HOST = 4
+# whether downloaded APK files with the sha256 hash from a signed remote index are taken
+# as they are described there, they only get scanned when a repository including them is updated
+DOWNLOAD_TRUST_REMOTE_INDEX = True
+# the seconds a failed mirror of a remote repository is avoided,
+# this doubles with every further failure up to MIRROR_MAX_RETRY_DELAY
+MIRROR_RETRY_DELAY = 60
+MIRROR_MAX_RETRY_DELAY = 60 * 60
+
+# Remote Repositories
+
+# the number of changed apps of a remote repository that get saved to the database together
+# in one transaction, a failed sync resumes after the last saved chunk,
+# keep this below 999, because this many apps get queried at once
+REMOTE_SYNC_CHUNK_SIZE = 500
+# the number of remote repositories that get synced at once, set to 1 to sync them one by one
+REMOTE_SYNC_WORKERS = 4
+# the number of remote repositories on the same host that get synced at once
+REMOTE_SYNC_WORKERS_PER_HOST = 2
+# the seconds after which the downloads of a remote repository sync get aborted
+REMOTE_SYNC_TIMEOUT = 30 * 60
+# the seconds between updates of a remote repository before it was seen changing
+REMOTE_UPDATE_INTERVAL = 24 * 60 * 60
+# the bounds of the seconds between updates of remote repositories that adapt to their changes,
+# they can be overridden for each remote repository
+REMOTE_UPDATE_MIN_INTERVAL = 60 * 60
+REMOTE_UPDATE_MAX_INTERVAL = 7 * 24 * 60 * 60
+# the fraction of the interval by which the next update of a remote repository is randomly moved,
+# so remote repositories do not all get updated at the same time
+REMOTE_UPDATE_JITTER = 0.1
+
 # Internationalization
 # https://docs.djangoproject.com/en/dev/topics/i18n/
 
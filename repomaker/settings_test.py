@@ -12,3 +12,6 @@ STATIC_ROOT = os.path.join(TEST_DIR, 'static')
 SINGLE_USER_MODE = True
 
 COMPRESS_ENABLED = False
+
+APK_SCAN_WORKERS = 1
+REMOTE_SYNC_WORKERS = 1
@@ -6,6 +6,13 @@ var holders = [
     document.getElementById('rm-dnd-holder--feature-graphic'),
 ]
 
+// files bigger than this are uploaded in chunks, so interrupted uploads can be resumed
+var CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024
+var CHUNK_SIZE = 4 * 1024 * 1024
+var CHUNK_RETRIES = 5
+// files up to this size are hashed, so the server can skip uploading files it has already
+var MAX_HASH_SIZE = 256 * 1024 * 1024
+
 function uploadFiles(element, files) {
     var type = element.id.split("--").pop()
     var formData = new FormData()
@@ -16,9 +23,13 @@ function uploadFiles(element, files) {
         }
         formData.append(type, files[i])
     }
+    if (type === 'apks' && hasLargeFile(files)) {
+        uploadFilesChunked(element, files)
+        return
+    }
     var request = new XMLHttpRequest()
     request.open('POST', '', true) // true for asynchronous
-    request.setRequestHeader('X-CSRFToken', document.getElementsByName('csrfmiddlewaretoken')[0].value)
+    request.setRequestHeader('X-CSRFToken', getCsrfToken())
     request.setRequestHeader('X-REQUESTED-WITH', 'XMLHttpRequest') // For Django's request.is_ajax()
     request.setRequestHeader('RM-Background-Type', type) // Needed to distinguish
     request.onloadstart = uploadStarted(element, files)
@@ -111,9 +122,11 @@ function uploadFinished(request, element, type, files) {
         var response = JSON.parse(request.responseText)
         setFeatureGraphic(element, response)
     }
-    else if (type === 'apks' && request.status === 200) {
+    else if (type === 'apks' && request.status === 202) {
         var response = JSON.parse(request.responseText)
-        addApks(element, response)
+        pollUpload(element, response['status_url'], function(response) {
+            uploadProcessed(element, response)
+        })
     }
     else if (request.status === 204) {
         location.reload()
@@ -123,6 +136,231 @@ function uploadFinished(request, element, type, files) {
     }
 }
 
+function getCsrfToken() {
+    return document.getElementsByName('csrfmiddlewaretoken')[0].value
+}
+
+function hasLargeFile(files) {
+    for (var i = 0; i < files.length; i++) {
+        if (files[i].size > CHUNKED_UPLOAD_THRESHOLD) return true
+    }
+    return false
+}
+
+function uploadFilesChunked(element, files) {
+    uploadStarted(element, files)
+    var total = 0
+    for (var i = 0; i < files.length; i++) {
+        total += files[i].size
+    }
+    var progress = {lengthComputable: true, loaded: 0, total: total}
+    var statusUrls = []
+    var uploadNext = function(i) {
+        if (i === files.length) {
+            pollUploads(element, statusUrls)
+            return
+        }
+        uploadFileChunked(element, files[i], progress, function(statusUrl) {
+            statusUrls.push(statusUrl)
+            uploadNext(i + 1)
+        })
+    }
+    uploadNext(0)
+}
+
+function uploadFileChunked(element, file, progress, onUploaded) {
+    var loaded = progress.loaded
+    hashFile(file, function(hash) {
+        var formData = new FormData()
+        formData.append('name', file.name)
+        formData.append('size', file.size)
+        formData.append('hash', hash)
+        var request = new XMLHttpRequest()
+        request.open('POST', '', true)
+        request.setRequestHeader('X-CSRFToken', getCsrfToken())
+        request.setRequestHeader('X-REQUESTED-WITH', 'XMLHttpRequest')
+        request.setRequestHeader('RM-Background-Type', 'apks')
+        request.setRequestHeader('RM-Chunked-Upload', 'true')
+        request.onreadystatechange = function() {
+            if (request.readyState !== 4) return
+            var response = request.status === 201 || request.status === 202 ?
+                JSON.parse(request.responseText) : null
+            if (request.status === 202) {
+                // the server has this file already
+                progress.loaded = loaded + file.size
+                updateProgress(element, progress)
+                onUploaded(response['status_url'])
+            }
+            else if (request.status === 201) {
+                var onChunkUploaded = function(offset) {
+                    progress.loaded = loaded + offset
+                    updateProgress(element, progress)
+                }
+                uploadChunk(element, file, response['upload_url'], 0, 0, onChunkUploaded,
+                    onUploaded)
+            }
+            else {
+                showError(element, request.responseText)
+            }
+        }
+        request.send(formData)
+    })
+}
+
+function uploadChunk(element, file, uploadUrl, offset, retries, onChunkUploaded, onUploaded) {
+    var request = new XMLHttpRequest()
+    request.open('PUT', uploadUrl, true)
+    request.setRequestHeader('X-CSRFToken', getCsrfToken())
+    request.setRequestHeader('X-REQUESTED-WITH', 'XMLHttpRequest')
+    request.setRequestHeader('Content-Type', 'application/octet-stream')
+    request.setRequestHeader('Upload-Offset', offset)
+    request.onreadystatechange = function() {
+        if (request.readyState !== 4) return
+        if (request.status === 202) {
+            onChunkUploaded(file.size)
+            onUploaded(JSON.parse(request.responseText)['status_url'])
+        }
+        else if (request.status === 200 || request.status === 409) {
+            // continue where the server is, also after a chunk was sent twice
+            var newOffset = JSON.parse(request.responseText)['offset']
+            onChunkUploaded(newOffset)
+            uploadChunk(element, file, uploadUrl, newOffset, 0, onChunkUploaded, onUploaded)
+        }
+        else if ((request.status === 0 || request.status >= 500) && retries < CHUNK_RETRIES) {
+            // the connection was interrupted, so resume the upload after a while
+            setTimeout(function() {
+                resumeChunkedUpload(element, file, uploadUrl, retries + 1, onChunkUploaded,
+                    onUploaded)
+            }, 1000 * Math.pow(2, retries))
+        }
+        else {
+            showError(element, request.responseText)
+        }
+    }
+    request.send(file.slice(offset, offset + CHUNK_SIZE))
+}
+
+function resumeChunkedUpload(element, file, uploadUrl, retries, onChunkUploaded, onUploaded) {
+    var request = new XMLHttpRequest()
+    request.open('GET', uploadUrl, true)
+    request.setRequestHeader('X-REQUESTED-WITH', 'XMLHttpRequest')
+    request.onreadystatechange = function() {
+        if (request.readyState !== 4) return
+        if (request.status === 200) {
+            var offset = JSON.parse(request.responseText)['offset']
+            uploadChunk(element, file, uploadUrl, offset, retries, onChunkUploaded, onUploaded)
+        }
+        else if (request.status !== 404 && retries < CHUNK_RETRIES) {
+            setTimeout(function() {
+                resumeChunkedUpload(element, file, uploadUrl, retries + 1, onChunkUploaded,
+                    onUploaded)
+            }, 1000 * Math.pow(2, retries))
+        }
+        else {
+            showError(element, request.responseText)
+        }
+    }
+    request.send()
+}
+
+function hashFile(file, callback) {
+    if (file.size > MAX_HASH_SIZE || !window.crypto || !window.crypto.subtle) {
+        callback('')
+        return
+    }
+    var reader = new FileReader()
+    reader.onload = function() {
+        window.crypto.subtle.digest('SHA-256', reader.result).then(function(digest) {
+            var bytes = new Uint8Array(digest)
+            var hash = ''
+            for (var i = 0; i < bytes.length; i++) {
+                hash += ('0' + bytes[i].toString(16)).slice(-2)
+            }
+            callback(hash)
+        }, function() {
+            callback('')
+        })
+    }
+    reader.onerror = function() {
+        callback('')
+    }
+    reader.readAsArrayBuffer(file)
+}
+
+function pollUploads(element, statusUrls) {
+    var merged = null
+    var pollNext = function(i) {
+        if (i === statusUrls.length) {
+            uploadProcessed(element, merged)
+            return
+        }
+        pollUpload(element, statusUrls[i], function(response) {
+            if (merged === null) {
+                merged = response
+            }
+            else {
+                merged['files'] = merged['files'].concat(response['files'])
+                if (response['apks']) merged['apks'] = merged['apks'].concat(response['apks'])
+            }
+            pollNext(i + 1)
+        })
+    }
+    pollNext(0)
+}
+
+function pollUpload(element, statusUrl, onFinished) {
+    var request = new XMLHttpRequest()
+    request.open('GET', statusUrl, true)
+    request.setRequestHeader('X-REQUESTED-WITH', 'XMLHttpRequest')
+    request.onreadystatechange = function() {
+        if (request.readyState !== 4) return
+        if (request.status !== 200) {
+            showError(element, request.responseText)
+            return
+        }
+        var response = JSON.parse(request.responseText)
+        if (response['finished']) {
+            onFinished(response)
+        }
+        else {
+            updateUploadProgress(element, response)
+            setTimeout(function() {
+                pollUpload(element, statusUrl, onFinished)
+            }, 1000)
+        }
+    }
+    request.send()
+}
+
+function updateUploadProgress(element, response) {
+    var loadingElement = document.getElementById(element.id + '--loading')
+    var loadingElementTitle = document.getElementById(loadingElement.id + '-title')
+    loadingElementTitle.textContent = interpolate(gettext('Adding files... %s of %s done'),
+        [response['processed'], response['total']])
+    var progressBar = document.querySelector('.rm-dnd-progress')
+    progressBar.MaterialProgress.setProgress((response['processed'] / response['total']) * 100)
+}
+
+function uploadProcessed(element, response) {
+    var errors = ''
+    var files = response['files']
+    for (var i = 0; i < files.length; i++) {
+        if (files[i]['state'] === 'failed') {
+            errors += files[i]['name'] + ': ' + files[i]['error'] + '\n'
+        }
+    }
+    if (response['app'] === null && errors === '') {
+        location.reload()
+        return
+    }
+    if (response['app'] !== null && response['apks'].length > 0) {
+        addApks(element, response)
+    }
+    if (errors !== '') {
+        showError(element, errors)
+    }
+}
+
 function addScreenshots(dndField, response) {
     var screenshotsContainer = dndField.parentElement // TODO getElementById
     var repo = response['repo']
@@ -1,5 +1,7 @@
 import os
 import re
+import uuid
+from shutil import copy
 
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
@@ -7,6 +9,7 @@ from modeltranslation.utils import get_language
 from repomaker.utils import to_universal_language_code
 
 REPO_DIR = 'repo'
+BLOB_DIR = 'blobs'
 
 USER_RE = re.compile('^user_([0-9]+)$')
 REMOTE_REPO_RE = re.compile('^remote_repo_([0-9]+)$')
@@ -38,6 +41,15 @@ def get_apk_file_path(apk, filename):
         return os.path.join('packages', filename)
 
 
+def get_blob_path(file_hash, filename):
+    """
+    Returns the path of a file in the content-addressed store.
+    Its directories are sharded by the first characters of the sha256 hash of the file
+    and the file name is kept, so links to the file can keep their name as well.
+    """
+    return os.path.join(BLOB_DIR, file_hash[:2], file_hash[2:4], file_hash, filename)
+
+
 def get_graphic_asset_file_path(app, filename):
     language_code = to_universal_language_code(get_language())
     path = os.path.join(get_repo_path(app.repo), app.package_id, language_code)
@@ -69,28 +81,76 @@ def get_identity_file_path(storage, filename):
     return os.path.join(get_repo_root_path(storage.repo), filename)
 
 
+def write_if_changed(path, content):
+    """
+    Writes the given content to the file at the given path
+    unless the file has this content already, so its modification time is kept.
+
+    :param path: The absolute path of the file to write
+    :param content: The bytes or string to write, strings are encoded as UTF-8
+    :return: True if the file was written, False if it was unchanged
+    """
+    if isinstance(content, str):
+        content = content.encode('utf8')
+    if os.path.isfile(path) and os.path.getsize(path) == len(content):
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    with open(path, 'wb') as f:
+        f.write(content)
+    return True
+
+
+def copy_if_changed(source, target):
+    """
+    Copies the source file to the target path like write_if_changed() writes content,
+    so the target is never a link that shares changes with the source.
+
+    :param source: The absolute path of the source file
+    :param target: The absolute path of the target file
+    :return: True if the target was (re-)written, False if it was unchanged
+    """
+    if os.path.isfile(target) and os.path.samefile(source, target):
+        os.remove(target)  # hardlinked by an earlier version
+    with open(source, 'rb') as f:
+        return write_if_changed(target, f.read())
+
+
 class RepoStorage(FileSystemStorage):
 
     def link(self, source, target):
         """
         Links or copies the source file to the target file.
+        If the target is a link to the source already, it is kept as it is.
+        If the target is a different file, it is not replaced and an available name is used.
+        The link is created under a temporary name first and then atomically moved to the target,
+        so readers never see a partially copied file.
         :param source: path to source file relative to self.location
         :param target: path to target file relative to self.location
         :return: The final relative path to the target file, can be different from :param target
         """
-        target_dir = os.path.dirname(target)
         abs_source = os.path.join(self.location, source)
         abs_target = os.path.join(self.location, target)
-        abs_target = self.get_available_name(abs_target)
+        if os.path.isfile(abs_target) and os.path.samefile(abs_source, abs_target):
+            return target
+        if os.path.lexists(abs_target):
+            target = self.get_available_name(target)
+            abs_target = os.path.join(self.location, target)
         target_path = os.path.dirname(abs_target)
 
         if not os.path.exists(target_path):
             os.makedirs(target_path)
-        # TODO support operating systems without support for os.link()
-        os.link(abs_source, abs_target)
-
-        rel_target = os.path.join(target_dir, os.path.basename(abs_target))
-        return rel_target
+        tmp_target = '%s.%s.tmp' % (abs_target, uuid.uuid4().hex)
+        try:
+            try:
+                os.link(abs_source, tmp_target)
+            except OSError:
+                copy(abs_source, tmp_target)  # e.g. the files are on different file systems
+            os.replace(tmp_target, abs_target)
+        finally:
+            if os.path.lexists(tmp_target):
+                os.remove(tmp_target)
+        return target
 
 
 class PrivateStorage(FileSystemStorage):
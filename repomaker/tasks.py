@@ -1,20 +1,32 @@
 import json
 import logging
 import time
+import urllib.parse
+from datetime import timedelta
 
 import repomaker.models
 from background_task import background
+from background_task.models import Task
+from background_task.settings import app_settings
 from background_task.signals import task_failed
-from background_task.tasks import DBTaskRunner
+from background_task.tasks import DBTaskRunner, bg_runner
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.utils import OperationalError
 from django.dispatch import receiver
 from django.utils import timezone
+from repomaker import remotesync
+from repomaker.utils import PhaseTimer
 
+PRIORITY_UPLOAD = 1
 PRIORITY_REPO = -1
 PRIORITY_REMOTE_REPO = -2
 PRIORITY_REMOTE_APP_ICON = -3
 
+UPDATE_REMOTE_REPO = 'repomaker.tasks.update_remote_repo'
+# the number of due tasks that are looked at to find remote repositories to sync concurrently
+REMOTE_SYNC_LOOKAHEAD = 50
+
 
 @background(schedule=timezone.now())
 def update_repo(repo_id):
@@ -24,18 +36,50 @@ def update_repo(repo_id):
         logging.warning('Repository does not exist anymore, dropping task. (%s)', e)
         return
 
-    if repo.is_updating:
-        return  # don't update the same repo concurrently
+    if repo.update_scheduled:
+        run_at = _get_update_run_at(repo)
+        if run_at is not None:
+            # keep the request scheduled, so further requests get merged into it
+            update_repo(repo.id, priority=PRIORITY_REPO,  # pylint: disable=unexpected-keyword-arg
+                        schedule=run_at)
+            return
+    # claim the update atomically, so the same repo does not get updated concurrently
+    claimed = repomaker.models.Repository.objects.filter(pk=repo.pk, is_updating=False) \
+        .update(is_updating=True, update_scheduled=False)
+    if claimed == 0:
+        return
     repo.update_scheduled = False
     repo.is_updating = True
-    repo.save()
 
+    timer = PhaseTimer()
+    succeeded = False
     try:
-        repo.update()
-        repo.publish()
+        with timer:
+            repo.update(incremental=True)
+            repo.publish()
+        succeeded = True
     finally:
         repo.is_updating = False
-        repo.save()
+        # only save what the update changed to keep requests that arrived in the meantime
+        repo.save(update_fields=['is_updating', 'last_publication_date', 'last_updated_date'])
+        repomaker.models.TaskTiming.record('update_repo', timer, succeeded, repo=repo)
+
+
+def _get_update_run_at(repo):
+    """
+    Returns the time when the given repository can be updated
+    or None if it can be updated right away.
+
+    The update waits while another update is running
+    and until the last update request is older than settings.REPO_UPDATE_QUIET_PERIOD.
+    """
+    quiet_period = timedelta(seconds=settings.REPO_UPDATE_QUIET_PERIOD)
+    now = timezone.now()
+    if repo.is_updating:
+        return now + quiet_period
+    if repo.update_requested_date is None or repo.update_requested_date + quiet_period <= now:
+        return None
+    return repo.update_requested_date + quiet_period
 
 
 @background(schedule=timezone.now())
@@ -53,11 +97,21 @@ def update_remote_repo(remote_repo_id):
     remote_repo.is_updating = True
     remote_repo.save()
 
+    timer = PhaseTimer()
+    succeeded = False
+    previous_change_date = remote_repo.last_change_date
     try:
-        remote_repo.update_index()
+        with timer:
+            remote_repo.update_index()
+        succeeded = True
     finally:
         remote_repo.is_updating = False
         remote_repo.save()
+        repomaker.models.TaskTiming.record('update_remote_repo', timer, succeeded,
+                                           remote_repo=remote_repo)
+    # failed updates are retried by the task runner instead
+    remote_repo.adapt_update_interval(previous_change_date)
+    remote_repo.schedule_update()
 
 
 @background(schedule=timezone.now())
@@ -70,6 +124,36 @@ def update_remote_app_icon(remote_app_id, icon_name):
     remote_app.update_icon(icon_name)
 
 
+@background(schedule=timezone.now())
+def update_remote_app_icons(icons):
+    """
+    Updates the icons of many remote apps, so a large remote repository
+    does not need a task for each of its apps.
+
+    :param icons: A list of lists with the primary key of a RemoteApp and its icon name
+    """
+    remote_apps = repomaker.models.RemoteApp.objects.in_bulk([app_id for app_id, _ in icons])
+    for remote_app_id, icon_name in icons:
+        if remote_app_id not in remote_apps:
+            logging.warning('Remote App %s does not exist anymore, not updating its icon.',
+                            remote_app_id)
+            continue
+        try:
+            remote_apps[remote_app_id].update_icon(icon_name)
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning('Could not update icon of %s: %s', remote_apps[remote_app_id], e)
+
+
+@background(schedule=timezone.now())
+def process_upload(upload_id):
+    try:
+        upload = repomaker.models.Upload.objects.get(pk=upload_id)
+    except ObjectDoesNotExist as e:
+        logging.warning('Upload does not exist anymore, dropping task. (%s)', e)
+        return
+    upload.process()
+
+
 @background(schedule=timezone.now())
 def download_apk(apk_id, url):
     try:
@@ -83,11 +167,20 @@ def download_apk(apk_id, url):
     apk.is_downloading = True
     apk.save()
 
+    timer = PhaseTimer()
+    succeeded = False
     try:
-        apk.download(url)
+        with timer:
+            apk.download(url)
+        succeeded = True
     finally:
-        apk.is_downloading = False
-        apk.save()
+        # the Apk gets deleted if its downloaded file is invalid, so don't create it again
+        exists = repomaker.models.Apk.objects.filter(pk=apk_id).exists()
+        if exists:
+            apk.is_downloading = False
+            apk.save()
+        repomaker.models.TaskTiming.record('download_apk', timer, succeeded,
+                                           apk=apk if exists else None)
 
 
 @background(schedule=timezone.now())
@@ -114,11 +207,17 @@ def download_remote_screenshot(screenshot_id, app_id):
         logging.warning('Remote Screenshot does not exist anymore, dropping task. (%s)', e)
 
 
+@background(schedule=timezone.now())
+def download_remote_screenshots(screenshot_ids, app_id):
+    screenshots = repomaker.models.RemoteScreenshot.objects.filter(pk__in=screenshot_ids)
+    repomaker.models.RemoteScreenshot.download_all(list(screenshots), app_id)
+
+
 @receiver(task_failed)
 def task_failed_receiver(**kwargs):
     task = kwargs['completed_task']
 
-    if task.task_name == 'repomaker.tasks.update_remote_repo':
+    if task.task_name == UPDATE_REMOTE_REPO:
         # extract task parameters
         task_params = json.loads(task.task_params)
         params = task_params[0]
@@ -130,11 +229,78 @@ def task_failed_receiver(**kwargs):
         remote_repo.save()
 
 
-class DesktopRunner(DBTaskRunner):
+class RemoteSyncRunner(DBTaskRunner):
+    """
+    Runs the due updates of remote repositories concurrently
+    with a remotesync.RemoteSyncExecutor while they are the next tasks to run.
+    All other tasks run one at a time as before.
+    """
+
+    def run_next_task(self, tasks, queue=None):
+        if self.run_remote_syncs(tasks, queue):
+            return True
+        return super().run_next_task(tasks, queue)
+
+    def run_remote_syncs(self, tasks, queue=None):
+        """
+        Runs updates of remote repositories until no more are due before other tasks.
+        Whenever one finishes, the next due one on a host with free capacity gets started.
+
+        :return: True if updates of remote repositories were run, False otherwise
+        """
+        if settings.REMOTE_SYNC_WORKERS <= 1 or app_settings.BACKGROUND_TASK_RUN_ASYNC:
+            return False
+        proxy_task = tasks._tasks[UPDATE_REMOTE_REPO]  # pylint: disable=protected-access
+        executor = None
+        try:
+            while True:
+                with remotesync.database_lock():
+                    due_tasks = self._get_due_remote_syncs(queue)
+                    for task in due_tasks:
+                        if executor is None:
+                            executor = remotesync.RemoteSyncExecutor()
+                        if executor.is_full():
+                            break
+                        host = self._get_host(task)
+                        if not executor.can_submit(host):
+                            continue
+                        locked_task = task.lock(self.worker_name)
+                        if locked_task:
+                            logging.info('Running %s', locked_task)
+                            executor.submit(host, bg_runner, proxy_task, locked_task)
+                if executor is None or not executor.wait():
+                    return executor is not None
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    @staticmethod
+    def _get_due_remote_syncs(queue=None):
+        """
+        Returns the due updates of remote repositories that come before all other tasks.
+        """
+        due_tasks = []
+        for task in Task.objects.find_available(queue)[:REMOTE_SYNC_LOOKAHEAD]:
+            if task.task_name != UPDATE_REMOTE_REPO:
+                break  # tasks with a higher priority run first
+            due_tasks.append(task)
+        return due_tasks
+
+    @staticmethod
+    def _get_host(task):
+        args, _ = task.params()
+        url = repomaker.models.RemoteRepository.objects.filter(pk=args[0]) \
+            .values_list('url', flat=True).first()
+        if url is None:
+            return None  # the task drops itself
+        return urllib.parse.urlsplit(url).netloc
+
+
+class DesktopRunner(RemoteSyncRunner):
 
     def run_task(self, tasks, task):
         try:
-            super().run_task.__wrapped__(self, tasks, task)
+            DBTaskRunner.run_task.__wrapped__(self, tasks, task)
         except OperationalError as e:
             if str(e) == 'database is locked':
                 time.sleep(0.25)
@@ -143,7 +309,9 @@ class DesktopRunner(DBTaskRunner):
 
     def run_next_task(self, tasks, queue=None):
         try:
-            return super().run_next_task.__wrapped__(self, tasks, queue)
+            if self.run_remote_syncs(tasks, queue):
+                return True
+            return DBTaskRunner.run_next_task.__wrapped__(self, tasks, queue)
         except OperationalError as e:
             if str(e) == 'database is locked':
                 time.sleep(0.25)
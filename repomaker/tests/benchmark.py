@@ -0,0 +1,313 @@
+"""
+Benchmarks Repository.update() with synthetic repositories of growing size
+and reading synthetic remote repository indexes.
+
+This module is not picked up by the normal test run. Use ./tests/test-benchmark.sh to run it.
+It is configured by these environment variables:
+
+REPOMAKER_BENCHMARK_SIZES: comma-separated numbers of apps per repository (10,100,1000,5000)
+REPOMAKER_BENCHMARK_FILE_SIZES: comma-separated sizes in MiB of video files to analyze (64,1024)
+REPOMAKER_BENCHMARK_INDEX_SIZES: comma-separated numbers of apps per remote index to read (20000)
+REPOMAKER_BENCHMARK_OUTPUT: the JSON file to write the results to (benchmark.json)
+REPOMAKER_BENCHMARK_BASELINE: a JSON file of an earlier run to compare the results with
+"""
+import datetime
+import hashlib
+import json
+import os
+import pickle
+import platform
+import time
+import tracemalloc
+
+import fdroidserver
+import magic
+from django.conf import settings
+from django.core.files.base import ContentFile
+from fdroidserver import update
+
+from repomaker.models import Apk, ApkPointer, App, Category, Repository, Screenshot
+from repomaker.models.apk import analyze_file, sha256sum
+from repomaker.models.app import VIDEO
+from repomaker.models.repository import FDROIDSERVER_LOCK
+from repomaker.remoteindex import RepoIndex
+from repomaker.utils import QueryCounter
+
+from . import fake_repo_create, RmTestCase
+
+SIZES = os.environ.get('REPOMAKER_BENCHMARK_SIZES', '10,100,1000,5000')
+FILE_SIZES = os.environ.get('REPOMAKER_BENCHMARK_FILE_SIZES', '64,1024')
+INDEX_SIZES = os.environ.get('REPOMAKER_BENCHMARK_INDEX_SIZES', '20000')
+OUTPUT = os.environ.get('REPOMAKER_BENCHMARK_OUTPUT', 'benchmark.json')
+BASELINE = os.environ.get('REPOMAKER_BENCHMARK_BASELINE')
+
+# relative changes of wall time and peak memory that are reported as regressions
+TOLERANCE = 0.2
+
+
+def measure(function, setup=None):
+    """
+    Runs the given function twice, once to measure its wall time and database queries
+    and once to measure its peak memory, because tracing memory slows it down.
+
+    :param function: The function to measure, it gets passed what setup() returns
+    :param setup: An optional function preparing the arguments before each run
+    :return: A dict with wall time in seconds, number of queries and peak memory in bytes
+    """
+    args = setup() if setup else ()
+    start = time.perf_counter()
+    with QueryCounter() as queries:
+        function(*args)
+    wall_time = time.perf_counter() - start
+
+    args = setup() if setup else ()
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_time': wall_time,
+        'queries': queries.count,
+        'peak_memory': peak_memory,
+    }
+
+
+def create_repository(user, size):
+    """
+    Creates a repository with the given number of apps.
+    Each app has a file, two screenshots, two categories and an English and German translation.
+    """
+    repo = Repository.objects.create(name='Benchmark %d' % size, description='Benchmark',
+                                     url='https://example.org/%d' % size, user=user,
+                                     fingerprint='benchmark')
+    fake_repo_create(repo)
+    categories = list(Category.objects.filter(user=None))
+    for i in range(size):
+        package_id = 'org.example.benchmark%d' % i
+        app = App.objects.create(repo=repo, package_id=package_id, name='App %d' % i,
+                                 type=VIDEO, website='https://example.org/app%d' % i,
+                                 author_name='Author %d' % i)
+        app.translate('en-us')
+        app.summary_en_us = 'Summary of app %d' % i
+        app.description_en_us = '<p>Description of app %d</p>' % i
+        app.translate('de')
+        app.summary_de = 'Zusammenfassung von App %d' % i
+        app.description_de = '<p>Beschreibung von App %d</p>' % i
+        app.save()
+        app.category.add(categories[i % len(categories)], categories[(i + 1) % len(categories)])
+        for language_code in ['en-us', 'de']:
+            Screenshot.objects.create(app=app, language_code=language_code,
+                                      file='%s/%s/phone/1.png' % (package_id, language_code))
+
+        # every app gets a file with unique content, so all of them end up in the index
+        apk = Apk.objects.create(package_id=package_id, version_code=1, hash_type='sha256')
+        apk.file.save('benchmark%d.mp4' % i, ContentFile(b'benchmark %d' % i), save=False)
+        apk.hash = sha256sum(apk.file.path)
+        apk.save()
+        pointer = ApkPointer.objects.create(repo=repo, app=app, apk=apk)
+        pointer.link_file_from_apk()
+    return repo
+
+
+def create_video_file(path, size):
+    """
+    Creates an MP4 file with the given size in MiB and random content.
+    """
+    with open(path, 'wb') as f:
+        f.write(b'\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom')
+        for _ in range(size):
+            f.write(os.urandom(1024 * 1024))
+
+
+def analyze_file_in_passes(path):
+    """
+    Analyzes a file like it was done before there was analyze_file(),
+    with one pass for the hash, another one for the type and a stat for the size.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(16384), b''):
+            sha.update(chunk)
+    return sha.hexdigest(), os.path.getsize(path), magic.from_file(path, mime=True)
+
+
+def analyze_file_in_one_pass(path):
+    file_hash, size, head = analyze_file(path)
+    return file_hash, size, magic.from_buffer(head, mime=True)
+
+
+def create_index_file(path, size):
+    """
+    Creates a remote repository index v1 with the given number of apps.
+    Each app has an English and German translation with screenshots and three packages.
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"repo": %s, "requests": {"install": [], "uninstall": []}, "apps": [' %
+                json.dumps({'name': 'Benchmark', 'description': 'Benchmark',
+                            'timestamp': 1500000000000, 'icon': 'icon.png'}))
+        for i in range(size):
+            f.write(',' if i else '')
+            localized = {language_code: {
+                'summary': 'Summary of app %d in %s' % (i, language_code),
+                'description': '<p>Description of app %d in %s</p>' % (i, language_code) * 20,
+                'phoneScreenshots': ['%d.png' % j for j in range(4)],
+            } for language_code in ['en-US', 'de']}
+            json.dump({'packageName': 'org.example.benchmark%d' % i, 'name': 'App %d' % i,
+                       'categories': ['Games', 'Internet'], 'license': 'GPL-3.0-or-later',
+                       'webSite': 'https://example.org/app%d' % i, 'icon': 'icon%d.png' % i,
+                       'added': 1500000000000, 'lastUpdated': 1500000000000 + i,
+                       'localized': localized}, f)
+        f.write('], "packages": {')
+        for i in range(size):
+            package_name = 'org.example.benchmark%d' % i
+            packages = [{
+                'packageName': package_name, 'versionCode': version_code,
+                'versionName': '1.%d' % version_code,
+                'apkName': '%s_%d.apk' % (package_name, version_code),
+                'hash': hashlib.sha256(b'%d.%d' % (i, version_code)).hexdigest(),
+                'hashType': 'sha256', 'size': 1000000 + i, 'sig': '%032x' % i,
+                'minSdkVersion': 14, 'targetSdkVersion': 28, 'added': 1500000000000,
+                'uses-permission': [['android.permission.INTERNET', None]],
+            } for version_code in range(3)]
+            f.write('%s%s: %s' % (',' if i else '', json.dumps(package_name),
+                                  json.dumps(packages)))
+        f.write('}}')
+
+
+def read_index_in_memory(path):
+    """
+    Reads all apps and packages of an index like it was done before there was RepoIndex,
+    by loading the entire index into memory.
+    """
+    with open(path, 'rb') as f:
+        repo_index = json.loads(f.read().decode('utf-8'))
+    return sum(len(repo_index['packages'][app['packageName']])
+               for app in repo_index['apps'])
+
+
+def read_index_streaming(path):
+    with open(path, 'rb') as f:
+        repo_index = RepoIndex(f)
+        return sum(len(repo_index['packages'][app['packageName']])
+                   for app in repo_index['apps'])
+
+
+def compare(results, baseline):
+    """
+    Returns a list of human-readable regressions of the results compared to the baseline.
+    """
+    regressions = []
+    for kind, unit in [('sizes', 'apps'), ('file_sizes', 'MiB'), ('index_sizes', 'apps')]:
+        for size, operations in results.get(kind, {}).items():
+            for operation, values in operations.items():
+                old_values = baseline.get(kind, {}).get(size, {}).get(operation)
+                if not old_values:
+                    continue
+                for key, value in values.items():
+                    old_value = old_values.get(key)
+                    if not old_value:
+                        continue
+                    tolerance = 0 if key == 'queries' else TOLERANCE
+                    if value > old_value * (1 + tolerance):
+                        regressions.append('%s with %s %s: %s went up from %s to %s' %
+                                           (operation, size, unit, key, old_value, value))
+    return regressions
+
+
+class RepositoryUpdateBenchmark(RmTestCase):
+
+    def test_update(self):
+        results = {
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'sizes': {},
+            'file_sizes': {},
+            'index_sizes': {},
+        }
+        for size in [int(size) for size in SIZES.split(',')]:
+            results['sizes'][str(size)] = self._benchmark(size)
+            # write results after each size, so they are not lost if a bigger size fails
+            with open(OUTPUT, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        for size in [int(size) for size in FILE_SIZES.split(',')]:
+            results['file_sizes'][str(size)] = self._benchmark_file_analysis(size)
+            with open(OUTPUT, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        for size in [int(size) for size in INDEX_SIZES.split(',')]:
+            results['index_sizes'][str(size)] = self._benchmark_index(size)
+            with open(OUTPUT, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        if BASELINE:
+            with open(BASELINE, 'r', encoding='utf-8') as f:
+                regressions = compare(results, json.load(f))
+            for regression in regressions:
+                print(regression)
+            # query counts do not depend on the machine, so they must not go up
+            self.assertFalse([r for r in regressions if ': queries ' in r])
+
+    def _benchmark(self, size):
+        # pylint: disable=protected-access
+        repo = create_repository(self.user, size)
+        results = {}
+
+        results['update'] = measure(repo.update)
+
+        # change a single app for an incremental update
+        app = App.objects.filter(repo=repo).first()
+
+        def change_app():
+            app.name = app.name + '.'
+            app.save()
+            return ()
+        results['update_incremental'] = measure(lambda: repo.update(incremental=True),
+                                                setup=change_app)
+
+        results['to_metadata_app'] = measure(repo._get_metadata_apps)
+
+        # make the index from the state the last update left behind
+        state = pickle.dumps(repo._read_update_state())
+
+        def make_index(apps, apks):
+            with FDROIDSERVER_LOCK:
+                repo.get_config()
+                fdroidserver.make_index(apps, apks, repo.get_repo_path(), False)
+
+        def prepare_index():
+            apps, apks = pickle.loads(state)
+            update.read_added_date_from_all_apks(apps, apks)
+            update.apply_info_from_latest_apk(apps, apks)
+            return apps, apks
+        results['make_index'] = measure(make_index, setup=prepare_index)
+
+        results['generate_page'] = measure(repo._generate_page)
+
+        repo.delete()
+        return results
+
+    def _benchmark_file_analysis(self, size):
+        # the file is in the page cache after it was written,
+        # so this measures the overhead of reading it rather than the disk
+        path = os.path.join(settings.TEST_DIR, 'benchmark.mp4')
+        create_video_file(path, size)
+        self.assertEqual(analyze_file_in_passes(path), analyze_file_in_one_pass(path))
+        results = {
+            'analyze_in_passes': measure(lambda: analyze_file_in_passes(path)),
+            'analyze_in_one_pass': measure(lambda: analyze_file_in_one_pass(path)),
+        }
+        os.remove(path)
+        return results
+
+    def _benchmark_index(self, size):
+        path = os.path.join(settings.TEST_DIR, 'index-v1.json')
+        create_index_file(path, size)
+        self.assertEqual(read_index_in_memory(path), read_index_streaming(path))
+        results = {
+            'read_in_memory': measure(lambda: read_index_in_memory(path)),
+            'read_streaming': measure(lambda: read_index_streaming(path)),
+        }
+        os.remove(path)
+        return results
@@ -1,4 +1,9 @@
+import json
 import os
+import threading
+import time
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from datetime import datetime
 from io import BytesIO
 from unittest.mock import patch
@@ -8,15 +13,49 @@ import requests
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.files import File
+from django.test import override_settings
 from django.utils import timezone
 from fdroidserver.exception import BuildException
+from repomaker import mirrors, tasks
 from repomaker.models import Apk, ApkPointer, RemoteApkPointer, App, RemoteApp, RemoteRepository, \
-    Repository
-from repomaker.storage import get_apk_file_path
+    Repository, TaskTiming
+from repomaker.models.apk import DOWNLOAD_CHUNK_SIZE, analyze_file, sha256sum
+from repomaker.models.repository import FDROIDSERVER_LOCK
+from repomaker.storage import get_apk_file_path, get_blob_path
 
 from .. import datetime_is_recent, RmTestCase
 
 
+class DroppingRangeRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves a file with support for HTTP Range requests,
+    but drops each connection after sending a limited number of bytes.
+    """
+    content = b''
+    max_bytes_per_request = 0
+    bytes_sent = 0
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        start = 0
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'][len('bytes='):-len('-')])
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, len(self.content) - 1, len(self.content)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(self.content) - start))
+        self.end_headers()
+
+        data = self.content[start:start + self.max_bytes_per_request]
+        self.wfile.write(data)
+        type(self).bytes_sent += len(data)
+        self.close_connection = True  # drops the connection before all data was sent
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
 class ApkTestCase(RmTestCase):
 
     def setUp(self):
@@ -70,7 +109,7 @@ class ApkTestCase(RmTestCase):
         self.apk.download_async('url')
         self.assertFalse(download_apk.called)
 
-    @patch('requests.get')
+    @patch('repomaker.downloads.get')
     def test_download(self, get):
         # remove file and assert that it is gone
         self.apk.file.delete()
@@ -83,15 +122,15 @@ class ApkTestCase(RmTestCase):
         # fake return value of GET request for APK
         get.return_value.status_code = requests.codes.ok
         with open(os.path.join(settings.TEST_FILES_DIR, 'test_1.apk'), 'rb') as f:
-            get.return_value.content = f.read()
+            get.return_value.iter_content.return_value = [f.read()]
 
         # download file and assert there was a GET request for the URL
         self.apk.download('url/download.apk')
-        get.assert_called_once_with('url/download.apk', timeout=60)
+        get.assert_called_once_with('url/download.apk', headers={}, stream=True)
 
-        # assert that downloaded file has been saved
-        self.assertEqual(get_apk_file_path(self.apk, 'download.apk'), self.apk.file.name)
-        path = os.path.join(settings.MEDIA_ROOT, get_apk_file_path(self.apk, 'download.apk'))
+        # assert that downloaded file has been saved in the content-addressed store
+        self.assertEqual(get_blob_path(self.apk.hash, 'download.apk'), self.apk.file.name)
+        path = os.path.join(settings.MEDIA_ROOT, self.apk.file.name)
         self.assertTrue(os.path.isfile(path))
 
         # assert that ApkPointer was updated with a new copy/link of the downloaded file
@@ -101,7 +140,7 @@ class ApkTestCase(RmTestCase):
         path = os.path.join(settings.MEDIA_ROOT, apk_pointer.file.name)
         self.assertTrue(os.path.isfile(path))
 
-    @patch('requests.get')
+    @patch('repomaker.downloads.get')
     def test_download_404(self, get):
         # remove file and assert that it is gone
         self.apk.file.delete()
@@ -110,12 +149,256 @@ class ApkTestCase(RmTestCase):
         # fake return value of GET request
         get.return_value = requests.Response()
         get.return_value.status_code = 404
+        get.return_value.raw = BytesIO()
 
         # try to download file and assert an exception was raised
         with self.assertRaises(requests.exceptions.HTTPError):
             self.apk.download('url/download.apk')
 
-    @patch('requests.get')
+    @patch('repomaker.models.apk.Apk.initialize')
+    @patch('repomaker.downloads.get')
+    def test_download_wrong_hash(self, get, initialize):
+        # remove file and set the hash the remote index promised
+        self.apk.file.delete()
+        self.apk.hash = sha256(b'foo').hexdigest()
+        self.apk.hash_type = 'sha256'
+        self.apk.save()
+        path = os.path.join(settings.MEDIA_ROOT, get_apk_file_path(self.apk, 'download.apk'))
+        repo = Repository.objects.create(user=self.repo.user)
+        ApkPointer.objects.create(apk=self.apk, repo=repo)
+
+        # fake return value of GET request with different content in several chunks
+        get.return_value.status_code = requests.codes.ok
+        get.return_value.iter_content.return_value = [b'b', b'ar']
+
+        # assert that the file is rejected without scanning it or retrying the download
+        tasks.download_apk.now(self.apk.pk, 'url/download.apk')
+        self.assertEqual(1, get.call_count)
+        self.assertFalse(initialize.called)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.part'))
+
+        # assert that the APK and its pointers were kept, so the download can be tried again
+        apk = Apk.objects.get(hash=sha256(b'foo').hexdigest())
+        self.assertEqual(self.apk.pk, apk.pk)
+        self.assertFalse(apk.file)
+        self.assertFalse(apk.is_downloading)
+        self.assertTrue(ApkPointer.objects.filter(repo=repo, apk=apk).exists())
+
+    @patch('repomaker.mirrors.get_ordered', side_effect=list)
+    @patch('repomaker.models.apk.Apk.initialize')
+    def test_download_wrong_hash_fails_over_to_mirror(self, initialize, _get_ordered):
+        content = os.urandom(1024)
+        servers = []
+        for server_content in [b'corrupt', content]:
+            handler = type('Handler', (DroppingRangeRequestHandler,), {
+                'content': server_content,
+                'max_bytes_per_request': len(server_content),
+            })
+            servers.append(HTTPServer(('127.0.0.1', 0), handler))
+            threading.Thread(target=servers[-1].serve_forever, daemon=True).start()
+        urls = ['http://127.0.0.1:%d/repo' % server.server_port for server in servers]
+
+        self.remote_repository.url = urls[0]
+        self.remote_repository.mirrors = json.dumps(urls[1:])
+        self.remote_repository.save()
+        RemoteApkPointer.objects.create(app=self.remote_app, apk=self.apk,
+                                        url=urls[0] + '/download.apk')
+        self.apk.file.delete()
+        self.apk.hash = sha256(content).hexdigest()
+        self.apk.hash_type = 'sha256'
+        self.apk.save()
+        initialize.return_value = self.apk
+
+        try:
+            self.apk.download(urls[0] + '/download.apk')
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+        # assert that the file came from the mirror with the expected content
+        with open(self.apk.file.path, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertFalse(mirrors.get_mirror(urls[0]).is_healthy(time.monotonic()))
+        self.assertTrue(RemoteApkPointer.objects.filter(apk=self.apk).exists())
+
+    @patch('repomaker.models.apk.Apk.initialize')
+    @patch('repomaker.downloads.get')
+    def test_download_expected_hash(self, get, initialize):
+        # remove file and set the hash the remote index promised
+        self.apk.file.delete()
+        self.apk.hash = sha256(b'foo').hexdigest()
+        self.apk.hash_type = 'sha256'
+        self.apk.save()
+        path = os.path.join(settings.MEDIA_ROOT, get_apk_file_path(self.apk, 'download.apk'))
+
+        # fake return value of GET request with the expected content in several chunks
+        get.return_value.status_code = requests.codes.ok
+        get.return_value.iter_content.return_value = [b'f', b'oo']
+        initialize.return_value = self.apk
+
+        # assert that the file is accepted
+        self.apk.download('url/download.apk')
+        initialize.assert_called_once_with()
+        self.assertEqual(get_blob_path(self.apk.hash, 'download.apk'), self.apk.file.name)
+        with open(self.apk.file.path, 'rb') as f:
+            self.assertEqual(b'foo', f.read())
+        self.assertFalse(os.path.exists(path + '.part'))
+
+    @patch('repomaker.models.apk.Apk.initialize')
+    @patch('repomaker.downloads.get')
+    def test_download_trusts_remote_index(self, get, initialize):
+        # remove file and describe the APK like the signed index of a remote repository does
+        self.apk.file.delete()
+        with open(os.path.join(settings.TEST_FILES_DIR, 'test_1.apk'), 'rb') as f:
+            content = f.read()
+        self.apk.package_id = 'org.bitbucket.tickytacky.mirrormirror'
+        self.apk.version_code = 2
+        self.apk.hash = sha256(content).hexdigest()
+        self.apk.hash_type = 'sha256'
+        self.apk.save()
+        RemoteApkPointer.objects.create(apk=self.apk, app=self.remote_app, url='url')
+        apk_pointer = ApkPointer.objects.create(apk=self.apk, repo=Repository.objects.get(id=1))
+
+        # download the file
+        get.return_value.status_code = requests.codes.ok
+        get.return_value.iter_content.return_value = [content]
+        with patch('repomaker.models.repository.Repository.update_async') as update_async:
+            self.apk.download('url/download.apk')
+            update_async.assert_called_once_with()
+
+        # assert that the file was not scanned, but taken as described in the index
+        self.assertFalse(initialize.called)
+        apk = Apk.objects.get(pk=self.apk.pk)
+        self.assertEqual(get_blob_path(apk.hash, 'download.apk'), apk.file.name)
+        self.assertEqual(2, apk.version_code)
+        self.assertEqual('', apk.scan_cache)  # scanned when the repository gets updated
+        self.assertTrue(ApkPointer.objects.get(pk=apk_pointer.pk).file)
+
+    @override_settings(DOWNLOAD_TRUST_REMOTE_INDEX=False)
+    @patch('repomaker.models.apk.Apk.initialize')
+    @patch('repomaker.downloads.get')
+    def test_download_does_not_trust_remote_index(self, get, initialize):
+        self.apk.file.delete()
+        self.apk.package_id = 'org.example'
+        self.apk.hash = sha256(b'foo').hexdigest()
+        self.apk.hash_type = 'sha256'
+        self.apk.save()
+        RemoteApkPointer.objects.create(apk=self.apk, app=self.remote_app, url='url')
+
+        get.return_value.status_code = requests.codes.ok
+        get.return_value.iter_content.return_value = [b'foo']
+        initialize.return_value = self.apk
+        self.apk.download('url/download.apk')
+
+        # assert that the file was scanned anyway
+        initialize.assert_called_once_with()
+
+    @patch('repomaker.models.apk.Apk.initialize')
+    def test_download_resumes_interrupted_download(self, initialize):
+        content = os.urandom(1024 * 1024)
+        handler = type('Handler', (DroppingRangeRequestHandler,), {
+            'content': content,
+            'max_bytes_per_request': 300 * 1024,
+        })
+        server = HTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        self.apk.file.delete()
+        self.apk.hash = sha256(content).hexdigest()
+        self.apk.hash_type = 'sha256'
+        self.apk.save()
+        initialize.return_value = self.apk
+
+        # download the file and retry like the background task does until it is complete
+        url = 'http://127.0.0.1:%d/download.apk' % server.server_port
+        attempts = 0
+        try:
+            while not self.apk.file:
+                attempts += 1
+                self.assertTrue(attempts <= 10)
+                try:
+                    self.apk.download(url)
+                except requests.exceptions.RequestException:
+                    pass
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # assert that the complete file was downloaded in several attempts
+        self.assertEqual(4, attempts)
+        with open(self.apk.file.path, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertFalse(os.path.exists(self.apk.file.path + '.part'))
+
+        # assert that interrupted downloads were resumed instead of started from the beginning
+        self.assertTrue(handler.bytes_sent <= len(content) + attempts * DOWNLOAD_CHUNK_SIZE)
+
+    @patch('repomaker.models.apk.Apk.initialize')
+    def test_download_fails_over_to_mirror(self, initialize):
+        content = os.urandom(1024 * 1024)
+        servers = []
+        for _ in range(2):
+            handler = type('Handler', (DroppingRangeRequestHandler,), {
+                'content': content,
+                'max_bytes_per_request': 300 * 1024,
+            })
+            servers.append(HTTPServer(('127.0.0.1', 0), handler))
+            threading.Thread(target=servers[-1].serve_forever, daemon=True).start()
+        urls = ['http://127.0.0.1:%d/repo' % server.server_port for server in servers]
+
+        self.remote_repository.url = urls[0]
+        self.remote_repository.mirrors = json.dumps(urls[1:])
+        self.remote_repository.save()
+        RemoteApkPointer.objects.create(app=self.remote_app, apk=self.apk,
+                                        url=urls[0] + '/download.apk')
+        self.apk.file.delete()
+        self.apk.hash = sha256(content).hexdigest()
+        self.apk.hash_type = 'sha256'
+        self.apk.save()
+        initialize.return_value = self.apk
+
+        # download the file and retry like the background task does until it is complete
+        attempts = 0
+        try:
+            while not self.apk.file:
+                attempts += 1
+                self.assertTrue(attempts <= 10)
+                try:
+                    self.apk.download(urls[0] + '/download.apk')
+                except requests.exceptions.RequestException:
+                    pass
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+        # assert that each attempt resumed the download from the other mirror when one failed
+        self.assertEqual(2, attempts)
+        with open(self.apk.file.path, 'rb') as f:
+            self.assertEqual(content, f.read())
+        self.assertTrue(sum(server.RequestHandlerClass.bytes_sent for server in servers) <=
+                        len(content) + 4 * DOWNLOAD_CHUNK_SIZE)
+
+    @patch('repomaker.models.apk.Apk.initialize')
+    @patch('repomaker.downloads.get')
+    def test_download_task_deletes_invalid_apk(self, get, initialize):
+        self.apk.file.delete()
+        repo = Repository.objects.create(user=self.repo.user)
+        ApkPointer.objects.create(apk=self.apk, repo=repo)
+        get.return_value.status_code = requests.codes.ok
+        get.return_value.iter_content.return_value = [b'foo']
+        initialize.side_effect = ValidationError('Invalid APK signature')
+
+        tasks.download_apk.now(self.apk.pk, 'url/download.apk')
+
+        # assert that the task did not create the deleted Apk again
+        self.assertEqual(0, Apk.objects.all().count())
+        self.assertEqual(0, ApkPointer.objects.filter(repo=repo).count())
+        self.assertEqual('download_apk', TaskTiming.objects.get(apk=None).task_name)
+
+    @patch('repomaker.downloads.get')
     def test_download_invalid_apk(self, get):
         # remove file and assert that it is gone
         self.apk.file.delete()
@@ -129,7 +412,7 @@ class ApkTestCase(RmTestCase):
 
         # fake return value of GET request
         get.return_value.status_code = requests.codes.ok
-        get.return_value.content = b'foo'
+        get.return_value.iter_content.return_value = [b'foo']
 
         # try to download the invalid file
         self.apk.download('url/download.apk')
@@ -139,7 +422,7 @@ class ApkTestCase(RmTestCase):
         self.assertEqual(0, ApkPointer.objects.all().count())
         self.assertEqual(0, RemoteApkPointer.objects.all().count())
 
-    @patch('requests.get')
+    @patch('repomaker.downloads.get')
     def test_download_apk_with_invalid_signature(self, get):
         # remove file and assert that it is gone
         self.apk.file.delete()
@@ -154,7 +437,7 @@ class ApkTestCase(RmTestCase):
         # fake return value of GET request for APK
         get.return_value.status_code = requests.codes.ok
         with open(os.path.join(settings.TEST_FILES_DIR, 'test_invalid_signature.apk'), 'rb') as f:
-            get.return_value.content = f.read()
+            get.return_value.iter_content.return_value = [f.read()]
 
         # try to download the invalid file
         self.apk.download('url/download.apk')
@@ -164,13 +447,13 @@ class ApkTestCase(RmTestCase):
         self.assertEqual(0, ApkPointer.objects.all().count())
         self.assertEqual(0, RemoteApkPointer.objects.all().count())
 
-    @patch('requests.get')
+    @patch('repomaker.downloads.get')
     def test_download_only_when_file_missing(self, get):
         # try to download file and assert there was no GET request (because it already exists)
         self.apk.download('url/download.apk')
         self.assertFalse(get.called)
 
-    @patch('requests.get')
+    @patch('repomaker.downloads.get')
     def test_download_non_apk(self, get):
         # remove file and assert that it is gone
         self.apk.file.delete()
@@ -190,11 +473,11 @@ class ApkTestCase(RmTestCase):
         # fake return value of GET request for test file
         get.return_value.status_code = requests.codes.ok
         with open(os.path.join(settings.TEST_FILES_DIR, 'test.mp4'), 'rb') as f:
-            get.return_value.content = f.read()
+            get.return_value.iter_content.return_value = [f.read()]
 
         # download file and assert there was a GET request for the URL
         self.apk.download('url/test.mp4')
-        get.assert_called_once_with('url/test.mp4', timeout=60)
+        get.assert_called_once_with('url/test.mp4', headers={}, stream=True)
 
         # assert that downloaded file has been saved
         self.assertEqual(get_apk_file_path(self.apk, 'test.mp4'), self.apk.file.name)
@@ -225,6 +508,12 @@ class ApkTestCase(RmTestCase):
         self.assertTrue(datetime_is_recent(apk.added_date))
         self.assertFalse(apk.is_downloading)
 
+        # assert that the scan result was cached
+        scan_result = Apk.objects.get(pk=apk.pk).get_scan_result()
+        self.assertEqual(apk.hash, scan_result['hash'])
+        self.assertEqual(apk.package_id, scan_result['packageName'])
+        self.assertFalse('type' in scan_result)
+
     def test_initialize_rejects_invalid_apk(self):
         # overwrite APK file with rubbish
         self.apk.file.delete()
@@ -232,6 +521,24 @@ class ApkTestCase(RmTestCase):
         with self.assertRaises(ValidationError):
             self.apk.initialize()
 
+    @patch('repomaker.models.apk.scan_apks')
+    def test_scan_files_does_not_hold_fdroidserver_lock(self, scan_apks):
+        def is_lock_free(paths):
+            # the lock is reentrant, so try to acquire it from another thread
+            result = []
+
+            def try_lock():
+                result.append(FDROIDSERVER_LOCK.acquire(blocking=False))
+                if result[0]:
+                    FDROIDSERVER_LOCK.release()
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+            return [result[0]] * len(paths)
+        scan_apks.side_effect = is_lock_free
+
+        self.assertEqual({self.apk.pk: True}, Apk.scan_files([self.apk]))
+
     @patch('fdroidserver.scan_apk')
     def test_initialize_rejects_invalid_apk_scan(self, scan_apk):
         scan_apk.side_effect = BuildException
@@ -273,6 +580,60 @@ class ApkTestCase(RmTestCase):
                          self.apk.hash)
         self.assertEqual('sha256', self.apk.hash_type)
 
+    def test_initialize_stores_file_by_hash(self):
+        self.replace_apk_file(os.path.join(settings.TEST_FILES_DIR, 'test.png'), 'test.png')
+        old_path = self.apk.file.path
+
+        self.apk.initialize()
+
+        # assert that the file was moved to the content-addressed store
+        self.assertEqual(get_blob_path(self.apk.hash, 'test.png'), self.apk.file.name)
+        self.assertEqual(self.apk.file.name, Apk.objects.get(pk=self.apk.pk).file.name)
+        self.assertTrue(os.path.isfile(self.apk.file.path))
+        self.assertFalse(os.path.exists(old_path))
+
+    def test_initialize_reuses_stored_file_with_other_name(self):
+        self.replace_apk_file(os.path.join(settings.TEST_FILES_DIR, 'test.png'), 'test.png')
+        self.apk.initialize()
+
+        # add the same content again under a different name
+        other_apk = Apk.objects.create()
+        with open(os.path.join(settings.TEST_FILES_DIR, 'test.png'), 'rb') as f:
+            other_apk.file.save('other.png', File(f), save=True)
+        old_path = other_apk.file.path
+        other_apk = other_apk.initialize()
+
+        # assert that the content is stored only once
+        self.assertEqual(get_blob_path(self.apk.hash, 'test.png'), other_apk.file.name)
+        self.assertEqual(['test.png'], os.listdir(os.path.dirname(self.apk.file.path)))
+        self.assertFalse(os.path.exists(old_path))
+
+    def test_delete_keeps_shared_blob(self):
+        self.replace_apk_file(os.path.join(settings.TEST_FILES_DIR, 'test.png'), 'test.png')
+        self.apk.initialize()
+        other_apk = Apk.objects.create(package_id='other', file=self.apk.file.name)
+
+        # assert that the file is only removed together with the last Apk using it
+        path = other_apk.file.path
+        self.apk.delete()
+        self.assertTrue(os.path.isfile(path))
+        other_apk.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_analyze_file(self):
+        path = os.path.join(settings.TEST_FILES_DIR, 'test.png')
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        file_hash, size, head = analyze_file(path, head_size=100)
+
+        # assert that everything was computed from the same pass through the file
+        self.assertEqual(sha256(content).hexdigest(), file_hash)
+        self.assertEqual(len(content), size)
+        self.assertEqual(content[:100], head)
+        self.assertEqual(content, analyze_file(path)[2])
+        self.assertEqual(file_hash, sha256sum(path))
+
     def test_initialize_standard_file_name(self):
         # overwrite APK file with image that has standard file name
         self.replace_apk_file(os.path.join(settings.TEST_FILES_DIR, 'test.png'),
@@ -410,6 +771,38 @@ class ApkTestCase(RmTestCase):
         self.assertFalse(apk.is_downloading)
         self.assertFalse(apk.pk)
 
+    def test_scan_result(self):
+        self.apk.hash = 'hash'
+        self.apk.set_scan_result({
+            'hash': 'hash',
+            'packageName': 'org.example',
+            'antiFeatures': {'KnownVuln'},
+            'apkName': 'org.example_1.apk',
+            'added': datetime.now(),
+        })
+        self.apk.save()
+
+        # assert that scan result is restored without repository specific information
+        scan_result = Apk.objects.get(pk=self.apk.pk).get_scan_result()
+        self.assertEqual({'hash': 'hash', 'packageName': 'org.example',
+                          'antiFeatures': {'KnownVuln'}}, scan_result)
+
+    def test_scan_result_outdated(self):
+        self.assertIsNone(self.apk.get_scan_result())
+
+        # assert that scan result of a different file is ignored
+        self.apk.hash = 'hash'
+        self.apk.set_scan_result({'hash': 'other hash'})
+        self.assertIsNone(self.apk.get_scan_result())
+
+        # assert that scan result of a different metadata version is ignored
+        self.apk.scan_cache = '{"METADATA_VERSION": 0, "apk": {"hash": "hash"}}'
+        self.assertIsNone(self.apk.get_scan_result())
+
+        # assert that broken scan results are ignored
+        self.apk.scan_cache = 'foo'
+        self.assertIsNone(self.apk.get_scan_result())
+
     def test_apk_file_gets_deleted(self):
         # get APK and assert that file exists
         path = self.apk.file.path
@@ -9,7 +9,7 @@ from django.test import TestCase
 from django.utils import timezone
 from fdroidserver.update import get_all_icon_dirs
 from repomaker.models import Apk, ApkPointer, RemoteApkPointer, App, RemoteApp, RemoteRepository
-from repomaker.storage import get_apk_file_path
+from repomaker.storage import get_blob_path
 
 from .. import fake_repo_create, RmTestCase
 
@@ -44,8 +44,8 @@ class ApkPointerTestCase(RmTestCase):
     def test_initialize(self):
         self.apk.initialize(self.repo)  # this calls self.apk_pointer.initialize()
 
-        # assert that global APK file has been linked/copied properly
-        self.assertEqual(get_apk_file_path(self.apk, self.apk_file_name), self.apk.file.name)
+        # assert that global APK file has been moved to the content-addressed store
+        self.assertEqual(get_blob_path(self.apk.hash, self.apk_file_name), self.apk.file.name)
         self.assertTrue(os.path.isfile(os.path.join(settings.MEDIA_ROOT, self.apk.file.name)))
 
         # get the created Apk object and assert that it has been created properly
@@ -141,6 +141,19 @@ class ApkPointerTestCase(RmTestCase):
         self.assertTrue(self.apk_pointer.file)
         self.assertTrue(os.path.isfile(self.apk_pointer.file.path))
 
+    def test_link_file_from_apk_keeps_file_of_other_pointer(self):
+        # add a pointer for another apk with the same file name as the existing pointer
+        apk = Apk.objects.create()
+        apk.file.save(self.apk_file_name, BytesIO(b'foo'), save=True)
+        apk_pointer = ApkPointer.objects.create(repo=self.repo, apk=apk)
+        apk_pointer.link_file_from_apk()
+
+        # assert that the new pointer got its own file and the existing one was kept
+        self.assertNotEqual(self.apk_pointer.file.name, apk_pointer.file.name)
+        self.assertTrue(os.path.samefile(apk.file.path, apk_pointer.file.path))
+        with open(self.apk_pointer.file.path, 'rb') as f:
+            self.assertNotEqual(b'foo', f.read())
+
     def test_link_file_from_apk_only_when_no_file(self):
         file_path = self.apk_pointer.file.path
         self.assertTrue(os.path.isfile(file_path))
@@ -138,7 +138,7 @@ class AppTestCase(RmTestCase):
         # default translation should not be included since it is empty
         self.assertFalse(settings.LANGUAGE_CODE in localized)
 
-    @patch('fdroidserver.net.http_get')
+    @patch('repomaker.downloads.http_get')
     def test_download_graphic_assets_from_remote_app(self, http_get):
         app = self.app
         remote_app = self.remote_app
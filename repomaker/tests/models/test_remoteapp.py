@@ -89,7 +89,7 @@ class RemoteAppTestCase(RmTestCase):
         self.assertEqual('bar2', self.app.description)  # <script> tag was removed
         self.assertEqual('bar', self.app.description_override)  # <script> tag was removed
 
-    @patch('fdroidserver.net.http_get')
+    @patch('repomaker.downloads.http_get')
     @patch('repomaker.models.app.App.update_icon')
     def test_update_icon(self, update_icon, http_get):
         # set initial etag and icon for app
@@ -227,11 +227,11 @@ class RemoteAppTestCase(RmTestCase):
         self.assertEqual('http://repo_url/org.example/en-US/phoneScreenshots/test2',
                          screenshots[1].url)
 
-    @patch('repomaker.tasks.download_remote_screenshot')
+    @patch('repomaker.tasks.download_remote_screenshots')
     @patch('repomaker.tasks.download_remote_graphic_assets')
     @patch('repomaker.models.apk.Apk.download_async')
     def test_add_to_repo(self, download_async, download_remote_graphic_assets,
-                         download_remote_screenshot):
+                         download_remote_screenshots):
         # create pre-requisites
         self.app.icon.save('test.png', io.BytesIO(b'foo'))
         repo = Repository.objects.create(name='test', user=User.objects.create(username='user2'))
@@ -257,7 +257,7 @@ class RemoteAppTestCase(RmTestCase):
         # assert that all asynchronous tasks have been scheduled
         download_async.assert_called_once_with(remote_apk_pointer.url)
         download_remote_graphic_assets.assert_called_once_with(app.id, self.app.id)
-        download_remote_screenshot.assert_called_once_with(remote_screenshot.pk, self.app.pk)
+        download_remote_screenshots.assert_called_once_with([remote_screenshot.pk], app.pk)
 
     def test_add_to_repo_without_apks(self):
         # create pre-requisites
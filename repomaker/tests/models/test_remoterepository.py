@@ -1,19 +1,25 @@
-from datetime import datetime, timezone
+import json
+import tempfile
+from datetime import datetime, timedelta, timezone
 from unittest.mock import Mock, patch
 
 import background_task
 import os
-import requests
 from background_task.tasks import Task
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.test import override_settings
+from django.utils import timezone as django_timezone
 from requests.exceptions import HTTPError
 
+from repomaker.downloads import DeadlineExceeded
 from repomaker.models import App, Apk, ApkPointer, RemoteApkPointer, RemoteApp, Repository, \
-    RemoteRepository
+    RemoteRepository, RemoteScreenshot
 from repomaker.models.repository import AbstractRepository
+from repomaker.remoteindex import RepoIndex
 from repomaker.storage import get_remote_repo_path
 from repomaker.tasks import PRIORITY_REMOTE_REPO
+from repomaker.utils import QueryCounter
 from .. import RmTestCase
 
 
@@ -31,6 +37,15 @@ class RemoteRepositoryTestCase(RmTestCase):
         with self.assertRaises(NotImplementedError):
             AbstractRepository().get_repo_path()
 
+    def test_get_mirror_urls(self):
+        self.assertEqual(['https://f-droid.org/repo'], self.remote_repo.get_mirror_urls())
+
+        # assert that duplicates and onion services are skipped
+        self.remote_repo.mirrors = '["https://f-droid.org/repo", "https://mirror.example.org/", ' \
+                                   '"http://example.onion/fdroid/repo"]'
+        self.assertEqual(['https://f-droid.org/repo', 'https://mirror.example.org'],
+                         self.remote_repo.get_mirror_urls())
+
     def test_initial_update(self):
         """
         Makes sure that pre-installed remote repositories will be updated on first start.
@@ -48,10 +63,73 @@ class RemoteRepositoryTestCase(RmTestCase):
         self.remote_repo.update_scheduled = False
 
         self.remote_repo.update_async()
-        update_remote_repo.assert_called_once_with(self.remote_repo.id, repeat=Task.DAILY,
+        update_remote_repo.assert_called_once_with(self.remote_repo.id,
                                                    priority=PRIORITY_REMOTE_REPO)
         self.assertTrue(self.remote_repo.update_scheduled)
 
+    @override_settings(REMOTE_UPDATE_INTERVAL=1000, REMOTE_UPDATE_MIN_INTERVAL=100,
+                       REMOTE_UPDATE_MAX_INTERVAL=10000)
+    def test_adapt_update_interval(self):
+        date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.remote_repo.last_change_date = date
+
+        # assert that the interval grows while the repository does not change
+        self.remote_repo.adapt_update_interval(date)
+        self.assertEqual(1500, self.remote_repo.update_interval)
+        self.remote_repo.adapt_update_interval(date)
+        self.assertEqual(2250, self.remote_repo.update_interval)
+
+        # assert that the interval becomes half the time between changes
+        self.remote_repo.last_change_date = date + timedelta(seconds=750)
+        self.remote_repo.adapt_update_interval(date)
+        self.assertEqual(750, self.remote_repo.change_interval)
+        self.assertEqual(375, self.remote_repo.update_interval)
+
+        # assert that a single longer time between changes only moves the average towards it
+        date = self.remote_repo.last_change_date
+        self.remote_repo.last_change_date = date + timedelta(seconds=1750)
+        self.remote_repo.adapt_update_interval(date)
+        self.assertEqual(1050, self.remote_repo.change_interval)
+        self.assertEqual(525, self.remote_repo.update_interval)
+
+        # assert that the first change halves the interval
+        self.remote_repo.adapt_update_interval(datetime.fromtimestamp(0, timezone.utc))
+        self.assertEqual(1050, self.remote_repo.change_interval)
+        self.assertEqual(262, self.remote_repo.update_interval)
+
+        # assert that the interval stays within the bounds of the repository
+        self.remote_repo.min_update_interval = 1000
+        self.remote_repo.adapt_update_interval(date)
+        self.assertEqual(1000, self.remote_repo.update_interval)
+        for _ in range(20):
+            self.remote_repo.adapt_update_interval(self.remote_repo.last_change_date)
+        self.assertEqual(10000, self.remote_repo.update_interval)
+        self.remote_repo.max_update_interval = 5000
+        self.remote_repo.adapt_update_interval(self.remote_repo.last_change_date)
+        self.assertEqual(5000, self.remote_repo.update_interval)
+
+    @override_settings(REMOTE_UPDATE_JITTER=0.1)
+    def test_schedule_update(self):
+        Task.objects.all().delete()
+        self.remote_repo.update_interval = 1000
+        self.remote_repo.schedule_update()
+        self.remote_repo.update_scheduled = False
+        self.remote_repo.update_async()  # requested meanwhile
+        self.remote_repo.schedule_update()
+
+        # assert that only the latest scheduled update and the requested update are left
+        tasks = Task.objects.filter(task_name='repomaker.tasks.update_remote_repo') \
+            .order_by('run_at')
+        self.assertEqual(2, len(tasks))
+        self.assertTrue(tasks[0].run_at <= django_timezone.now())
+        self.assertEqual(self.remote_repo.next_update_date, tasks[1].run_at)
+
+        # assert that the update was scheduled within the jitter
+        delay = (tasks[1].run_at - django_timezone.now()).total_seconds()
+        self.assertTrue(890 <= delay <= 1100, delay)
+        self.assertEqual(self.remote_repo.next_update_date,
+                         RemoteRepository.objects.get(pk=1).next_update_date)
+
     @patch('repomaker.tasks.update_remote_repo')
     def test_update_async_not_called_when_update_scheduled(self, update_remote_repo):
         """
@@ -63,7 +141,7 @@ class RemoteRepositoryTestCase(RmTestCase):
         self.assertFalse(update_remote_repo.called)
 
     @patch('repomaker.models.remoterepository.RemoteRepository._update_apps')
-    @patch('fdroidserver.index.download_repo_index')
+    @patch('repomaker.remoteindex.download_repo_index')
     def test_update_index_only_when_new(self, download_repo_index, _update_apps):
         """
         Test that a remote repository is only updated when the index changed since last time.
@@ -73,27 +151,31 @@ class RemoteRepositoryTestCase(RmTestCase):
         }, 'etag'
         self.remote_repo.last_change_date = datetime.now(tz=timezone.utc)
         self.remote_repo.update_index(update_apps=True)
-        download_repo_index.assert_called_once_with(self.remote_repo.get_fingerprint_url(),
-                                                    etag=None)
+        download_repo_index.assert_called_once_with(
+            self.remote_repo.get_fingerprint_url(), etag=None,
+            last_index_path=self.remote_repo.get_index_path(),
+            mirror_urls=self.remote_repo.get_mirror_urls())
         self.assertNotEqual('Test Name', self.remote_repo.name)
         self.assertFalse(_update_apps.called)
 
     @patch('repomaker.models.remoterepository.RemoteRepository._update_apps')
-    @patch('fdroidserver.index.download_repo_index')
+    @patch('repomaker.remoteindex.download_repo_index')
     def test_update_index_only_when_not_none(self, download_repo_index, _update_apps):
         """
         Test that a remote repository is only updated when the index changed since last time.
         """
         download_repo_index.return_value = None, 'etag'
         self.remote_repo.update_index(update_apps=True)
-        download_repo_index.assert_called_once_with(self.remote_repo.get_fingerprint_url(),
-                                                    etag=None)
+        download_repo_index.assert_called_once_with(
+            self.remote_repo.get_fingerprint_url(), etag=None,
+            last_index_path=self.remote_repo.get_index_path(),
+            mirror_urls=self.remote_repo.get_mirror_urls())
         self.assertFalse(_update_apps.called)
 
-    @patch('requests.get')
+    @patch('repomaker.downloads.http_get')
     @patch('repomaker.models.remoterepository.RemoteRepository._update_apps')
-    @patch('fdroidserver.index.download_repo_index')
-    def test_update_index(self, download_repo_index, _update_apps, get):
+    @patch('repomaker.remoteindex.download_repo_index')
+    def test_update_index(self, download_repo_index, _update_apps, http_get):
         """
         Test that a remote repository is updated and a new icon is downloaded.
         """
@@ -113,31 +195,33 @@ class RemoteRepositoryTestCase(RmTestCase):
             'packages': [],
         }, 'etag'
         # fake return value of GET request for repository icon
-        get.return_value.status_code = requests.codes.ok
-        get.return_value.content = b'foo'
+        http_get.return_value = b'foo', 'etag'
 
         # update index and ensure it would have been downloaded
         repo = self.remote_repo
         repo.update_index(update_apps=True)
-        download_repo_index.assert_called_once_with(repo.get_fingerprint_url(), etag=None)
+        download_repo_index.assert_called_once_with(repo.get_fingerprint_url(), etag=None,
+                                                    last_index_path=repo.get_index_path(),
+                                                    mirror_urls=['https://f-droid.org/repo'])
 
         # assert that the repository metadata was updated with the information from the index
         self.assertEqual('Test Name', repo.name)
         self.assertEqual('Test Description', repo.description)
         self.assertEqual('["mirror1", "mirror2"]', repo.mirrors)
 
-        # assert that new repository icon was downloaded and changed
-        get.assert_called_once_with(repo.url + '/icons/' + 'test-icon.png',
-                                    headers={'User-Agent': 'F-Droid'},
-                                    timeout=600)
+        # assert that new repository icon was downloaded from one of the mirrors and changed
+        self.assertEqual(1, http_get.call_count)
+        self.assertIn(http_get.call_args[0][0],
+                      [url + '/icons/test-icon.png' for url in repo.get_mirror_urls()])
+        self.assertIsNone(http_get.call_args[0][1])
         self.assertEqual(os.path.join(get_remote_repo_path(repo), 'test-icon.png'), repo.icon.name)
 
         # assert that an attempt was made to update the apps
         self.assertTrue(_update_apps.called)
 
-    @patch('repomaker.models.remoteapp.RemoteApp.update_from_json')
-    @patch('fdroidserver.index.download_repo_index')
-    def test_update_index_retry_when_failed(self, download_repo_index, update_from_json):
+    @patch('repomaker.models.remoteapp.RemoteApp.apply_json')
+    @patch('repomaker.remoteindex.download_repo_index')
+    def test_update_index_retry_when_failed(self, download_repo_index, apply_json):
         """
         Test that a remote repository is only updated when the index changed since last time.
         """
@@ -160,18 +244,49 @@ class RemoteRepositoryTestCase(RmTestCase):
             },
         }
         download_repo_index.return_value = index, 'etag'
-        update_from_json.side_effect = HTTPError(Mock(status=502))
+        apply_json.side_effect = HTTPError(Mock(status=502))
 
         with self.assertRaises(HTTPError):
             self.remote_repo.update_index(update_apps=True)
-        download_repo_index.assert_called_once_with(self.remote_repo.get_fingerprint_url(),
-                                                    etag=None)
+        download_repo_index.assert_called_once_with(
+            self.remote_repo.get_fingerprint_url(), etag=None,
+            last_index_path=self.remote_repo.get_index_path(),
+            mirror_urls=self.remote_repo.get_mirror_urls())
 
-        update_from_json.assert_called_once_with(index['apps'][0])
+        apply_json.assert_called_once_with(index['apps'][0])
         self.assertEqual(datetime.fromtimestamp(0, timezone.utc), self.remote_repo.last_change_date)
         self.assertIsNone(self.remote_repo.index_etag)
 
-    @patch('fdroidserver.net.http_get')
+    @patch('repomaker.models.remoteapp.RemoteApp.apply_json')
+    @patch('repomaker.remoteindex.download_repo_index')
+    def test_update_index_closes_index(self, download_repo_index, apply_json):
+        index = {
+            'repo': {'name': 'Test Name', 'description': 'Test Description',
+                     'timestamp': datetime.utcnow().timestamp() * 1000},
+            'apps': [{'packageName': 'org.example', 'name': 'test app',
+                      'lastUpdated': datetime.utcnow().timestamp() * 1000}],
+            'packages': {'org.example': []},
+        }
+        files = []
+
+        def get_repo_index(*_args, **_kwargs):
+            files.append(tempfile.TemporaryFile())
+            files[-1].write(json.dumps(index).encode('utf-8'))
+            return RepoIndex(files[-1]), 'etag'
+        download_repo_index.side_effect = get_repo_index
+
+        # assert that the temporary file of the index is closed when the update fails
+        apply_json.side_effect = HTTPError(Mock(status=502))
+        with self.assertRaises(HTTPError):
+            self.remote_repo.update_index(update_apps=True)
+        self.assertTrue(files[0].closed)
+
+        # assert that it is closed after a successful update as well
+        with patch('repomaker.models.remoterepository.RemoteRepository._update_apps'):
+            self.remote_repo.update_index(update_apps=True)
+        self.assertTrue(files[1].closed)
+
+    @patch('repomaker.downloads.http_get')
     def test_update_icon_without_pk(self, http_get):
         # create unsaved repo without primary key
         repo = RemoteRepository(url='http://test', last_change_date=datetime.now(tz=timezone.utc))
@@ -186,7 +301,7 @@ class RemoteRepositoryTestCase(RmTestCase):
         self.assertFalse('None' in repo.icon.name)
         self.assertTrue(str(repo.pk) in repo.icon.name)
 
-    @patch('fdroidserver.index.download_repo_index')
+    @patch('repomaker.remoteindex.download_repo_index')
     def test_fail(self, download_repo_index):
         # assert that pre-installed remote repository is initially enabled
         self.assertFalse(self.remote_repo.disabled)
@@ -307,6 +422,140 @@ class RemoteRepositoryTestCase(RmTestCase):
         self.assertEqual(apps[0]['authorName'], app.author_name)
         self.assertEqual(apps[0]['webSite'], app.website)
 
+    @override_settings(REMOTE_SYNC_CHUNK_SIZE=50)
+    def test_update_apps_with_bounded_queries(self):
+        last_updated = datetime.utcnow().timestamp() * 1000
+        apps = []
+        packages = dict()
+        for i in range(120):
+            package_name = 'org.example.app%d' % i
+            apps.append({
+                'packageName': package_name,
+                'name': 'App %d' % i,
+                'lastUpdated': last_updated,
+                'categories': ['Games', 'Internet', 'Unknown'],
+                'localized': {'en-US': {'summary': 'Summary %d' % i,
+                                        'phoneScreenshots': ['1.png', '2.png']}},
+                'icon': package_name + '.png',
+            })
+            packages[package_name] = [{
+                'packageName': package_name,
+                'apkName': '%s.%d.apk' % (package_name, version_code),
+                'hash': 'hash%d.%d' % (i, version_code),
+                'hashType': 'sha256',
+                'versionCode': version_code,
+                'versionName': str(version_code),
+                'size': 42,
+            } for version_code in [1, 2]]
+        Task.objects.all().delete()
+
+        with QueryCounter() as counter:
+            self.remote_repo._update_apps(apps, packages)  # pylint: disable=protected-access
+
+        # assert that the number of queries only depends on the number of chunks
+        self.assertLess(counter.count, 3 * 25)
+
+        # assert that everything was saved
+        self.assertEqual(120, RemoteApp.objects.filter(repo=self.remote_repo).count())
+        remote_app = RemoteApp.objects.get(package_id='org.example.app7')
+        self.assertEqual('Summary 7', remote_app.summary)
+        self.assertEqual({'Games', 'Internet'}, {c.name for c in remote_app.category.all()})
+        self.assertEqual(2, RemoteScreenshot.objects.filter(app=remote_app).count())
+        self.assertEqual(240, Apk.objects.count())
+        self.assertEqual([2, 1], [p.apk.version_code for p in RemoteApkPointer.objects.filter(
+            app=remote_app).order_by('-apk__version_code')])
+        self.assertEqual(self.remote_repo.url + '/org.example.app7.2.apk',
+                         remote_app.get_latest_apk_pointer().url)
+
+        # assert that there is one task for the icons of each chunk
+        self.assertEqual(3, Task.objects.filter(
+            task_name='repomaker.tasks.update_remote_app_icons').count())
+
+        # assert that nothing is saved again when the apps did not change
+        with QueryCounter() as counter:
+            self.remote_repo._update_apps(apps, packages)  # pylint: disable=protected-access
+        self.assertEqual(2, counter.count)
+
+    def test_update_apps_removed(self):
+        last_updated = self.remote_repo.last_updated_date
+        RemoteApp.objects.create(repo=self.remote_repo, package_id='org.example.removed',
+                                 last_updated_date=last_updated)
+        RemoteApp.objects.create(repo=self.remote_repo, package_id='org.example.unchanged',
+                                 last_updated_date=last_updated)
+        apps = [{'packageName': 'org.example.new', 'name': 'New',
+                 'lastUpdated': datetime.utcnow().timestamp() * 1000}]
+
+        # pylint: disable=protected-access
+        self.remote_repo._update_apps(apps, {'org.example.new': []}, ['org.example.removed'])
+
+        # assert that only the removed app was removed, even though the other is not in the apps
+        self.assertEqual({'org.example.new', 'org.example.unchanged'},
+                         {app.package_id for app in RemoteApp.objects.all()})
+
+    @override_settings(REMOTE_SYNC_CHUNK_SIZE=2)
+    @patch('repomaker.downloads.check_deadline')
+    def test_update_apps_stops_at_deadline(self, check_deadline):
+        last_updated = datetime.utcnow().timestamp() * 1000
+        apps = [{'packageName': 'org.example.app%d' % i, 'name': 'App %d' % i,
+                 'lastUpdated': last_updated} for i in range(5)]
+        packages = {app['packageName']: [] for app in apps}
+        index_date = datetime.now(tz=timezone.utc)
+
+        # the deadline passes while the fourth app gets parsed
+        check_deadline.side_effect = [None, None, None, DeadlineExceeded()]
+        with self.assertRaises(DeadlineExceeded):
+            # pylint: disable=protected-access
+            self.remote_repo._update_apps(apps, packages, index_date=index_date)
+
+        # assert that only the first chunk was saved, so the next update resumes after it
+        self.assertEqual({'org.example.app0', 'org.example.app1'},
+                         {app.package_id for app in RemoteApp.objects.all()})
+        self.remote_repo = RemoteRepository.objects.get(pk=self.remote_repo.pk)
+        self.assertEqual('org.example.app1', self.remote_repo.sync_checkpoint_package)
+
+    @override_settings(REMOTE_SYNC_CHUNK_SIZE=2)
+    def test_update_apps_resumes_after_checkpoint(self):
+        last_updated = datetime.utcnow().timestamp() * 1000
+        apps = [{'packageName': 'org.example.app%d' % i, 'name': 'App %d' % i,
+                 'lastUpdated': last_updated} for i in range(5)]
+        packages = {app['packageName']: [] for app in apps}
+        index_date = datetime.now(tz=timezone.utc)
+        save_apps = RemoteRepository._save_apps  # pylint: disable=protected-access
+
+        # fail while saving the second chunk of apps
+        def fail_second_chunk(*args):
+            if RemoteApp.objects.exists():
+                raise HTTPError()
+            save_apps(*args)
+
+        with patch('repomaker.models.remoterepository.RemoteRepository._save_apps',
+                   autospec=True, side_effect=fail_second_chunk):
+            with self.assertRaises(HTTPError):
+                # pylint: disable=protected-access
+                self.remote_repo._update_apps(apps, packages, index_date=index_date)
+
+        # assert that the first chunk was kept together with its checkpoint
+        self.assertEqual({'org.example.app0', 'org.example.app1'},
+                         {app.package_id for app in RemoteApp.objects.all()})
+        self.remote_repo = RemoteRepository.objects.get(pk=self.remote_repo.pk)
+        self.assertEqual('org.example.app1', self.remote_repo.sync_checkpoint_package)
+        self.assertEqual(index_date, self.remote_repo.sync_checkpoint_date)
+
+        # assert that the next update of the same index resumes after the checkpoint
+        with patch('repomaker.models.remoteapp.RemoteApp.apply_json', autospec=True,
+                   side_effect=RemoteApp.apply_json) as apply_json:
+            # pylint: disable=protected-access
+            self.remote_repo._update_apps(apps, packages, index_date=index_date)
+        self.assertEqual(apps[2:], [call[0][1] for call in apply_json.call_args_list])
+        self.assertEqual(5, RemoteApp.objects.count())
+
+        # assert that an update of another index does not skip any apps
+        with patch('repomaker.models.remoteapp.RemoteApp.apply_json', autospec=True,
+                   side_effect=RemoteApp.apply_json) as apply_json:
+            # pylint: disable=protected-access
+            self.remote_repo._update_apps(apps, packages, index_date=datetime.now(tz=timezone.utc))
+        self.assertEqual(5, apply_json.call_count)
+
     def test_remove_old_apps(self):
         RemoteApp.objects.create(repo=self.remote_repo, package_id="delete",
                                  last_updated_date=self.remote_repo.last_updated_date)
@@ -1,6 +1,9 @@
 import io
 import json
 import os
+import pickle
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from unittest.mock import patch
 
@@ -8,21 +11,43 @@ import sass_processor.processor
 import sass_processor.storage
 from background_task.models import Task
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core.files import File
+from django.db import connection
+from django.test import TransactionTestCase
 from django.templatetags.static import static
 from django.urls import reverse
 from django.utils import translation
+import fdroidserver.signindex
+import fdroidserver.update
 from fdroidserver.update import METADATA_VERSION
 from repomaker.models import App, RemoteApp, Apk, ApkPointer, RemoteApkPointer, Repository, \
-    RemoteRepository, S3Storage, SshStorage, GitStorage
+    RemoteRepository, RepositoryChange, S3Storage, SshStorage, GitStorage, Category, Screenshot
+from repomaker.models.apk import sha256sum
 from repomaker.models.app import VIDEO, APK
 from repomaker.models.repository import REPO_DEFAULT_ICON
 from repomaker.storage import get_repo_file_path, REPO_DIR
 from repomaker.tasks import PRIORITY_REPO
+from repomaker.utils import PhaseTimer
 
 from .. import datetime_is_recent, fake_repo_create, RmTestCase
 
 
+def add_file_app(repo, package_id, name, file_name):
+    """
+    Adds a new app with the given test file to the given repository.
+    """
+    app = App.objects.create(repo=repo, package_id=package_id, name=name, type=VIDEO)
+    apk = Apk.objects.create(package_id=package_id, version_code=1, hash_type='sha256')
+    with open(os.path.join(settings.TEST_FILES_DIR, file_name), 'rb') as f:
+        apk.file.save(file_name, File(f), save=False)
+    apk.hash = sha256sum(apk.file.path)
+    apk.save()
+    pointer = ApkPointer.objects.create(repo=repo, app=app, apk=apk)
+    pointer.link_file_from_apk()
+    return app
+
+
 class RepositoryTestCase(RmTestCase):
 
     @patch('repomaker.models.repository.Repository._generate_page')
@@ -162,6 +187,23 @@ class RepositoryTestCase(RmTestCase):
         self.assertTrue(os.path.getsize(self.repo.qrcode.path) > 100)
         self.assertEqual('qrcode.png', os.path.basename(self.repo.qrcode.name))
 
+    def test_generate_qrcode_keeps_unchanged_file(self):
+        self.repo._generate_qrcode()  # pylint: disable=protected-access
+        os.utime(self.repo.qrcode.path, (0, 0))
+
+        # assert that the file is not touched if the URL did not change
+        self.repo._generate_qrcode()  # pylint: disable=protected-access
+        self.assertEqual(0, os.path.getmtime(self.repo.qrcode.path))
+
+        # assert that the file is updated when the URL changes
+        with open(self.repo.qrcode.path, 'rb') as f:
+            old_qrcode = f.read()
+        self.repo.url = 'https://example.com'
+        self.repo._generate_qrcode()  # pylint: disable=protected-access
+        self.assertNotEqual(0, os.path.getmtime(self.repo.qrcode.path))
+        with open(self.repo.qrcode.path, 'rb') as f:
+            self.assertNotEqual(old_qrcode, f.read())
+
     def test_generate_qrcode_without_url(self):
         self.assertFalse(self.repo.qrcode)  # no QR code exists
         self.repo.url = None  # remove repo URL
@@ -209,18 +251,40 @@ class RepositoryTestCase(RmTestCase):
         Makes sure that the asynchronous update starts a background task.
         """
         self.repo.update_async()
-        update_repo.assert_called_once_with(self.repo.id, priority=PRIORITY_REPO)
+        update_repo.assert_called_once_with(self.repo.id, priority=PRIORITY_REPO,
+                                            schedule=settings.REPO_UPDATE_QUIET_PERIOD)
         self.assertTrue(self.repo.update_scheduled)
 
+        # assert that the scheduling state was saved
+        repo = Repository.objects.get(pk=self.repo.pk)
+        self.assertTrue(repo.update_scheduled)
+        self.assertEqual(self.repo.update_requested_date, repo.update_requested_date)
+
     @patch('repomaker.tasks.update_repo')
     def test_update_async_not_when_scheduled(self, update_remote_repo):
         """
         Makes sure that the asynchronous update does not start a second background task.
         """
         self.repo.update_scheduled = True
+        self.repo.save()
         self.repo.update_async()
         self.assertFalse(update_remote_repo.called)
 
+        # assert that the request was still recorded to extend the quiet period
+        repo = Repository.objects.get(pk=self.repo.pk)
+        self.assertIsNotNone(repo.update_requested_date)
+
+    @patch('repomaker.tasks.update_repo')
+    def test_update_async_stale_instance(self, update_repo):
+        """
+        Makes sure that an outdated instance does not prevent scheduling a new update.
+        """
+        stale_repo = Repository.objects.get(pk=self.repo.pk)
+        stale_repo.update_scheduled = True  # the update task started and reset this already
+
+        stale_repo.update_async()
+        self.assertTrue(update_repo.called)
+
     @patch('repomaker.models.repository.Repository._generate_page')
     def test_empty_repository_update(self, _generate_page):
         repo = self.repo
@@ -255,6 +319,165 @@ class RepositoryTestCase(RmTestCase):
         # assert that repository homepage was re-created
         _generate_page.called_once_with()
 
+    def _add_file_app(self, package_id, name, file_name):
+        return add_file_app(self.repo, package_id, name, file_name)
+
+    @patch('fdroidserver.update.scan_repo_files')
+    @patch('fdroidserver.make_index')
+    @patch('repomaker.models.repository.Repository._generate_page')
+    def test_incremental_update(self, _generate_page, make_index, scan_repo_files):
+        scan_repo_files.return_value = [], False
+        app = self._add_file_app('first', 'First', 'test.mp4')
+
+        # a first incremental update falls back to a full update
+        self.repo.update(incremental=True)
+        self.assertEqual(1, scan_repo_files.call_count)
+        self.assertEqual(0, RepositoryChange.objects.filter(repo=self.repo).count())
+
+        # change the existing app and add a new one
+        app.name = 'First Changed'
+        app.save()
+        self._add_file_app('second', 'Second', 'test.ogg')
+        self.assertEqual({'first', 'second'}, RepositoryChange.get_changes(self.repo)[0])
+
+        # update incrementally and assert that the repository directory was not scanned again
+        self.repo.update(incremental=True)
+        self.assertEqual(1, scan_repo_files.call_count)
+        self.assertEqual(0, RepositoryChange.objects.filter(repo=self.repo).count())
+
+        # assert that both apps with their latest metadata went into the index
+        apps, apks = make_index.call_args[0][0], make_index.call_args[0][1]
+        self.assertEqual({'first', 'second'}, set(apps.keys()))
+        self.assertEqual('First Changed', apps['first'].Name)
+        self.assertEqual({'test.mp4', 'test.ogg'}, {apk['apkName'] for apk in apks})
+
+        # an update without changes re-uses everything from the last update
+        self.repo.update(incremental=True)
+        self.assertEqual(1, scan_repo_files.call_count)
+        self.assertEqual({'first', 'second'}, set(make_index.call_args[0][0].keys()))
+
+    def test_read_update_state_ignores_unreadable_state(self):
+        path = self.repo._get_update_state_path()  # pylint: disable=protected-access
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # a truncated state
+        with open(path, 'wb') as f:
+            f.write(pickle.dumps({'apps': 1})[:5])
+        self.assertIsNone(self.repo._read_update_state())  # pylint: disable=protected-access
+
+        # a state that refers to a module that does not exist anymore
+        with open(path, 'wb') as f:
+            f.write(b'crepomaker.gone\nState\n.')
+        self.assertIsNone(self.repo._read_update_state())  # pylint: disable=protected-access
+
+        # a state that refers to a class that does not exist anymore
+        with open(path, 'wb') as f:
+            f.write(b'crepomaker.storage\nGone\n.')
+        self.assertIsNone(self.repo._read_update_state())  # pylint: disable=protected-access
+
+    @patch('fdroidserver.make_index')
+    @patch('repomaker.models.repository.Repository._generate_page')
+    def test_incremental_update_removes_deleted_app(self, _generate_page, make_index):
+        self._add_file_app('first', 'First', 'test.mp4')
+        app = self._add_file_app('second', 'Second', 'test.ogg')
+        self.repo.update()
+
+        app.delete()
+        self.repo.update(incremental=True)
+
+        self.assertEqual({'first'}, set(make_index.call_args[0][0].keys()))
+        self.assertEqual(['test.mp4'], [apk['apkName'] for apk in make_index.call_args[0][1]])
+
+    @patch('fdroidserver.make_index')
+    @patch('repomaker.models.repository.Repository._generate_page')
+    def test_update_query_count(self, _generate_page, make_index):
+        app = self._add_file_app('first', 'First', 'test.mp4')
+        app.category.add(Category.objects.get(name='Games'))
+        Screenshot.objects.create(app=app, file='first/en/phone/1.png')
+        query_count = self.repo.update()
+
+        # add another app with categories, screenshots and translations
+        app = self._add_file_app('second', 'Second', 'test.ogg')
+        app.category.add(Category.objects.get(name='Games'), Category.objects.get(name='Writing'))
+        Screenshot.objects.create(app=app, file='second/en/phone/1.png')
+        Screenshot.objects.create(app=app, language_code='de', file='second/de/phone/1.png')
+        app.translate('de')
+        app.summary_de = 'Zusammenfassung'
+        app.save()
+
+        # assert that the number of queries does not depend on the number of apps
+        self.assertEqual(query_count, self.repo.update())
+
+        # assert that all metadata made it into the index
+        apps = make_index.call_args[0][0]
+        self.assertEqual({'first', 'second'}, set(apps.keys()))
+        self.assertEqual(['Games', 'Writing'], sorted(apps['second'].Categories))
+        self.assertEqual(['1.png'], apps['second']['localized']['de']['phoneScreenshots'])
+        self.assertEqual('Zusammenfassung', apps['second']['localized']['de']['summary'])
+
+    @patch('fdroidserver.signindex.sign_jar')
+    @patch('fdroidserver.make_index')
+    @patch('repomaker.models.repository.Repository._generate_page')
+    def test_update_timings(self, _generate_page, make_index, sign_jar):
+        # fdroidserver signs the index while making it
+        make_index.side_effect = lambda *args: fdroidserver.signindex.sign_jar('index.jar')
+        self._add_file_app('first', 'First', 'test.mp4')
+
+        with PhaseTimer() as timer:
+            self.repo.update()
+
+        # assert that all phases of the update were measured
+        self.assertEqual(['scan_apks', 'load_metadata', 'make_index', 'sign_index',
+                          'generate_page'], list(timer.phases.keys()))
+        self.assertEqual(1, timer.phases['load_metadata']['count'])
+        self.assertEqual(1, timer.phases['make_index']['count'])
+        sign_jar.assert_called_once_with('index.jar')
+        self.assertTrue(timer.phases['make_index']['duration'] >=
+                        timer.phases['sign_index']['duration'])
+
+        # assert that the original signing function was restored
+        self.assertEqual(sign_jar, fdroidserver.signindex.sign_jar)
+
+    @patch('fdroidserver.verify_apk_signature')
+    @patch('fdroidserver.scan_apk', wraps=fdroidserver.scan_apk)
+    @patch('fdroidserver.make_index')
+    @patch('repomaker.models.repository.Repository._generate_page')
+    def test_update_shares_apk_scan_result(self, _generate_page, make_index, scan_apk,
+                                           verify_apk_signature):
+        verify_apk_signature.return_value = True
+        package_id = 'org.bitbucket.tickytacky.mirrormirror'
+        apk = Apk.objects.create(package_id=package_id, version_code=2)
+        with open(os.path.join(settings.TEST_FILES_DIR, 'test_1.apk'), 'rb') as f:
+            apk.file.save('test_1.apk', File(f), save=False)
+        apk.hash = sha256sum(apk.file.path)
+        apk.save()
+
+        # add the same APK to two repositories
+        repos = [self.repo, Repository.objects.create(name="Second", description="Second",
+                                                      url="https://example.com",
+                                                      fingerprint="foongerprint", user=self.user)]
+        for repo in repos:
+            app = App.objects.create(repo=repo, package_id=package_id, type=APK)
+            ApkPointer.objects.create(repo=repo, app=app, apk=apk).link_file_from_apk()
+
+        # assert that the APK was scanned when updating the first repository
+        repos[0].update()
+        self.assertEqual(1, scan_apk.call_count)
+        self.assertEqual(apk.hash, Apk.objects.get(pk=apk.pk).get_scan_result()['hash'])
+
+        # assert that the second repository re-used the scan result
+        repos[1].update()
+        self.assertEqual(1, scan_apk.call_count)
+        repo_file = make_index.call_args[0][1][0]
+        self.assertEqual('test_1.apk', repo_file['apkName'])
+        self.assertEqual(apk.hash, repo_file['hash'])
+
+        # assert that the icons were extracted into the second repository
+        self.assertTrue(repo_file['icons'])
+        for density, icon_name in repo_file['icons'].items():
+            icon_dir = fdroidserver.update.get_icon_dir(repos[1].get_repo_path(), density)
+            self.assertTrue(os.path.isfile(os.path.join(icon_dir, icon_name)))
+
     @patch('repomaker.models.storage.GitStorage.publish')
     @patch('repomaker.models.storage.SshStorage.publish')
     @patch('repomaker.models.storage.S3Storage.publish')
@@ -288,9 +511,10 @@ class RepositoryTestCase(RmTestCase):
         # assert that the repo has still not been published
         self.assertIsNone(self.repo.last_publication_date)
 
-    @patch('requests.get')
+    @patch('repomaker.downloads.http_get')
+    @patch('repomaker.downloads.get')
     @patch('repomaker.models.repository.Repository._generate_page')
-    def test_full_cyclic_integration(self, _generate_page, get):
+    def test_full_cyclic_integration(self, _generate_page, get, http_get):
         """
         This test creates a local repository with one app and one non-apk app
         and then imports it again as a remote repository.
@@ -358,7 +582,10 @@ class RepositoryTestCase(RmTestCase):
         self.assertTrue(os.path.isfile(index_path))
         with open(index_path, "rb") as file:
             index = file.read()
-        get.return_value.content = index
+        response = get.return_value
+        response.iter_content.return_value = [index]
+        response.headers = {'ETag': 'etag'}
+        http_get.return_value = b'icon-data', 'etag'
 
         # add a new remote repository
         date = datetime.fromtimestamp(0, timezone.utc)
@@ -371,12 +598,8 @@ class RepositoryTestCase(RmTestCase):
         self.assertTrue(len(remote_repo.public_key) > 500)
 
         # assert repo icon were also downloaded
-        self.assertEqual(2, get.call_count)
-        get.assert_called_with(  # last get call
-            'test_url' + '/icons/icon.png',
-            headers={'User-Agent': 'F-Droid'},
-            timeout=600
-        )
+        self.assertEqual(1, get.call_count)
+        http_get.assert_called_once_with('test_url' + '/icons/icon.png', None)
 
         # assert that new remote apps have been created properly
         remote_apps = RemoteApp.objects.all()
@@ -395,9 +618,9 @@ class RepositoryTestCase(RmTestCase):
         # assert that remote app icon is scheduled to be downloaded in a new task
         self.assertEqual(1, Task.objects.all().count())
         task = Task.objects.all()[0]
-        self.assertEqual('repomaker.tasks.update_remote_app_icon', task.task_name)
+        self.assertEqual('repomaker.tasks.update_remote_app_icons', task.task_name)
         self.assertJSONEqual(
-            '[[' + str(remote_app.pk) + ', "org.bitbucket.tickytacky.mirrormirror.2.png"], {}]',
+            '[[[[' + str(remote_app.pk) + ', "org.bitbucket.tickytacky.mirrormirror.2.png"]]], {}]',
             task.task_params)
 
         # non-apk app
@@ -507,6 +730,15 @@ class RepositoryPageTestCase(RmTestCase):
         repo._generate_page()  # pylint: disable=protected-access
         _copy_page_assets.assert_called_once_with()
 
+        # assert that generating the unchanged page again does not touch its files
+        page_paths = [os.path.join(repo.get_repo_path(), 'index.html'),
+                      os.path.join(repo.get_repo_path(), 'assets', 'qr_code.html')]
+        for path in page_paths:
+            os.utime(path, (0, 0))
+        repo._generate_page()  # pylint: disable=protected-access
+        for path in page_paths:
+            self.assertEqual(0, os.path.getmtime(path))
+
         # make sure that SASS processor gets disabled again as soon as it is no longer needed
         sass_processor.processor.SassProcessor.processor_enabled = False
 
@@ -528,3 +760,60 @@ class RepositoryPageTestCase(RmTestCase):
         style_abs_path = os.path.join(settings.STATIC_ROOT, 'repomaker', 'css', 'repo', 'page.css')
         self.assertTrue(os.path.isfile(style_abs_path))
         self.assertTrue(os.path.getsize(style_abs_path) > 200)
+
+
+class RepositoryConcurrencyTestCase(TransactionTestCase):
+    serialized_rollback = True  # restore data from migrations for the following tests
+
+    def setUp(self):
+        if not os.path.isdir(settings.TEST_DIR):
+            os.makedirs(settings.TEST_DIR)
+        os.chdir(settings.TEST_DIR)
+
+    def tearDown(self):
+        if os.path.isdir(settings.TEST_DIR):
+            shutil.rmtree(settings.TEST_DIR)
+
+    @staticmethod
+    def _update(repo_id):
+        try:
+            Repository.objects.get(pk=repo_id).update()
+        finally:
+            connection.close()
+
+    @patch('fdroidserver.make_index')
+    @patch('repomaker.models.repository.Repository._generate_page')
+    def test_concurrent_updates(self, _generate_page, make_index):
+        # remember in which directory the index of which apps and files was made
+        indexes = {}
+
+        def make_index_side_effect(apps, apks, repodir, *_args):
+            path = os.path.dirname(repodir)
+            indexes[path] = set(apps.keys()), [apk['apkName'] for apk in apks]
+        make_index.side_effect = make_index_side_effect
+
+        user = User.objects.create(username='concurrent')
+        repos = []
+        for i, file_name in enumerate(['test.mp4', 'test.ogg', 'test.flac']):
+            repo = Repository.objects.create(name="Repo %d" % i, description="Test", user=user,
+                                             url="https://example.org/%d" % i,
+                                             fingerprint="foongerprint")
+            add_file_app(repo, 'app%d' % i, 'App %d' % i, file_name)
+            repos.append(repo)
+
+        # update all repositories at the same time
+        cwd = os.getcwd()
+        with ThreadPoolExecutor(max_workers=len(repos)) as executor:
+            for future in [executor.submit(self._update, repo.pk) for repo in repos]:
+                future.result()
+
+        # assert that the working directory did not change
+        self.assertEqual(cwd, os.getcwd())
+
+        # assert that each repository was built in its own directory with only its own app
+        for i, file_name in enumerate(['test.mp4', 'test.ogg', 'test.flac']):
+            path = repos[i].get_path()
+            self.assertEqual(({'app%d' % i}, [file_name]), indexes[path])
+            with open(os.path.join(path, 'tmp', 'apkcache.json'), 'r', encoding='utf-8') as f:
+                self.assertEqual([file_name], [k for k, v in json.load(f).items()
+                                               if isinstance(v, dict)])
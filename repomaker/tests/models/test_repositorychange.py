@@ -0,0 +1,89 @@
+import io
+
+from repomaker.models import Apk, ApkPointer, App, Category, Repository, RepositoryChange, \
+    Screenshot
+
+from .. import RmTestCase
+
+
+class RepositoryChangeTestCase(RmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.app = App.objects.create(repo=self.repo, package_id='org.example', name='Test')
+        RepositoryChange.objects.all().delete()  # start with an empty journal
+
+    def assertChanged(self, *package_ids):
+        changed, _ = RepositoryChange.get_changes(self.repo)
+        self.assertEqual(set(package_ids), changed)
+
+    def test_str(self):
+        RepositoryChange.record(self.repo.pk, 'org.example')
+        change = RepositoryChange.objects.get()
+        self.assertEqual('Test Name - org.example', str(change))
+
+    def test_record_without_package_id(self):
+        RepositoryChange.record(self.repo.pk, '')
+        self.assertChanged()
+
+    def test_app_save(self):
+        self.app.name = 'New Name'
+        self.app.save()
+        self.assertChanged('org.example')
+
+    def test_app_translation(self):
+        self.app.translate('de')
+        self.app.summary_de = 'Zusammenfassung'
+        self.app.save()
+        self.assertChanged('org.example')
+
+    def test_app_delete(self):
+        self.app.delete()
+        self.assertChanged('org.example')
+
+    def test_app_category(self):
+        self.app.category.add(Category.objects.all()[0])
+        self.assertChanged('org.example')
+
+    def test_apk_pointer(self):
+        apk = Apk.objects.create(package_id='org.example.apk')
+        ApkPointer.objects.create(repo=self.repo, app=self.app, apk=apk)
+        self.assertChanged('org.example.apk')
+
+    def test_apk_pointer_without_apk_package_id(self):
+        ApkPointer.objects.create(repo=self.repo, app=self.app, apk=Apk.objects.create())
+        self.assertChanged('org.example')
+
+    def test_screenshot(self):
+        screenshot = Screenshot.objects.create(app=self.app)
+        screenshot.file.save('test.png', io.BytesIO(b'foo'), save=True)
+        self.assertChanged('org.example')
+
+        RepositoryChange.objects.all().delete()
+        screenshot.delete()
+        self.assertChanged('org.example')
+
+    def test_get_changes_only_for_repo(self):
+        other_repo = Repository.objects.create(user=self.user)
+        App.objects.create(repo=other_repo, package_id='org.example.other')
+        self.assertChanged()
+
+    def test_clear_keeps_later_changes(self):
+        RepositoryChange.record(self.repo.pk, 'org.example')
+        _, latest = RepositoryChange.get_changes(self.repo)
+        RepositoryChange.record(self.repo.pk, 'org.example.later')
+
+        RepositoryChange.clear(self.repo, latest)
+        self.assertChanged('org.example.later')
+
+    def test_clear_without_changes(self):
+        RepositoryChange.clear(self.repo, None)
+        self.assertChanged()
+
+    def test_repository_delete(self):
+        apk = Apk.objects.create(package_id='org.example')
+        ApkPointer.objects.create(repo=self.repo, app=self.app, apk=apk)
+
+        self.repo.delete()
+
+        self.assertEqual(0, RepositoryChange.objects.all().count())
@@ -7,6 +7,7 @@ from unittest.mock import patch
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import TestCase
+from requests.exceptions import HTTPError
 from repomaker.models import Repository, RemoteRepository, App, RemoteApp, Screenshot, \
     RemoteScreenshot
 from repomaker.models.screenshot import AbstractScreenshot, PHONE, SEVEN_INCH, TEN_INCH, TV, WEAR
@@ -126,13 +127,19 @@ class RemoteScreenshotTestCase(TestCase):
         self.remote_screenshot.download_async(self.app)
         download_remote_screenshot.assert_called_once_with(self.remote_screenshot.pk, self.app.pk)
 
-    @patch('requests.get')
-    def test_download(self, get):
+    @patch('repomaker.tasks.download_remote_screenshots')
+    def test_download_all_async(self, download_remote_screenshots):
+        # schedule async download of all screenshots in one task
+        RemoteScreenshot.download_all_async([self.remote_screenshot], self.app)
+        download_remote_screenshots.assert_called_once_with([self.remote_screenshot.pk],
+                                                            self.app.pk)
+
+    @patch('repomaker.downloads.http_get')
+    def test_download(self, http_get):
         # do a fake screenshot download
-        get.return_value.status_code = 200
-        get.return_value.content = b'foo'
+        http_get.return_value = b'foo', None
         self.remote_screenshot.download(self.app.pk)
-        get.assert_called_once_with('test_url/test.png', timeout=60)
+        http_get.assert_called_once_with('test_url/test.png', None)
 
         # exactly one Screenshot was created
         self.assertEqual(1, Screenshot.objects.all().count())
@@ -145,10 +152,10 @@ class RemoteScreenshotTestCase(TestCase):
         self.assertEqual(get_screenshot_file_path(screenshot, 'test.png'), screenshot.file.name)
         os.path.isfile(screenshot.file.path)
 
-    @patch('requests.get')
-    def test_failed_download(self, get):
+    @patch('repomaker.downloads.http_get')
+    def test_failed_download(self, http_get):
         # do a fake screenshot download
-        get.return_value.status_code = 404
+        http_get.side_effect = HTTPError('404 Client Error')
         self.remote_screenshot.download(self.app.pk)
 
         # no Screenshot was created
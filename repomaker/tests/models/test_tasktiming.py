@@ -0,0 +1,44 @@
+from django.test import override_settings
+
+from repomaker.models import TaskTiming
+from repomaker.utils import PhaseTimer, timed_phase
+
+from .. import RmTestCase
+
+
+class TaskTimingTestCase(RmTestCase):
+
+    def test_record(self):
+        with PhaseTimer() as timer:
+            with timed_phase('make_index', 2):
+                pass
+
+        timing = TaskTiming.record('update_repo', timer, repo=self.repo)
+
+        # assert that the timer's measurements were stored
+        timing = TaskTiming.objects.get(pk=timing.pk)
+        self.assertEqual('update_repo', timing.task_name)
+        self.assertEqual(self.repo, timing.repo)
+        self.assertEqual(timer.start_date, timing.start_date)
+        self.assertEqual(timer.duration, timing.duration)
+        self.assertTrue(timing.succeeded)
+        self.assertEqual(1, len(timing.get_phases()))
+        self.assertEqual('make_index', timing.get_phases()[0]['name'])
+        self.assertEqual(2, timing.get_phases()[0]['count'])
+
+        # assert that the timing can be exported
+        timing_dict = timing.to_dict()
+        self.assertEqual('update_repo', timing_dict['task'])
+        self.assertEqual(timing.get_phases(), timing_dict['phases'])
+
+    @override_settings(TASK_TIMING_HISTORY=2)
+    def test_record_removes_old_timings(self):
+        for _ in range(3):
+            with PhaseTimer() as timer:
+                pass
+            TaskTiming.record('update_repo', timer, repo=self.repo)
+        TaskTiming.record('download_apk', timer, False)
+
+        # assert that only the latest timings of the repository were kept
+        self.assertEqual(2, TaskTiming.objects.filter(repo=self.repo).count())
+        self.assertEqual(1, TaskTiming.objects.filter(task_name='download_apk').count())
@@ -0,0 +1,239 @@
+import hashlib
+import io
+import os
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
+
+from repomaker.models import Apk, ApkPointer, App, ChunkedUpload, Repository, Upload
+from repomaker.models import upload as upload_module
+from repomaker.models.upload import ADDED, FAILED, PENDING, UploadConflictError
+from repomaker.tasks import PRIORITY_UPLOAD
+
+from .. import RmTestCase
+
+
+class UploadTestCase(RmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.app = App.objects.create(repo=self.repo, package_id='org.example', name='Test')
+
+    @staticmethod
+    def get_uploaded_file(file_name, name=None):
+        with open(os.path.join(settings.TEST_FILES_DIR, file_name), 'rb') as f:
+            return SimpleUploadedFile(name or file_name, f.read())
+
+    def test_create(self):
+        upload = Upload.create(self.repo, [self.get_uploaded_file('test.avi')])
+
+        # assert that the file was stored, but not added to the repository yet
+        self.assertEqual(1, Apk.objects.all().count())
+        self.assertTrue(os.path.isfile(Apk.objects.get().file.path))
+        self.assertEqual(0, ApkPointer.objects.all().count())
+        self.assertEqual([{'name': 'test.avi', 'apk': Apk.objects.get().pk, 'state': PENDING,
+                           'error': None, 'existing': False}], upload.get_files())
+        self.assertFalse(upload.is_finished())
+
+    def test_create_removes_old_finished_uploads(self):
+        old_date = timezone.now() - timedelta(days=2)
+        Upload.objects.create(repo=self.repo, created_date=old_date, files='[]')
+        old_pending = Upload.create(self.repo, [self.get_uploaded_file('test.avi')])
+        old_pending.created_date = old_date
+        old_pending.save()
+
+        upload = Upload.create(self.repo, [])
+
+        # assert that only the finished old upload was removed
+        self.assertEqual({old_pending, upload}, set(Upload.objects.all()))
+
+    @patch('repomaker.tasks.process_upload')
+    def test_process_async(self, process_upload):
+        upload = Upload.create(self.repo, [self.get_uploaded_file('test.avi')])
+        upload.process_async()
+        process_upload.assert_called_once_with(upload.pk, priority=PRIORITY_UPLOAD)
+
+    def test_process(self):
+        upload = Upload.create(self.repo, [self.get_uploaded_file('test.avi'),
+                                           self.get_uploaded_file('test.pdf', 'document.pdf')])
+
+        apks = upload.process()
+
+        # assert that both files were added to the repository
+        self.assertEqual(2, len(apks))
+        self.assertEqual(2, ApkPointer.objects.filter(repo=self.repo).count())
+        upload = Upload.objects.get(pk=upload.pk)
+        self.assertEqual([ADDED, ADDED], [f['state'] for f in upload.get_files()])
+        self.assertTrue(upload.is_finished())
+        self.assertTrue(Repository.objects.get(pk=self.repo.pk).update_scheduled)
+
+        # assert that the progress can be exported
+        upload_dict = upload.to_dict()
+        self.assertTrue(upload_dict['finished'])
+        self.assertEqual(2, upload_dict['total'])
+        self.assertEqual(2, upload_dict['processed'])
+        self.assertEqual(self.repo.pk, upload_dict['repo'])
+        self.assertIsNone(upload_dict['app'])
+
+    def test_process_failed(self):
+        upload = Upload.create(self.repo, [self.get_uploaded_file('test.pdf')], self.app)
+
+        self.assertEqual([], upload.process())
+
+        # assert that the file was rejected and deleted
+        self.assertEqual([{'name': 'test.pdf', 'state': FAILED,
+                           'error': 'This file is not an update for org.example'}],
+                         upload.to_dict()['files'])
+        self.assertEqual(0, Apk.objects.all().count())
+        self.assertFalse(Repository.objects.get(pk=self.repo.pk).update_scheduled)
+
+    def test_delete_removes_pending_files(self):
+        Upload.create(self.repo, [self.get_uploaded_file('test.avi')])
+        path = Apk.objects.get().file.path
+
+        self.repo.delete()
+
+        # assert that the file that was not added yet got removed with the upload
+        self.assertEqual(0, Upload.objects.all().count())
+        self.assertEqual(0, Apk.objects.all().count())
+        self.assertFalse(os.path.isfile(path))
+
+    def test_create_for_existing_file(self):
+        Upload.create(self.repo, [self.get_uploaded_file('test.avi')]).process()
+        apk = Apk.objects.get()
+        other_repo = Repository.objects.create(user=self.user, name='Other')
+
+        upload = Upload.create_for_existing_file(other_repo, 'test.avi', apk.hash.upper())
+        self.assertEqual([apk.pk], [f['apk'] for f in upload.get_files()])
+        self.assertIsNone(Upload.create_for_existing_file(other_repo, 'test.avi', 'a' * 64))
+
+        # assert that the existing file was added without storing it again
+        self.assertEqual([apk], upload.process())
+        self.assertEqual(1, Apk.objects.all().count())
+        self.assertEqual(1, ApkPointer.objects.filter(repo=other_repo).count())
+
+        # assert that the existing file is kept when it can not be added again
+        upload = Upload.create_for_existing_file(other_repo, 'test.avi', apk.hash)
+        self.assertEqual([], upload.process())
+        self.assertEqual([FAILED], [f['state'] for f in upload.get_files()])
+        self.assertTrue(Apk.objects.filter(pk=apk.pk).exists())
+
+
+class ChunkedUploadTestCase(RmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(settings.TEST_FILES_DIR, 'test.avi'), 'rb') as f:
+            self.content = f.read()
+        self.hash = hashlib.sha256(self.content).hexdigest()
+
+    def test_start(self):
+        chunked_upload = ChunkedUpload.start(self.repo, '../../test.avi', len(self.content),
+                                             self.hash.upper())
+        self.assertEqual('test.avi', chunked_upload.file_name)
+        self.assertEqual(self.hash, chunked_upload.hash)
+        self.assertEqual(0, chunked_upload.offset)
+
+    def test_start_removes_old_uploads(self):
+        old_upload = ChunkedUpload.start(self.repo, 'test.avi', 2)
+        old_upload.append(io.BytesIO(b'1'))
+        old_upload.created_date = timezone.now() - timedelta(days=2)
+        old_upload.save()
+
+        ChunkedUpload.start(self.repo, 'test.avi', 2)
+
+        # assert that the old upload and its partial file were removed
+        self.assertFalse(ChunkedUpload.objects.filter(pk=old_upload.pk).exists())
+        self.assertFalse(os.path.isfile(old_upload.get_part_path()))
+
+    def test_append_and_finish(self):
+        chunked_upload = ChunkedUpload.start(self.repo, 'test.avi', len(self.content), self.hash)
+        part_path = chunked_upload.get_part_path()
+
+        chunked_upload.append(io.BytesIO(self.content[:1000]))
+        self.assertEqual(1000, ChunkedUpload.objects.get().offset)
+        chunked_upload.append(io.BytesIO(self.content[1000:]))
+        upload = chunked_upload.finish()
+
+        # assert that the file was moved into place and is waiting to be added
+        apk = Apk.objects.get()
+        with open(apk.file.path, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+        self.assertEqual([{'name': 'test.avi', 'apk': apk.pk, 'state': PENDING, 'error': None,
+                           'existing': False}], upload.get_files())
+        self.assertEqual(0, ChunkedUpload.objects.all().count())
+        self.assertFalse(os.path.isfile(part_path))
+
+    def test_resume(self):
+        chunked_upload = ChunkedUpload.start(self.repo, 'test.avi', len(self.content), self.hash)
+        chunked_upload.append(io.BytesIO(self.content[:1000]))
+
+        # simulate that another process receives the rest of the file
+        # after a chunk was written only partly
+        with open(chunked_upload.get_part_path(), 'ab') as f:
+            f.write(self.content[1000:1500])
+        upload_module._part_hashes.clear()  # pylint: disable=protected-access
+        chunked_upload = ChunkedUpload.objects.get()
+        chunked_upload.append(io.BytesIO(self.content[1000:]))
+
+        # assert that the hash was computed from the partial file and matches
+        chunked_upload.finish()
+        with open(Apk.objects.get().file.path, 'rb') as f:
+            self.assertEqual(self.content, f.read())
+
+    def test_append_same_chunk_concurrently(self):
+        chunked_upload = ChunkedUpload.start(self.repo, 'test.avi', len(self.content), self.hash)
+        other_request_upload = ChunkedUpload.objects.get()
+        chunked_upload.append(io.BytesIO(self.content[:1000]))
+
+        # assert that the same chunk is rejected when it was loaded before the other request
+        with self.assertRaises(UploadConflictError):
+            other_request_upload.append(io.BytesIO(b'a' * 1000))
+        self.assertEqual(1000, ChunkedUpload.objects.get().offset)
+        with open(chunked_upload.get_part_path(), 'rb') as f:
+            self.assertEqual(self.content[:1000], f.read())
+
+    def test_append_while_other_request_appends(self):
+        chunked_upload = ChunkedUpload.start(self.repo, 'test.avi', len(self.content), self.hash)
+        ChunkedUpload.objects.update(is_appending=True)
+
+        with self.assertRaises(UploadConflictError):
+            chunked_upload.append(io.BytesIO(self.content))
+        self.assertFalse(os.path.isfile(chunked_upload.get_part_path()))
+
+    def test_finish_while_other_request_appends(self):
+        chunked_upload = ChunkedUpload.start(self.repo, 'test.avi', len(self.content), self.hash)
+        chunked_upload.append(io.BytesIO(self.content))
+        ChunkedUpload.objects.update(is_appending=True)
+
+        with self.assertRaises(UploadConflictError):
+            chunked_upload.finish()
+        self.assertEqual(1, ChunkedUpload.objects.all().count())
+        self.assertEqual(0, Apk.objects.all().count())
+
+    def test_append_more_than_announced(self):
+        chunked_upload = ChunkedUpload.start(self.repo, 'test.avi', 10)
+        with self.assertRaises(ValidationError):
+            chunked_upload.append(io.BytesIO(b'12345678901'))
+        self.assertEqual(0, ChunkedUpload.objects.get().offset)
+
+        # assert that the upload is not claimed anymore after the failure
+        self.assertFalse(ChunkedUpload.objects.get().is_appending)
+        chunked_upload.append(io.BytesIO(b'1234567890'))
+        self.assertEqual(10, ChunkedUpload.objects.get().offset)
+
+    def test_finish_with_wrong_hash(self):
+        chunked_upload = ChunkedUpload.start(self.repo, 'test.avi', 3, self.hash)
+        chunked_upload.append(io.BytesIO(b'123'))
+        part_path = chunked_upload.get_part_path()
+        with self.assertRaises(ValidationError):
+            chunked_upload.finish()
+
+        # assert that the upload and its file were removed
+        self.assertEqual(0, ChunkedUpload.objects.all().count())
+        self.assertEqual(0, Apk.objects.all().count())
+        self.assertFalse(os.path.isfile(part_path))
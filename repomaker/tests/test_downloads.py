@@ -0,0 +1,132 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.test import override_settings
+from requests.exceptions import HTTPError
+
+from repomaker import downloads
+
+from . import RmTestCase
+
+
+class CountingRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves its path as content with keep-alive connections and counts the connections.
+    """
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            type(self).connections += 1
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self._send_headers()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self._send_headers():
+            self.wfile.write(self.path.encode())
+
+    def _send_headers(self):
+        if self.path == '/missing':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return False
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.path)))
+        self.send_header('ETag', 'etag' + self.path)
+        self.end_headers()
+        return True
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@override_settings(DOWNLOAD_WORKERS=8, DOWNLOAD_CONNECTIONS_PER_HOST=2)
+class DownloadsTest(RmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.handler = type('Handler', (CountingRequestHandler,), {'connections': 0})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+        # start with a new session and thread pool using the overridden settings
+        downloads._session = None  # pylint: disable=protected-access
+        downloads._executor = None  # pylint: disable=protected-access
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        downloads.get_session().close()
+        downloads._session = None  # pylint: disable=protected-access
+        downloads._executor = None  # pylint: disable=protected-access
+        super().tearDown()
+
+    def test_get_session_is_shared(self):
+        self.assertIs(downloads.get_session(), downloads.get_session())
+
+    def test_http_get(self):
+        self.assertEqual((b'/icon.png', 'etag/icon.png'),
+                         downloads.http_get(self.url + '/icon.png'))
+
+        # assert that unchanged content is not downloaded again
+        self.assertEqual((None, 'etag/icon.png'),
+                         downloads.http_get(self.url + '/icon.png', 'etag/icon.png'))
+
+    def test_http_get_all(self):
+        # 8 screenshots in 5 languages
+        paths = ['/%s/phoneScreenshots/%d.png' % (language_code, i)
+                 for language_code in ['en-US', 'de', 'fr', 'es', 'it'] for i in range(8)]
+        paths.insert(1, '/missing')
+
+        results = downloads.http_get_all([self.url + path for path in paths])
+
+        # assert that all files were downloaded in order and failed downloads were returned
+        self.assertEqual(len(paths), len(results))
+        self.assertEqual((b'/en-US/phoneScreenshots/0.png', 'etag/en-US/phoneScreenshots/0.png'),
+                         results[0])
+        self.assertIsInstance(results[1], HTTPError)
+        for path, result in zip(paths[2:], results[2:]):
+            self.assertEqual(path.encode(), result[0])
+
+        # assert that the connections to the host were reused
+        self.assertTrue(self.handler.connections <= 2)
+
+    def test_http_get_all_with_etags(self):
+        urls = [self.url + '/1.png', self.url + '/2.png']
+        results = downloads.http_get_all(urls, ['etag/1.png', 'old'])
+        self.assertEqual([(None, 'etag/1.png'), (b'/2.png', 'etag/2.png')], results)
+
+    def test_deadline(self):
+        with downloads.deadline(60):
+            self.assertTrue(0 < downloads.get_timeout() <= downloads.TIMEOUT)
+            self.assertEqual((b'/icon.png', 'etag/icon.png'),
+                             downloads.http_get(self.url + '/icon.png'))
+
+            # assert that a nested deadline can only shorten the time that is left
+            with downloads.deadline(0):
+                with self.assertRaises(downloads.DeadlineExceeded):
+                    downloads.http_get(self.url + '/icon.png')
+            with downloads.deadline(600):
+                self.assertTrue(downloads.get_timeout() <= 60)
+
+        # assert that there is no deadline outside of the block
+        self.assertEqual(downloads.TIMEOUT, downloads.get_timeout())
+
+    def test_http_get_all_keeps_deadline(self):
+        urls = [self.url + '/1.png', self.url + '/2.png']
+
+        # assert that the downloads in the threads of the pool are aborted at the deadline
+        with downloads.deadline(0):
+            with self.assertRaises(downloads.DeadlineExceeded):
+                downloads.http_get_all(urls)
+        self.assertEqual(0, self.handler.connections)
+
+        # assert that the threads of the pool do not keep the deadline afterwards
+        self.assertEqual([(b'/1.png', 'etag/1.png'), (b'/2.png', 'etag/2.png')],
+                         downloads.http_get_all(urls))
@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+from repomaker import indexv2
+
+INDEX_V1 = {
+    'repo': {'name': 'Test', 'description': 'Test Description', 'icon': 'icon.png',
+             'address': 'https://example.org/fdroid/repo', 'timestamp': 1000,
+             'mirrors': ['https://mirror.example.org/fdroid/repo']},
+    'apps': [{
+        'packageName': 'org.example',
+        'name': 'Test App',
+        'summary': 'Summary',
+        'icon': 'org.example.1.png',
+        'categories': ['Games'],
+        'webSite': 'https://example.org',
+        'added': 1000,
+        'lastUpdated': 1000,
+        'localized': {
+            'de': {'summary': 'Zusammenfassung', 'featureGraphic': 'feature.png',
+                   'phoneScreenshots': ['1.png', '2.png']},
+        },
+    }],
+    'packages': {
+        'org.example': [{
+            'packageName': 'org.example', 'apkName': 'org.example_1.apk', 'hash': 'hash1',
+            'hashType': 'sha256', 'size': 42, 'versionCode': 1, 'versionName': '1.0',
+            'added': 1000, 'minSdkVersion': 14, 'signer': 'signer',
+            'uses-permission': [['android.permission.INTERNET', None],
+                                ['android.permission.READ_CONTACTS', 22]],
+        }],
+    },
+}
+
+
+class IndexV2Test(TestCase):
+
+    def setUp(self):
+        self.repodir = tempfile.mkdtemp()
+        self.history_dir = os.path.join(tempfile.mkdtemp(), 'index-v2')
+        os.makedirs(os.path.join(self.repodir, 'org.example', 'de'))
+        with open(os.path.join(self.repodir, 'org.example', 'de', 'feature.png'), 'wb') as f:
+            f.write(b'feature')
+
+    def tearDown(self):
+        shutil.rmtree(self.repodir)
+        shutil.rmtree(os.path.dirname(self.history_dir))
+
+    def test_v1_to_v2(self):
+        index_v2 = indexv2.v1_to_v2(INDEX_V1, self.repodir)
+
+        self.assertEqual({'en-US': 'Test'}, index_v2['repo']['name'])
+        self.assertEqual([{'url': 'https://mirror.example.org/fdroid/repo'}],
+                         index_v2['repo']['mirrors'])
+        metadata = index_v2['packages']['org.example']['metadata']
+        self.assertEqual({'en-US': 'Summary', 'de': 'Zusammenfassung'}, metadata['summary'])
+        self.assertEqual({'name': '/icons/org.example.1.png'}, metadata['icon']['en-US'])
+        # assert that hashes and sizes are added for the files that exist
+        self.assertEqual({'name': '/org.example/de/feature.png', 'size': 7,
+                          'sha256': '2ad562319767157087dda0dec6391f4479f8a04869ab0cc8d3a9c3637dae'
+                                    '73b5'}, metadata['featureGraphic']['de'])
+        self.assertEqual(['/org.example/de/phoneScreenshots/1.png',
+                          '/org.example/de/phoneScreenshots/2.png'],
+                         [f['name'] for f in metadata['screenshots']['phone']['de']])
+        version = index_v2['packages']['org.example']['versions']['hash1']
+        self.assertEqual({'name': '/org.example_1.apk', 'sha256': 'hash1', 'size': 42},
+                         version['file'])
+        self.assertEqual([{'name': 'android.permission.INTERNET'},
+                          {'name': 'android.permission.READ_CONTACTS', 'maxSdkVersion': 22}],
+                         version['manifest']['usesPermission'])
+        self.assertEqual({'minSdkVersion': 14}, version['manifest']['usesSdk'])
+
+    def test_v2_to_v1(self):
+        index_v2 = indexv2.v1_to_v2(INDEX_V1, self.repodir)
+
+        repo = indexv2.repo_v2_to_v1(index_v2['repo'])
+        self.assertEqual({'name': 'Test', 'description': 'Test Description', 'timestamp': 1000,
+                          'icon': 'icon.png',
+                          'mirrors': ['https://mirror.example.org/fdroid/repo']}, repo)
+
+        # assert that the app can be synced like the one from index v1
+        app = indexv2.app_v2_to_v1('org.example', index_v2['packages']['org.example'])
+        app_v1 = dict(INDEX_V1['apps'][0])
+        app_v1['localized'] = {'en-US': {'name': 'Test App', 'summary': 'Summary'},
+                               'de': app_v1['localized']['de']}
+        del app_v1['summary']
+        self.assertEqual(app_v1, app)
+
+        packages = indexv2.packages_v2_to_v1('org.example', index_v2['packages']['org.example'])
+        self.assertEqual([{'packageName': 'org.example', 'apkName': 'org.example_1.apk',
+                           'hash': 'hash1', 'hashType': 'sha256', 'size': 42, 'versionCode': 1,
+                           'versionName': '1.0', 'added': 1000}], packages)
+
+    def test_merge_patch(self):
+        old = {'a': 1, 'b': {'c': 2, 'd': [1, 2]}, 'e': 'removed'}
+        new = {'a': 1, 'b': {'c': 3, 'd': [1, 2], 'f': {'g': None}}, 'h': [3]}
+
+        merge_patch = indexv2.make_merge_patch(old, new)
+
+        self.assertEqual({'b': {'c': 3, 'f': {'g': None}}, 'e': None, 'h': [3]}, merge_patch)
+        self.assertEqual({'a': 1, 'b': {'c': 3, 'd': [1, 2], 'f': {}}, 'h': [3]},
+                         indexv2.apply_merge_patch(old, merge_patch))
+
+    def write_index_v1(self, timestamp, app_name):
+        index_v1 = json.loads(json.dumps(INDEX_V1))
+        index_v1['repo']['timestamp'] = timestamp
+        index_v1['apps'][0]['name'] = app_name
+        with open(os.path.join(self.repodir, 'index-v1.json'), 'w', encoding='utf-8') as f:
+            json.dump(index_v1, f)
+
+    def read_json(self, name):
+        with open(os.path.join(self.repodir, name), encoding='utf-8') as f:
+            return json.load(f)
+
+    @patch('repomaker.indexv2.MAX_DIFFS', 2)
+    def test_make_index_v2(self):
+        sign_jar = Mock()
+        self.write_index_v1(1000, 'First')
+        indexv2.make_index_v2(self.repodir, self.history_dir, sign_jar)
+
+        # assert that the index and the signed entry were written without diffs
+        sign_jar.assert_called_once_with(os.path.join(self.repodir, 'entry.jar'))
+        entry = self.read_json('entry.json')
+        self.assertEqual(1000, entry['timestamp'])
+        self.assertEqual({}, entry['diffs'])
+        self.assertEqual('/index-v2.json', entry['index']['name'])
+        self.assertEqual(1, entry['index']['numPackages'])
+        self.assertEqual({'en-US': 'First'},
+                         self.read_json('index-v2.json')['packages']['org.example']['metadata']
+                         ['name'])
+
+        for timestamp in [2000, 3000, 4000]:
+            self.write_index_v1(timestamp, 'App %d' % timestamp)
+            indexv2.make_index_v2(self.repodir, self.history_dir, sign_jar)
+
+        # assert that there are diffs from the two last earlier versions only
+        entry = self.read_json('entry.json')
+        self.assertEqual({'2000', '3000'}, set(entry['diffs'].keys()))
+        self.assertEqual(['2000.json', '3000.json'],
+                         sorted(os.listdir(os.path.join(self.repodir, 'diff'))))
+        self.assertEqual(['3000.json', '4000.json'], sorted(os.listdir(self.history_dir))[1:])
+
+        # assert that applying a diff to the earlier index results in the current one
+        with open(os.path.join(self.history_dir, '2000.json'), encoding='utf-8') as f:
+            old_index = json.load(f)
+        diff = self.read_json('diff/2000.json')
+        self.assertEqual({'repo': {'timestamp': 4000},
+                          'packages': {'org.example': {'metadata': {'name':
+                                                                    {'en-US': 'App 4000'}}}}},
+                         diff)
+        self.assertEqual(self.read_json('index-v2.json'),
+                         indexv2.apply_merge_patch(old_index, diff))
@@ -0,0 +1,123 @@
+import io
+from unittest.mock import MagicMock, Mock, patch
+
+import requests
+from django.test import override_settings
+
+from repomaker import mirrors
+
+from . import RmTestCase
+
+MIRROR_URLS = ['https://example.org/repo', 'https://mirror1.example.org/repo',
+               'https://mirror2.example.org/repo']
+
+
+def get_http_error(status_code):
+    return requests.exceptions.HTTPError(response=Mock(status_code=status_code))
+
+
+@override_settings(MIRROR_RETRY_DELAY=60, MIRROR_MAX_RETRY_DELAY=600)
+class MirrorsTest(RmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        mirrors._mirrors.clear()  # pylint: disable=protected-access
+
+    def test_get_ordered_prefers_low_latency(self):
+        for _ in range(20):
+            mirrors.record_success(MIRROR_URLS[0], 2)
+            mirrors.record_success(MIRROR_URLS[1], 0.1)
+            mirrors.record_success(MIRROR_URLS[2], 2)
+        self.assertAlmostEqual(0.1, mirrors.get_mirror(MIRROR_URLS[1]).latency, places=2)
+
+        first = [mirrors.get_ordered(MIRROR_URLS)[0] for _ in range(1000)]
+
+        # assert that the fastest mirror is preferred, but the others are still used
+        self.assertGreater(first.count(MIRROR_URLS[1]), 850)
+        self.assertLess(first.count(MIRROR_URLS[1]), 1000)
+
+    def test_get_ordered_puts_failed_mirrors_last(self):
+        mirrors.record_failure(MIRROR_URLS[1])
+        mirrors.record_failure(MIRROR_URLS[1])
+        mirrors.record_failure(MIRROR_URLS[0])
+
+        for _ in range(10):
+            self.assertEqual([MIRROR_URLS[2], MIRROR_URLS[0], MIRROR_URLS[1]],
+                             mirrors.get_ordered(MIRROR_URLS))
+
+        # assert that the delay doubles with each failure
+        self.assertAlmostEqual(60, mirrors.get_mirror(MIRROR_URLS[1]).retry_at -
+                               mirrors.get_mirror(MIRROR_URLS[0]).retry_at, delta=1)
+
+        # assert that a success makes the mirror healthy again
+        mirrors.record_success(MIRROR_URLS[1], 0.1)
+        self.assertTrue(mirrors.get_mirror(MIRROR_URLS[1]).is_healthy(0))
+        self.assertEqual(0, mirrors.get_mirror(MIRROR_URLS[1]).failures)
+
+    def test_resolve(self):
+        resolved = mirrors.resolve(MIRROR_URLS[0] + '/icons/icon.png', MIRROR_URLS,
+                                   exclude=[MIRROR_URLS[2]])
+        self.assertEqual({(MIRROR_URLS[0], MIRROR_URLS[0] + '/icons/icon.png'),
+                          (MIRROR_URLS[1], MIRROR_URLS[1] + '/icons/icon.png')}, set(resolved))
+
+        # assert that URLs that are not in the repository are used as they are
+        self.assertEqual([(None, 'https://other.example.org/icon.png')],
+                         mirrors.resolve('https://other.example.org/icon.png', MIRROR_URLS))
+
+    @patch('repomaker.downloads.http_get')
+    def test_http_get_fails_over(self, http_get):
+        mirrors.record_failure(MIRROR_URLS[2])  # so the order is known
+        mirrors.record_success(MIRROR_URLS[0], 0.001)
+        mirrors.record_success(MIRROR_URLS[1], 100)
+        http_get.side_effect = [requests.exceptions.ConnectionError(), (b'icon', 'etag')]
+
+        with patch('random.choices', return_value=[0]):
+            content = mirrors.http_get(MIRROR_URLS[0] + '/icon.png', MIRROR_URLS, 'old')
+
+        self.assertEqual((b'icon', 'etag'), content)
+        self.assertEqual([((MIRROR_URLS[0] + '/icon.png', 'old'),),
+                          ((MIRROR_URLS[1] + '/icon.png', 'old'),)], http_get.call_args_list)
+        self.assertFalse(mirrors.get_mirror(MIRROR_URLS[0]).is_healthy(0))
+        self.assertTrue(mirrors.get_mirror(MIRROR_URLS[1]).is_healthy(0))
+
+    @patch('repomaker.downloads.http_get')
+    def test_http_get_missing_file(self, http_get):
+        http_get.side_effect = get_http_error(404)
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            mirrors.http_get(MIRROR_URLS[0] + '/icon.png', MIRROR_URLS)
+
+        # assert that all mirrors were tried, but none marked as failed
+        self.assertEqual(3, http_get.call_count)
+        for url in MIRROR_URLS:
+            self.assertTrue(mirrors.get_mirror(url).is_healthy(0))
+
+    @patch('repomaker.downloads.http_get')
+    def test_http_get_client_error(self, http_get):
+        http_get.side_effect = get_http_error(403)
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            mirrors.http_get(MIRROR_URLS[0] + '/icon.png', MIRROR_URLS)
+        self.assertEqual(1, http_get.call_count)
+
+    @patch('repomaker.downloads.get')
+    def test_download_fails_over_while_streaming(self, get):
+        def iter_content(_):
+            yield b'broken'
+            raise requests.exceptions.ChunkedEncodingError()
+        broken = MagicMock()
+        broken.iter_content = iter_content
+        response = MagicMock()
+        response.iter_content.return_value = [b'file']
+        get.side_effect = [broken, response]
+
+        f = io.BytesIO(b'start ')
+        f.seek(0, io.SEEK_END)
+        mirrors.download(MIRROR_URLS[0] + '/index.json', MIRROR_URLS, f)
+
+        # assert that only the content from the second mirror is in the file
+        self.assertEqual(b'start file', f.getvalue())
+        self.assertEqual(2, get.call_count)
+        self.assertNotEqual(get.call_args_list[0][0][0], get.call_args_list[1][0][0])
+        failed_mirror_url = get.call_args_list[0][0][0][:-len('/index.json')]
+        self.assertFalse(mirrors.get_mirror(failed_mirror_url).is_healthy(0))
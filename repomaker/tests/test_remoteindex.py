@@ -0,0 +1,328 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import TestCase
+from unittest.mock import MagicMock, Mock, patch
+
+import requests
+from fdroidserver.exception import VerificationException
+
+from repomaker import remoteindex
+from repomaker.remoteindex import RepoIndex, RepoIndexV2
+
+FINGERPRINT = '2E428F3BFCECAE8C0CE9B9E756F6F888044099F3DD0514464DDC90BBF3199EF8'
+
+INDEX_V2 = {
+    'repo': {'name': {'en-US': 'Test'}, 'timestamp': 2000},
+    'packages': {
+        'org.example': {
+            'metadata': {'name': {'en-US': 'Example'}, 'lastUpdated': 2000},
+            'versions': {'hash1': {'file': {'name': '/org.example_1.apk', 'sha256': 'hash1',
+                                            'size': 42},
+                                   'manifest': {'versionCode': 1, 'versionName': '1.0'}}},
+        },
+        'org.example.unchanged': {
+            'metadata': {'name': {'en-US': 'Unchanged'}, 'lastUpdated': 1000},
+            'versions': {},
+        },
+        'org.example.removed': {
+            'metadata': {'name': {'en-US': 'Removed'}, 'lastUpdated': 1000},
+            'versions': {},
+        },
+    },
+}
+
+INDEX = {
+    'packages': {
+        'org.example': [{'packageName': 'org.example', 'versionCode': 2},
+                        {'packageName': 'org.example', 'versionCode': 1}],
+        'org.example.ümlaut': [{'packageName': 'org.example.ümlaut', 'size': 1234567890}],
+    },
+    'repo': {'name': 'Test', 'timestamp': 1234567890123},
+    'requests': {'install': [], 'uninstall': []},
+    'apps': [
+        {'packageName': 'org.example', 'name': 'Ünïcödé 😀 ' * 100,
+         'localized': {'en-US': {'phoneScreenshots': ['1.png', '2.png']}}},
+        {'packageName': 'org.example.ümlaut', 'name': 'Test', 'added': 1234567890123},
+    ],
+}
+
+
+class RepoIndexTest(TestCase):
+
+    @staticmethod
+    def get_repo_index(data, **kwargs):
+        f = tempfile.TemporaryFile()
+        f.write(json.dumps(data, ensure_ascii=False, **kwargs).encode('utf-8'))
+        return RepoIndex(f)
+
+    def test_read(self):
+        repo_index = self.get_repo_index(INDEX)
+
+        self.assertEqual(INDEX['repo'], repo_index['repo'])
+        self.assertEqual(2, len(repo_index['apps']))
+        self.assertEqual(INDEX['apps'], list(repo_index['apps']))
+        self.assertEqual(set(INDEX['packages'].keys()), set(repo_index['packages'].keys()))
+        self.assertNotIn('org.missing', repo_index['packages'])
+
+        # assert that packages can be read while iterating over the apps
+        for app in repo_index['apps']:
+            self.assertEqual(INDEX['packages'][app['packageName']],
+                             repo_index['packages'][app['packageName']])
+        repo_index.close()
+
+    @patch('repomaker.remoteindex.INDEX_CHUNK_SIZE', 7)
+    def test_read_small_chunks(self):
+        # chunks end within multi-byte characters, numbers and values
+        repo_index = self.get_repo_index(INDEX, indent=3)
+        self.assertEqual(INDEX['apps'], list(repo_index['apps']))
+        self.assertEqual(INDEX['packages']['org.example.ümlaut'],
+                         repo_index['packages']['org.example.ümlaut'])
+
+    def test_read_empty(self):
+        repo_index = self.get_repo_index({'repo': {}, 'apps': [], 'packages': {}})
+        self.assertEqual(0, len(repo_index['apps']))
+        self.assertEqual([], list(repo_index['apps']))
+        self.assertEqual(0, len(repo_index['packages']))
+
+    def test_read_invalid(self):
+        f = tempfile.TemporaryFile()
+        f.write(b'{"repo": {}, "apps": [{"packageName": "org.example"} {}]}')
+        with self.assertRaises(ValueError):
+            RepoIndex(f)
+
+    def test_read_malformed(self):
+        for content in [b'', b'[]', b'{"repo": {}', b'{"repo" {}}', b'{"repo": {},}',
+                        b'{1: {}}', b'{"apps": [{}, ]}', b'{"apps": [{"a": tru}]}',
+                        b'{"repo": "\xff"}', b'{"packages": {"org.example": [}}']:
+            with self.subTest(content=content):
+                f = tempfile.TemporaryFile()
+                f.write(content)
+                with self.assertRaises(ValueError):
+                    RepoIndex(f)
+                f.close()
+
+
+class DownloadRepoIndexTest(TestCase):
+
+    def setUp(self):
+        jar = io.BytesIO()
+        with zipfile.ZipFile(jar, 'w') as f:
+            f.writestr('index-v1.json', json.dumps(INDEX))
+        self.jar = jar.getvalue()
+        self.url = 'https://example.org/fdroid/repo?fingerprint=' + FINGERPRINT
+
+    @patch('fdroidserver.index.get_public_key_from_jar')
+    @patch('fdroidserver.common.verify_jar_signature')
+    @patch('repomaker.downloads.get')
+    def test_download_repo_index(self, get, verify_jar_signature, get_public_key_from_jar):
+        not_found = MagicMock()
+        not_found.raise_for_status.side_effect = \
+            requests.exceptions.HTTPError(response=Mock(status_code=404))
+        response = MagicMock()
+        response.iter_content.return_value = [self.jar[:100], self.jar[100:]]
+        response.headers = {'ETag': 'etag'}
+        get.side_effect = [not_found, response]
+        get_public_key_from_jar.return_value = b'key', FINGERPRINT
+
+        repo_index, etag = remoteindex.download_repo_index(self.url)
+
+        # assert that the index v1 was downloaded and verified, because there is no index v2
+        get.assert_called_with('https://example.org/fdroid/repo/index-v1.jar', stream=True)
+        self.assertTrue(verify_jar_signature.called)
+        self.assertEqual('etag', etag)
+
+        # assert that the index can be read and got the public key added
+        self.assertEqual('6b6579', repo_index['repo']['pubkey'])
+        self.assertEqual(FINGERPRINT, repo_index['repo']['fingerprint'])
+        self.assertEqual(INDEX['apps'], list(repo_index['apps']))
+
+    @patch('fdroidserver.index.get_public_key_from_jar')
+    @patch('fdroidserver.common.verify_jar_signature')
+    @patch('repomaker.downloads.get')
+    def test_download_repo_index_wrong_fingerprint(self, get, verify_jar_signature,
+                                                   get_public_key_from_jar):
+        get.return_value.iter_content.return_value = [self.jar]
+        get_public_key_from_jar.return_value = b'key', 'other fingerprint'
+
+        with self.assertRaises(VerificationException):
+            remoteindex.download_repo_index(self.url)
+        self.assertTrue(verify_jar_signature.called)
+
+    def test_download_repo_index_without_fingerprint(self):
+        with self.assertRaises(VerificationException):
+            remoteindex.download_repo_index('https://example.org/fdroid/repo')
+
+    @patch('repomaker.downloads.get')
+    @patch('repomaker.downloads.get_session')
+    def test_download_repo_index_unchanged(self, get_session, get):
+        get_session.return_value.head.return_value.headers = {'ETag': 'etag'}
+
+        self.assertEqual((None, 'etag'), remoteindex.download_repo_index(self.url, 'etag'))
+        self.assertFalse(get.called)
+
+
+def get_jar(file_name, data):
+    jar = io.BytesIO()
+    with zipfile.ZipFile(jar, 'w') as f:
+        f.writestr(file_name, json.dumps(data))
+    return jar.getvalue()
+
+
+def get_file_entry(name, content):
+    return {'name': name, 'sha256': hashlib.sha256(content).hexdigest(), 'size': len(content)}
+
+
+@patch('fdroidserver.index.get_public_key_from_jar', Mock(return_value=(b'key', FINGERPRINT)))
+@patch('fdroidserver.common.verify_jar_signature', Mock())
+class DownloadRepoIndexV2Test(TestCase):
+
+    def setUp(self):
+        self.url = 'https://example.org/fdroid/repo?fingerprint=' + FINGERPRINT
+        self.files = dict()  # the content of the files in the repository by path
+        self.index = json.dumps(INDEX_V2).encode('utf-8')
+        self.entry = {'timestamp': 2000, 'index': get_file_entry('/index-v2.json', self.index),
+                      'diffs': {}}
+        self.files['/index-v2.json'] = self.index
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmp_dir, 'remote_repo_1', 'index-v2.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get(self, url, stream=False):
+        self.assertTrue(stream)
+        path = url[len('https://example.org/fdroid/repo'):]
+        if path == '/entry.jar' and self.entry is not None:
+            self.files[path] = get_jar('entry.json', self.entry)
+        response = MagicMock()
+        response.headers = {'ETag': 'etag'}
+        if path in self.files:
+            response.iter_content.return_value = [self.files[path]]
+        else:
+            response.raise_for_status.side_effect = \
+                requests.exceptions.HTTPError(response=Mock(status_code=404))
+        return response
+
+    def download(self):
+        with patch('repomaker.downloads.get', side_effect=self.get) as get:
+            repo_index, etag = remoteindex.download_repo_index(self.url,
+                                                               last_index_path=self.index_path)
+        self.assertEqual('etag', etag)
+        return repo_index, [call[0][0] for call in get.call_args_list]
+
+    def test_download_full_index(self):
+        repo_index, urls = self.download()
+
+        self.assertEqual(['https://example.org/fdroid/repo/entry.jar',
+                          'https://example.org/fdroid/repo/index-v2.json'], urls)
+        self.assertIsInstance(repo_index, RepoIndexV2)
+        self.assertEqual('Test', repo_index['repo']['name'])
+        self.assertEqual(2000, repo_index['repo']['timestamp'])
+        self.assertEqual(FINGERPRINT, repo_index['repo']['fingerprint'])
+        self.assertNotIn('removed', repo_index)
+
+        # assert that the index can be synced like index v1
+        apps = list(repo_index['apps'])
+        self.assertEqual(['org.example', 'org.example.unchanged', 'org.example.removed'],
+                         [app['packageName'] for app in apps])
+        self.assertEqual('Example', apps[0]['localized']['en-US']['name'])
+        self.assertEqual([{'packageName': 'org.example', 'apkName': 'org.example_1.apk',
+                           'hash': 'hash1', 'hashType': 'sha256', 'size': 42, 'versionCode': 1,
+                           'versionName': '1.0'}], repo_index['packages']['org.example'])
+
+        # assert that storing the index writes it as it was downloaded
+        remoteindex.store_repo_index(repo_index, self.index_path)
+        with open(self.index_path, 'rb') as f:
+            self.assertEqual(self.index, f.read())
+
+    def test_download_diff(self):
+        os.makedirs(os.path.dirname(self.index_path))
+        with open(self.index_path, 'wb') as f:
+            f.write(self.index)
+        diff = json.dumps({
+            'repo': {'timestamp': 3000},
+            'packages': {
+                'org.example': {'metadata': {'name': {'en-US': 'Changed'}}},
+                'org.example.new': {'metadata': {'name': {'en-US': 'New'}}, 'versions': {}},
+                'org.example.removed': None,
+            },
+        }).encode('utf-8')
+        self.files['/diff/2000.json'] = diff
+        self.entry['timestamp'] = 3000
+        self.entry['diffs'] = {'2000': get_file_entry('/diff/2000.json', diff)}
+
+        repo_index, urls = self.download()
+
+        # assert that only the diff was downloaded and only the changed apps are synced
+        self.assertEqual(['https://example.org/fdroid/repo/entry.jar',
+                          'https://example.org/fdroid/repo/diff/2000.json'], urls)
+        self.assertEqual(3000, repo_index['repo']['timestamp'])
+        self.assertEqual(['org.example', 'org.example.new'],
+                         [app['packageName'] for app in repo_index['apps']])
+        self.assertEqual('Changed', next(iter(repo_index['apps']))['localized']['en-US']['name'])
+        self.assertEqual(['org.example.removed'], repo_index['removed'])
+        self.assertEqual({'org.example', 'org.example.unchanged', 'org.example.new'},
+                         set(repo_index['packages'].keys()))
+
+        # assert that the stored index has the diff applied
+        remoteindex.store_repo_index(repo_index, self.index_path)
+        with open(self.index_path, encoding='utf-8') as f:
+            index = json.load(f)
+        self.assertEqual(3000, index['repo']['timestamp'])
+        self.assertEqual({'en-US': 'Changed'},
+                         index['packages']['org.example']['metadata']['name'])
+        self.assertEqual(INDEX_V2['packages']['org.example']['versions'],
+                         index['packages']['org.example']['versions'])
+        self.assertNotIn('org.example.removed', index['packages'])
+
+    def test_download_unchanged_timestamp(self):
+        os.makedirs(os.path.dirname(self.index_path))
+        with open(self.index_path, 'wb') as f:
+            f.write(self.index)
+
+        repo_index, urls = self.download()
+
+        self.assertEqual(['https://example.org/fdroid/repo/entry.jar'], urls)
+        self.assertEqual([], list(repo_index['apps']))
+        self.assertEqual([], repo_index['removed'])
+
+    def test_download_invalid_hash(self):
+        self.files['/index-v2.json'] = b'{}'
+        temporary_files = []
+
+        def create_temporary_file():
+            temporary_files.append(temporary_file(mode='w+b'))
+            return temporary_files[-1]
+        temporary_file = tempfile.TemporaryFile
+
+        with self.assertRaises(VerificationException), \
+                patch('tempfile.TemporaryFile', side_effect=create_temporary_file):
+            self.download()
+
+        # assert that the temporary file of the index was closed
+        self.assertTrue(temporary_files)
+        self.assertTrue(all(f.closed for f in temporary_files))
+
+    def test_download_index_v1_fallback(self):
+        # the repository has no entry.jar
+        self.entry = None
+        self.files['/index-v1.jar'] = get_jar('index-v1.json', INDEX)
+
+        repo_index, urls = self.download()
+
+        self.assertEqual(['https://example.org/fdroid/repo/entry.jar',
+                          'https://example.org/fdroid/repo/index-v1.jar'], urls)
+        self.assertIsInstance(repo_index, RepoIndex)
+        self.assertEqual(INDEX['apps'], list(repo_index['apps']))
+
+        # assert that a stored index v2 gets removed
+        os.makedirs(os.path.dirname(self.index_path))
+        with open(self.index_path, 'wb') as f:
+            f.write(self.index)
+        remoteindex.store_repo_index(repo_index, self.index_path)
+        self.assertFalse(os.path.exists(self.index_path))
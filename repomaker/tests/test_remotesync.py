@@ -0,0 +1,107 @@
+import fcntl
+import os
+import threading
+from unittest.mock import patch
+
+from django.conf import settings
+from django.test import override_settings
+
+from repomaker import downloads, remotesync
+
+from . import RmTestCase
+
+
+@override_settings(REMOTE_SYNC_WORKERS=3, REMOTE_SYNC_WORKERS_PER_HOST=2, REMOTE_SYNC_TIMEOUT=60)
+class RemoteSyncExecutorTest(RmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.executor = remotesync.RemoteSyncExecutor()
+
+    def tearDown(self):
+        self.executor.shutdown()
+        super().tearDown()
+
+    def test_limits(self):
+        release = threading.Event()
+        self.executor.submit('example.org', release.wait)
+        self.executor.submit('example.org', release.wait)
+
+        # assert that a third sync can only run for another host
+        self.assertFalse(self.executor.can_submit('example.org'))
+        self.assertTrue(self.executor.can_submit('example.com'))
+        self.executor.submit('example.com', release.wait)
+
+        # assert that no further sync can run at all
+        self.assertTrue(self.executor.is_full())
+        self.assertFalse(self.executor.can_submit('example.net'))
+
+        release.set()
+        self.assertTrue(self.executor.wait())
+        self.assertFalse(self.executor.is_full())
+        while self.executor.wait():
+            pass
+        self.assertTrue(self.executor.can_submit('example.org'))
+
+    def test_database_lock(self):
+        events = []
+        downloading = threading.Event()
+        downloaded = threading.Event()
+
+        def slow_sync():
+            events.append('slow start')
+            with remotesync.database_unlocked():
+                downloading.set()
+                downloaded.wait()
+            events.append('slow end')
+
+        def fast_sync():
+            events.append('fast')
+            downloaded.set()
+
+        self.executor.submit('example.org', slow_sync)
+        downloading.wait()
+        self.executor.submit('example.com', fast_sync)
+        while self.executor.wait():
+            pass
+
+        # assert that the fast sync used the database while the slow one downloaded
+        self.assertEqual(['slow start', 'fast', 'slow end'], events)
+
+    @override_settings(REMOTE_SYNC_TIMEOUT=0)
+    @patch('repomaker.downloads.get_session')
+    def test_timeout(self, get_session):
+        executor = remotesync.RemoteSyncExecutor()
+        executor.submit('example.org', downloads.http_get, 'https://example.org/icon.png')
+        executor.shutdown()
+
+        # assert that the download was aborted before it started
+        get_session.return_value.get.assert_not_called()
+
+    def test_database_unlocked_without_lock(self):
+        with remotesync.database_unlocked():
+            pass
+        # assert that the lock is still free
+        with remotesync.database_lock():
+            pass
+
+    def test_database_lock_file(self):
+        def is_locked_by_other_process():
+            # flock() locks of different open files conflict, like those of other processes
+            path = os.path.join(settings.PRIVATE_REPO_ROOT, remotesync.LOCK_FILE_NAME)
+            with open(path, 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return True
+                fcntl.flock(f, fcntl.LOCK_UN)
+                return False
+
+        with remotesync.database_lock():
+            # assert that other processes can not use the database
+            self.assertTrue(is_locked_by_other_process())
+            with remotesync.database_unlocked():
+                # assert that other processes can use the database while downloading
+                self.assertFalse(is_locked_by_other_process())
+            self.assertTrue(is_locked_by_other_process())
+        self.assertFalse(is_locked_by_other_process())
@@ -0,0 +1,67 @@
+import os
+from unittest.mock import patch
+
+from django.conf import settings
+from django.test import override_settings
+from fdroidserver.exception import BuildException
+
+from repomaker.models.repository import AbstractRepository
+from repomaker.scan import ApkScanError, InvalidSignatureError, scan_apk, scan_apks
+
+from . import RmTestCase
+
+
+class ScanTest(RmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        AbstractRepository().get_config()  # scanning needs the paths to fdroidserver's tools
+        self.paths = [os.path.join(settings.TEST_FILES_DIR, name) for name in
+                      ['test_1.apk', 'test_invalid_signature.apk', 'test_2.apk']]
+
+    @patch('fdroidserver.common.verify_old_apk_signature')
+    @patch('fdroidserver.verify_apk_signature')
+    def test_scan_apk_with_disabled_algorithm(self, verify_apk_signature,
+                                              verify_old_apk_signature):
+        verify_apk_signature.return_value = False
+        verify_old_apk_signature.return_value = True
+
+        # assert that old signatures are rejected by default
+        with self.assertRaises(InvalidSignatureError):
+            scan_apk(self.paths[0])
+
+        # assert that old signatures are accepted, but marked, if disabled algorithms are allowed
+        scan_result = scan_apk(self.paths[0], allow_disabled_algorithms=True)
+        self.assertEqual({'KnownVuln', 'DisabledAlgorithm'}, scan_result['antiFeatures'])
+
+    @patch('fdroidserver.scan_apk')
+    @patch('fdroidserver.verify_apk_signature')
+    def test_scan_apks_in_order(self, verify_apk_signature, fdroid_scan_apk):
+        verify_apk_signature.side_effect = lambda path: 'invalid' not in path
+        fdroid_scan_apk.side_effect = [{'packageName': 'first', 'antiFeatures': set()},
+                                       BuildException('broken')]
+
+        scan_results = scan_apks(self.paths)
+
+        # assert that each path got its result or error in the same order
+        self.assertEqual(3, len(scan_results))
+        self.assertEqual('first', scan_results[0]['packageName'])
+        self.assertIsInstance(scan_results[1], InvalidSignatureError)
+        self.assertIsInstance(scan_results[2], ApkScanError)
+
+    @patch('fdroidserver.common.config', None)
+    def test_scan_apks_without_config(self):
+        with self.assertRaises(AssertionError):
+            scan_apks(self.paths)
+
+    @override_settings(APK_SCAN_WORKERS=2)
+    def test_scan_apks_in_parallel(self):
+        scan_results = scan_apks(self.paths)
+
+        # assert that results of the parallel processes are returned in the same order
+        self.assertEqual(3, len(scan_results))
+        self.assertEqual('org.bitbucket.tickytacky.mirrormirror', scan_results[0]['packageName'])
+        self.assertEqual(2, scan_results[0]['versionCode'])
+        self.assertIsInstance(scan_results[1], InvalidSignatureError)
+        self.assertEqual('org.bitbucket.tickytacky.mirrormirror', scan_results[2]['packageName'])
+        self.assertEqual(3, scan_results[2]['versionCode'])
@@ -0,0 +1,77 @@
+import os
+
+from django.conf import settings
+
+from repomaker.storage import copy_if_changed, get_blob_path, write_if_changed, RepoStorage
+
+from . import RmTestCase
+
+
+class StorageTest(RmTestCase):
+
+    def setUp(self):
+        super().setUp()
+        if not os.path.isdir(settings.TEST_DIR):
+            os.makedirs(settings.TEST_DIR)
+        self.source = os.path.join(settings.TEST_DIR, 'source')
+        self.target = os.path.join(settings.TEST_DIR, 'target')
+
+    def test_write_if_changed(self):
+        self.assertTrue(write_if_changed(self.target, 'content'))
+        os.utime(self.target, (0, 0))
+
+        # assert that the same content is not written again
+        self.assertFalse(write_if_changed(self.target, b'content'))
+        self.assertEqual(0, os.path.getmtime(self.target))
+
+        # assert that new content is written
+        self.assertTrue(write_if_changed(self.target, 'new content'))
+        with open(self.target, 'r', encoding='utf8') as f:
+            self.assertEqual('new content', f.read())
+
+    def test_copy_if_changed(self):
+        write_if_changed(self.source, 'content')
+
+        # assert that the file gets copied once
+        self.assertTrue(copy_if_changed(self.source, self.target))
+        self.assertFalse(os.path.samefile(self.source, self.target))
+        self.assertFalse(copy_if_changed(self.source, self.target))
+
+        # assert that a changed file gets copied again
+        write_if_changed(self.source, 'new content')
+        self.assertTrue(copy_if_changed(self.source, self.target))
+        with open(self.target, 'r', encoding='utf8') as f:
+            self.assertEqual('new content', f.read())
+
+    def test_copy_if_changed_replaces_link(self):
+        write_if_changed(self.source, 'content')
+        os.link(self.source, self.target)
+
+        # assert that the link is replaced by a copy that does not change the source
+        self.assertTrue(copy_if_changed(self.source, self.target))
+        self.assertFalse(os.path.samefile(self.source, self.target))
+        write_if_changed(self.target, 'other content')
+        with open(self.source, 'r', encoding='utf8') as f:
+            self.assertEqual('content', f.read())
+
+    def test_get_blob_path(self):
+        file_hash = '7733e133eec140ab5e410f69955a4cba4a61133437ba436e92b75f03cbabfd52'
+        self.assertEqual(os.path.join('blobs', '77', '33', file_hash, 'test_1.apk'),
+                         get_blob_path(file_hash, 'test_1.apk'))
+
+    def test_repo_storage_link(self):
+        storage = RepoStorage(location=settings.TEST_DIR)
+        write_if_changed(self.source, 'content')
+
+        # assert that linking again keeps the name of the link
+        self.assertEqual('repo/target', storage.link('source', 'repo/target'))
+        self.assertEqual('repo/target', storage.link('source', 'repo/target'))
+        self.assertTrue(os.path.samefile(self.source, storage.path('repo/target')))
+
+        # assert that a different file does not replace the existing link
+        write_if_changed(self.target, 'other content')
+        new_target = storage.link('target', 'repo/target')
+        self.assertNotEqual('repo/target', new_target)
+        self.assertTrue(os.path.samefile(self.source, storage.path('repo/target')))
+        self.assertTrue(os.path.samefile(self.target, storage.path(new_target)))
+        self.assertEqual(2, len(os.listdir(storage.path('repo'))))
@@ -1,12 +1,15 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch
 
-import requests
+import background_task.tasks
 from background_task.tasks import Task
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone as django_timezone
 from repomaker import tasks
-from repomaker.models import Repository, RemoteRepository, App, RemoteApp, Apk, RemoteScreenshot
+from repomaker.models import Repository, RemoteRepository, App, RemoteApp, Apk, RemoteScreenshot, \
+    TaskTiming, Upload
 
 
 class TasksTest(TestCase):
@@ -22,14 +25,19 @@ class TasksTest(TestCase):
 
         tasks.update_repo.now(repo.id)  # this repo actually exists
 
-        # assert that repository was updated and published
-        update.assert_called_once_with()
+        # assert that repository was updated incrementally and published
+        update.assert_called_once_with(incremental=True)
         publish.assert_called_once_with()
 
         # assert that repository is in correct state
         self.assertFalse(repo.update_scheduled)
         self.assertFalse(repo.is_updating)
 
+        # assert that the timing of the update was recorded
+        timing = TaskTiming.objects.get(repo=repo)
+        self.assertEqual('update_repo', timing.task_name)
+        self.assertTrue(timing.succeeded)
+
     @patch('repomaker.models.repository.Repository.publish')
     @patch('repomaker.models.repository.Repository.update')
     def test_update_repo_gone(self, update, publish):
@@ -51,6 +59,92 @@ class TasksTest(TestCase):
         self.assertFalse(update.called)
         self.assertFalse(publish.called)
 
+    @patch('repomaker.models.repository.Repository.publish')
+    @patch('repomaker.models.repository.Repository.update')
+    def test_update_repo_claimed_concurrently(self, update, publish):
+        # load the repository before another worker starts updating it
+        repo = Repository.objects.create(user=User.objects.create())
+        Repository.objects.filter(pk=repo.pk).update(is_updating=True)
+
+        with patch('repomaker.models.Repository.objects.get', return_value=repo):
+            tasks.update_repo.now(repo.id)
+
+        # assert that nothing was updated and published and the other update keeps running
+        self.assertFalse(update.called)
+        self.assertFalse(publish.called)
+        self.assertTrue(Repository.objects.get(pk=repo.pk).is_updating)
+
+    @patch('repomaker.models.repository.Repository.publish')
+    @patch('repomaker.models.repository.Repository.update')
+    def test_update_repo_waits_for_quiet_period(self, update, publish):
+        # create a repository that had an update requested just now
+        repo = Repository.objects.create(user=User.objects.create(), update_scheduled=True,
+                                         update_requested_date=django_timezone.now())
+
+        tasks.update_repo.now(repo.id)
+
+        # assert that nothing was updated, but the update was scheduled again
+        self.assertFalse(update.called)
+        self.assertFalse(publish.called)
+        self.assertEqual(1, Task.objects.filter(task_name='repomaker.tasks.update_repo').count())
+        task = Task.objects.get(task_name='repomaker.tasks.update_repo')
+        quiet_period = timedelta(seconds=settings.REPO_UPDATE_QUIET_PERIOD)
+        self.assertEqual(repo.update_requested_date + quiet_period, task.run_at)
+        self.assertTrue(Repository.objects.get(pk=repo.pk).update_scheduled)
+
+    @patch('repomaker.models.repository.Repository.publish')
+    @patch('repomaker.models.repository.Repository.update')
+    def test_update_repo_after_quiet_period(self, update, publish):
+        # create a repository that had its last update request a while ago
+        quiet_period = timedelta(seconds=settings.REPO_UPDATE_QUIET_PERIOD)
+        requested_date = django_timezone.now() - quiet_period - timedelta(seconds=1)
+        repo = Repository.objects.create(user=User.objects.create(), update_scheduled=True,
+                                         update_requested_date=requested_date)
+
+        tasks.update_repo.now(repo.id)
+
+        # assert that repository was updated and is in correct state
+        update.assert_called_once_with(incremental=True)
+        publish.assert_called_once_with()
+        repo = Repository.objects.get(pk=repo.pk)
+        self.assertFalse(repo.update_scheduled)
+        self.assertFalse(repo.is_updating)
+        self.assertFalse(Task.objects.exists())
+
+    @patch('repomaker.models.repository.Repository.publish')
+    @patch('repomaker.models.repository.Repository.update')
+    def test_update_repo_scheduled_while_running(self, update, publish):
+        # create a repository that is updating and has a follow-up update scheduled
+        repo = Repository.objects.create(user=User.objects.create(), update_scheduled=True,
+                                         is_updating=True)
+
+        tasks.update_repo.now(repo.id)
+
+        # assert that nothing was updated, but the follow-up update was not dropped
+        self.assertFalse(update.called)
+        self.assertFalse(publish.called)
+        self.assertEqual(1, Task.objects.filter(task_name='repomaker.tasks.update_repo').count())
+
+    @patch('repomaker.models.repository.Repository.publish')
+    @patch('repomaker.models.repository.Repository.update')
+    def test_update_repo_coalesces_requests_while_running(self, update, publish):
+        repo = Repository.objects.create(user=User.objects.create())
+
+        def request_updates(**kwargs):
+            # other processes request several updates while the update is running
+            for _ in range(3):
+                Repository.objects.get(pk=repo.pk).update_async()
+        update.side_effect = request_updates
+
+        tasks.update_repo.now(repo.id)
+
+        # assert that exactly one follow-up update was scheduled
+        publish.assert_called_once_with()
+        self.assertEqual(1, Task.objects.filter(task_name='repomaker.tasks.update_repo').count())
+        repo = Repository.objects.get(pk=repo.pk)
+        self.assertTrue(repo.update_scheduled)
+        self.assertFalse(repo.is_updating)
+
     @patch('repomaker.models.remoterepository.RemoteRepository.update_index')
     def test_update_remote_repo(self, update_index):
         # get an actual (pre-installed) remote repository and update its scheduling state
@@ -67,6 +161,16 @@ class TasksTest(TestCase):
         self.assertFalse(repo.update_scheduled)
         self.assertFalse(repo.is_updating)
 
+        # assert that the timing of the update was recorded
+        self.assertEqual('update_remote_repo', TaskTiming.objects.get(remote_repo=repo).task_name)
+
+        # assert that the next update was scheduled after the grown interval
+        repo = RemoteRepository.objects.get(pk=1)
+        self.assertEqual(settings.REMOTE_UPDATE_INTERVAL * 1.5, repo.update_interval)
+        task = Task.objects.get(task_name='repomaker.tasks.update_remote_repo')
+        self.assertEqual(repo.next_update_date, task.run_at)
+        self.assertTrue(task.run_at > django_timezone.now() + timedelta(days=1))
+
     @patch('repomaker.models.remoterepository.RemoteRepository.update_index')
     def test_update_remote_repo_gone(self, update_index):
         tasks.update_remote_repo.now(1337)  # this repo ID doesn't exist (anymore?)
@@ -105,6 +209,37 @@ class TasksTest(TestCase):
         # assert that nothing was updated and published
         self.assertFalse(update_icon.called)
 
+    @patch('repomaker.models.remoteapp.RemoteApp.update_icon')
+    def test_update_remote_app_icons(self, update_icon):
+        remote_apps = [RemoteApp.objects.create(
+            repo=RemoteRepository.objects.get(pk=1), package_id='org.example%d' % i,
+            last_updated_date=datetime.fromtimestamp(0, timezone.utc)
+        ) for i in range(2)]
+        update_icon.side_effect = [Exception('Test'), None]
+
+        # the second app doesn't exist (anymore?) and the first one fails
+        tasks.update_remote_app_icons.now([[remote_apps[0].id, 'icon1'], [1337, 'icon2'],
+                                           [remote_apps[1].id, 'icon3']])
+
+        # assert that the icons of all existing apps were updated regardless
+        self.assertEqual([(('icon1',),), (('icon3',),)], update_icon.call_args_list)
+
+    @patch('repomaker.models.upload.Upload.process')
+    def test_process_upload(self, process):
+        upload = Upload.objects.create(repo=Repository.objects.create(user=User.objects.create()))
+
+        tasks.process_upload.now(upload.id)
+
+        # assert that the uploaded files were added
+        process.assert_called_once_with()
+
+    @patch('repomaker.models.upload.Upload.process')
+    def test_process_upload_gone(self, process):
+        tasks.process_upload.now(1337)
+
+        # assert that nothing was processed
+        self.assertFalse(process.called)
+
     @patch('repomaker.models.apk.Apk.download')
     def test_download_apk(self, download):
         # create an APK
@@ -118,6 +253,9 @@ class TasksTest(TestCase):
         # assert that APK is in correct state
         self.assertFalse(apk.is_downloading)
 
+        # assert that the timing of the download was recorded
+        self.assertEqual('download_apk', TaskTiming.objects.get(apk=apk).task_name)
+
     @patch('repomaker.models.apk.Apk.download')
     def test_download_apk_gone(self, download):
         tasks.download_apk.now(1337, None)  # this APK ID doesn't exist (anymore?)
@@ -189,22 +327,35 @@ class TasksTest(TestCase):
         # assert that screenshot was not downloaded
         self.assertFalse(download.called)
 
-    @patch('requests.get')
-    def test_download_remote_screenshot_app_gone(self, get):
+    @patch('repomaker.downloads.http_get')
+    def test_download_remote_screenshot_app_gone(self, http_get):
         date = datetime.fromtimestamp(0, timezone.utc)
         remote_repo = RemoteRepository.objects.create(last_change_date=date)
         remote_app = RemoteApp.objects.create(repo=remote_repo, last_updated_date=date)
         screenshot = RemoteScreenshot.objects.create(app=remote_app, url='test')
 
         # fake return values of GET request
-        get.return_value.status_code = requests.codes.ok
-        get.return_value.content = b'foo'
+        http_get.return_value = b'foo', None
 
         tasks.download_remote_screenshot.now(screenshot.id, 1337)
 
         # assert that screenshot was downloaded
-        get.assert_called_once_with(screenshot.url, timeout=60)
+        http_get.assert_called_once_with(screenshot.url, None)
+
+    @patch('repomaker.models.screenshot.RemoteScreenshot.download_all')
+    def test_download_remote_screenshots(self, download_all):
+        date = datetime.fromtimestamp(0, timezone.utc)
+        remote_repo = RemoteRepository.objects.create(last_change_date=date)
+        remote_app = RemoteApp.objects.create(repo=remote_repo, last_updated_date=date)
+        screenshot1 = RemoteScreenshot.objects.create(app=remote_app)
+        screenshot2 = RemoteScreenshot.objects.create(app=remote_app)
 
+        tasks.download_remote_screenshots.now([screenshot1.id, 1337, screenshot2.id], 42)
+
+        # assert that the screenshots still existing were downloaded in one go
+        download_all.assert_called_once_with([screenshot1, screenshot2], 42)
+
+    @override_settings(REPO_UPDATE_QUIET_PERIOD=0)
     def test_priorities(self):
         # create an actual repository and an APK
         repo = Repository.objects.create(user=User.objects.create())
@@ -221,3 +372,76 @@ class TasksTest(TestCase):
         self.assertEqual('repomaker.tasks.download_apk', available_tasks[0].task_name)
         self.assertEqual('repomaker.tasks.update_repo', available_tasks[1].task_name)
         self.assertTrue(available_tasks[0].priority > available_tasks[1].priority)
+
+
+class InlineExecutor:
+    """
+    Runs syncs right away and allows only one sync per host at a time.
+    """
+
+    def __init__(self):
+        self.hosts = []
+
+    def is_full(self):
+        return len(self.hosts) >= 3
+
+    def can_submit(self, host):
+        return host not in self.hosts
+
+    def submit(self, host, func, *args):
+        self.hosts.append(host)
+        func(*args)
+
+    def wait(self):
+        return False
+
+    def shutdown(self):
+        pass
+
+
+@override_settings(REMOTE_SYNC_WORKERS=3)
+@patch('repomaker.remotesync.RemoteSyncExecutor', InlineExecutor)
+class RemoteSyncRunnerTest(TestCase):
+
+    def setUp(self):
+        Task.objects.all().delete()  # delete all initial tasks
+        self.runner = tasks.RemoteSyncRunner()
+        date = datetime.fromtimestamp(0, timezone.utc)
+        self.remote_repos = [
+            RemoteRepository.objects.create(url=url, last_change_date=date)
+            for url in ['https://example.org/repo1', 'https://example.org/repo2',
+                        'https://example.com/repo']
+        ]
+        for remote_repo in self.remote_repos:
+            tasks.update_remote_repo(remote_repo.id,  # pylint: disable=unexpected-keyword-arg
+                                     priority=tasks.PRIORITY_REMOTE_REPO)
+
+    @patch('repomaker.models.remoterepository.RemoteRepository.update_index')
+    def test_run_remote_syncs(self, update_index):
+        self.assertTrue(self.runner.run_remote_syncs(background_task.tasks.tasks))
+
+        # assert that one repository of each host was synced
+        self.assertEqual(2, update_index.call_count)
+        remaining_tasks = Task.objects.filter(task_name=tasks.UPDATE_REMOTE_REPO,
+                                              run_at__lte=django_timezone.now())
+        self.assertEqual(1, remaining_tasks.count())
+        self.assertEqual(([self.remote_repos[1].id], {}), remaining_tasks[0].params())
+
+        # assert that the synced repositories got scheduled for their next update
+        for remote_repo in [self.remote_repos[0], self.remote_repos[2]]:
+            remote_repo.refresh_from_db()
+            self.assertTrue(remote_repo.next_update_date > django_timezone.now())
+
+    @patch('repomaker.models.remoterepository.RemoteRepository.update_index')
+    def test_run_remote_syncs_after_other_tasks(self, update_index):
+        Apk.objects.create().download_async('url')
+
+        # assert that the APK download with a higher priority is left for the next run
+        self.assertFalse(self.runner.run_remote_syncs(background_task.tasks.tasks))
+        update_index.assert_not_called()
+
+    @override_settings(REMOTE_SYNC_WORKERS=1)
+    @patch('repomaker.models.remoterepository.RemoteRepository.update_index')
+    def test_run_remote_syncs_disabled(self, update_index):
+        self.assertFalse(self.runner.run_remote_syncs(background_task.tasks.tasks))
+        update_index.assert_not_called()
@@ -3,7 +3,7 @@ from django.urls import reverse
 
 import repomaker.storage
 from repomaker.models import Repository, RemoteRepository, App, Category, Screenshot, Apk, \
-    ApkPointer, GitStorage
+    ApkPointer, GitStorage, Upload, ChunkedUpload
 from repomaker.tests import RmTestCase
 from repomaker.urls import urlpatterns
 
@@ -20,6 +20,8 @@ class UrlsTest(RmTestCase):
     apk = None
     apk_pointer = None
     storage = None
+    upload = None
+    chunked_upload = None
 
     def setUp(self):
         super().setUp()
@@ -40,6 +42,9 @@ class UrlsTest(RmTestCase):
         self.apk_pointer = ApkPointer.objects.create(apk=self.apk, repo=self.test_repo,
                                                      app=self.app)
         self.storage = GitStorage.objects.create(repo=self.test_repo)
+        self.upload = Upload.objects.create(repo=self.test_repo)
+        self.chunked_upload = ChunkedUpload.objects.create(repo=self.test_repo, file_name='a.apk',
+                                                           size=1)
 
     def test_authentication(self):
         for url in urlpatterns:
@@ -65,6 +70,10 @@ class UrlsTest(RmTestCase):
                 params['app_id'] = self.app.pk
             if 's_id' in keys:
                 params['s_id'] = self.screenshot.pk
+            if 'upload_id' in keys:
+                params['upload_id'] = self.upload.pk
+            if 'chunked_upload_id' in keys:
+                params['chunked_upload_id'] = self.chunked_upload.pk
             if 'pk' in keys:
                 params['pk'] = self.apk_pointer.pk
             if 'path' in keys:
@@ -1,7 +1,7 @@
 import bleach
 from unittest import TestCase
 
-from repomaker.utils import clean
+from repomaker.utils import clean, PhaseTimer, timed_phase
 
 
 class UtilsTest(TestCase):
@@ -15,3 +15,23 @@ class UtilsTest(TestCase):
     def test_clean_only_empty_link(self):
         string = 'Link <a href="https://orbot.org">Orbot</a> is supported'
         self.assertEqual(string, clean(string))
+
+    def test_timed_phase(self):
+        with PhaseTimer() as timer:
+            with timed_phase('first', 2):
+                pass
+            with timed_phase('second') as phase:
+                phase.count = 3
+            with timed_phase('first', 1):
+                pass
+
+        # assert that phases with the same name were added up in order of their first run
+        self.assertEqual(['first', 'second'], list(timer.phases.keys()))
+        self.assertEqual(3, timer.phases['first']['count'])
+        self.assertEqual(3, timer.phases['second']['count'])
+        self.assertTrue(timer.duration >= timer.phases['first']['duration'])
+        self.assertIsNone(PhaseTimer.get_current())
+
+    def test_timed_phase_without_timer(self):
+        with timed_phase('phase', 1) as phase:
+            phase.count = 2  # nothing is measured, but this does not fail
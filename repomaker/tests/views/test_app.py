@@ -7,7 +7,7 @@ from django.urls import reverse
 from django.utils import translation
 from modeltranslation.utils import get_language
 
-from repomaker import DEFAULT_USER_NAME
+from repomaker import DEFAULT_USER_NAME, tasks
 from repomaker.models import App, Apk, ApkPointer, Repository, Screenshot, RemoteRepository, \
     RemoteApp
 from .. import RmTestCase
@@ -222,8 +222,14 @@ class AppViewTestCase(RmTestCase):
             response = self.client.post(self.app.get_edit_url(), {'apks': f},
                                         HTTP_X_REQUESTED_WITH='XMLHttpRequest',
                                         HTTP_RM_BACKGROUND_TYPE='screenshots')
-        self.assertContains(response, 'test.pdf: This file is not an update ' +
-                            'for org.bitbucket.tickytacky.mirrormirror', status_code=500)
+        self.assertEqual(202, response.status_code)
+        tasks.process_upload.now(response.json()['id'])
+        response = self.client.get(response.json()['status_url'])
+        self.assertEqual([{'name': 'test.pdf', 'state': 'failed',
+                           'error': 'This file is not an update for ' +
+                                    'org.bitbucket.tickytacky.mirrormirror'}],
+                         response.json()['files'])
+        self.assertEqual([], response.json()['apks'])
 
         self.assertEqual(1, App.objects.all().count())
         self.assertEqual(1, Apk.objects.all().count())
@@ -314,6 +320,9 @@ class AppViewTestCase(RmTestCase):
         with open(os.path.join(settings.TEST_FILES_DIR, 'test_1.apk'), 'rb') as f:
             response = self.client.post(self.app.get_edit_url(), {'apks': f},
                                         HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(202, response.status_code)
+        tasks.process_upload.now(response.json()['id'])
+        response = self.client.get(response.json()['status_url'])
 
         self.assertEqual(1, Apk.objects.all().count())
         self.assertTrue(Repository.objects.get(pk=self.repo.pk).update_scheduled)
@@ -344,6 +353,9 @@ class AppViewTestCase(RmTestCase):
         with open(os.path.join(settings.TEST_FILES_DIR, 'test_1.apk'), 'rb') as f:
             response = self.client.post(app2.get_edit_url(), {'apks': f},
                                         HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(202, response.status_code)
+        tasks.process_upload.now(response.json()['id'])
+        response = self.client.get(response.json()['status_url'])
 
         self.assertEqual(1, Apk.objects.all().count())
         self.assertEqual(2, ApkPointer.objects.all().count())
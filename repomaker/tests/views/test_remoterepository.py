@@ -8,7 +8,8 @@ from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import translation
 from repomaker.models import RemoteRepository, RemoteApp, RemoteScreenshot, \
-    RemoteApkPointer
+    RemoteApkPointer, TaskTiming
+from repomaker.utils import PhaseTimer
 
 from .. import RmTestCase
 
@@ -188,3 +189,15 @@ class RemoteRepositoryViewTest(RmTestCase):
         add_to_repo.assert_called_once_with(self.repo)
         self.assertTrue(isinstance(response, django.http.HttpResponseRedirect))
         self.assertEqual('test-url', response.url)
+
+    def test_status_json(self):
+        with PhaseTimer() as timer:
+            pass
+        TaskTiming.record('update_remote_repo', timer, remote_repo=self.remote_repo)
+
+        kwargs = {'remote_repo_id': self.remote_repo.id}
+        response = self.client.get(reverse('remote_repo_status_json', kwargs=kwargs))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.remote_repo.id, response.json()['id'])
+        self.assertEqual(1, len(response.json()['timings']))
+        self.assertEqual('update_remote_repo', response.json()['timings'][0]['task'])
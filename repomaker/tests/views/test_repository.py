@@ -1,14 +1,20 @@
 from unittest.mock import patch
 
 import os
+from background_task.models import Task
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import override_settings
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 from fdroidserver.exception import BuildException
 
-from repomaker.models import App, Apk, ApkPointer, Repository
+from repomaker import tasks
+from repomaker.models import App, Apk, ApkPointer, ChunkedUpload, Repository, TaskTiming, \
+    Upload
+from repomaker.models.app import APK
+from repomaker.utils import PhaseTimer, timed_phase
 from repomaker.views.repository import RepositoryCreateView, RepositoryForm, RepositoryView
 from .. import fake_repo_create, RmTestCase
 
@@ -196,9 +202,8 @@ class RepositoryTestCase(RmTestCase):
         self.assertEqual(0, Apk.objects.all().count())
         self.assertEqual(0, ApkPointer.objects.all().count())
 
-        with open(os.path.join(settings.TEST_FILES_DIR, 'test_1.apk'), 'rb') as f:
-            self.client.post(reverse('repo', kwargs={'repo_id': self.repo.id}), {'apks': f},
-                             HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_RM_BACKGROUND_TYPE='apks')
+        status = self.upload('test_1.apk')
+        self.assertEqual('added', status['files'][0]['state'])
 
         self.assertEqual(1, App.objects.all().count())
         self.assertEqual(1, Apk.objects.all().count())
@@ -214,9 +219,7 @@ class RepositoryTestCase(RmTestCase):
         self.assertEqual(0, Apk.objects.all().count())
         self.assertEqual(0, ApkPointer.objects.all().count())
 
-        with open(os.path.join(settings.TEST_FILES_DIR, 'test_1.apk'), 'rb') as f:
-            self.client.post(reverse('repo', kwargs={'repo_id': self.repo.id}), {'apks': f},
-                             HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_RM_BACKGROUND_TYPE='apks')
+        self.upload('test_1.apk')
 
         self.assertEqual(1, App.objects.all().count())
         self.assertEqual(1, Apk.objects.all().count())
@@ -232,12 +235,9 @@ class RepositoryTestCase(RmTestCase):
         self.assertEqual(0, Apk.objects.all().count())
         self.assertEqual(0, ApkPointer.objects.all().count())
 
-        with open(os.path.join(settings.TEST_FILES_DIR, 'test_invalid_signature.apk'), 'rb') as f:
-            response = self.client.post(reverse('repo', kwargs={'repo_id': self.repo.id}),
-                                        {'apks': f}, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
-                                        HTTP_RM_BACKGROUND_TYPE='apks')
-        self.assertContains(response, 'test_invalid_signature.apk: Invalid APK signature',
-                            status_code=500)
+        status = self.upload('test_invalid_signature.apk')
+        self.assertEqual([{'name': 'test_invalid_signature.apk', 'state': 'failed',
+                           'error': 'Invalid APK signature'}], status['files'])
 
         self.assertEqual(1, App.objects.all().count())
         self.assertEqual(0, Apk.objects.all().count())
@@ -253,9 +253,7 @@ class RepositoryTestCase(RmTestCase):
         self.assertEqual(0, Apk.objects.all().count())
         self.assertEqual(0, ApkPointer.objects.all().count())
 
-        with open(os.path.join(settings.TEST_FILES_DIR, 'test.avi'), 'rb') as f:
-            self.client.post(reverse('repo', kwargs={'repo_id': self.repo.id}), {'apks': f},
-                             HTTP_X_REQUESTED_WITH='XMLHttpRequest', HTTP_RM_BACKGROUND_TYPE='apks')
+        self.upload('test.avi')
 
         self.assertEqual(2, App.objects.all().count())
         self.assertEqual(1, Apk.objects.all().count())
@@ -263,6 +261,201 @@ class RepositoryTestCase(RmTestCase):
 
         self.assertTrue(Repository.objects.get(pk=self.repo.pk).update_scheduled)
 
+    def test_upload_returns_before_adding_files(self):
+        with open(os.path.join(settings.TEST_FILES_DIR, 'test.avi'), 'rb') as f:
+            response = self.client.post(reverse('repo', kwargs={'repo_id': self.repo.id}),
+                                        {'apks': f}, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        HTTP_RM_BACKGROUND_TYPE='apks')
+
+        # assert that the file was stored, but is only added by the scheduled task
+        self.assertEqual(202, response.status_code)
+        status = response.json()
+        self.assertFalse(status['finished'])
+        self.assertEqual(0, status['processed'])
+        self.assertEqual([{'name': 'test.avi', 'state': 'pending', 'error': None}],
+                         status['files'])
+        self.assertEqual(1, Apk.objects.all().count())
+        self.assertEqual(0, ApkPointer.objects.all().count())
+        self.assertEqual(1, Task.objects.filter(task_name='repomaker.tasks.process_upload').count())
+
+        # assert that the status can be polled
+        response = self.client.get(status['status_url'])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(status['id'], response.json()['id'])
+
+    def test_upload_status_other_user(self):
+        upload = Upload.objects.create(repo=self.repo)
+        self.repo.user = self.user
+        self.repo.save()
+        response = self.client.get(reverse('upload_status_json', args=[self.repo.id, upload.id]))
+        self.assertEqual(403, response.status_code)
+
+    def start_chunked_upload(self, file_hash=''):
+        with open(os.path.join(settings.TEST_FILES_DIR, 'test.avi'), 'rb') as f:
+            content = f.read()
+        response = self.client.post(reverse('repo', kwargs={'repo_id': self.repo.id}),
+                                    {'name': 'test.avi', 'size': len(content),
+                                     'hash': file_hash},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                    HTTP_RM_BACKGROUND_TYPE='apks', HTTP_RM_CHUNKED_UPLOAD='true')
+        return content, response
+
+    def test_chunked_upload(self):
+        content, response = self.start_chunked_upload()
+        self.assertEqual(201, response.status_code)
+        upload_url = response.json()['upload_url']
+
+        response = self.client.put(upload_url, content[:1000], 'application/octet-stream',
+                                   HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1000, response.json()['offset'])
+
+        # assert that a chunk at the wrong offset returns the offset to resume from
+        response = self.client.put(upload_url, content[:1000], 'application/octet-stream',
+                                   HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(1000, response.json()['offset'])
+        self.assertEqual(1000, self.client.get(upload_url).json()['offset'])
+
+        # assert that the last chunk schedules adding the file
+        response = self.client.put(upload_url, content[1000:], 'application/octet-stream',
+                                   HTTP_UPLOAD_OFFSET='1000')
+        self.assertEqual(202, response.status_code)
+        self.assertEqual([{'name': 'test.avi', 'state': 'pending', 'error': None}],
+                         response.json()['files'])
+        self.assertEqual(1, Apk.objects.all().count())
+        self.assertEqual(1, Task.objects.filter(task_name='repomaker.tasks.process_upload').count())
+
+    def test_chunked_upload_of_existing_file(self):
+        self.upload('test.avi')
+        apk = Apk.objects.get()
+        other_repo = Repository.objects.create(user=self.user, name='Other')
+        ApkPointer.objects.filter(repo=self.repo).update(repo=other_repo)
+
+        content, response = self.start_chunked_upload(apk.hash)
+
+        # assert that the file does not need to be uploaded again
+        self.assertEqual(202, response.status_code)
+        self.assertTrue('status_url' in response.json())
+        self.assertEqual(1, Apk.objects.all().count())
+        self.assertEqual(0, ChunkedUpload.objects.all().count())
+        self.assertTrue(content)
+
+    def test_chunked_upload_while_other_request_appends(self):
+        content, response = self.start_chunked_upload()
+        upload_url = response.json()['upload_url']
+        ChunkedUpload.objects.update(is_appending=True)
+
+        # assert that the chunk is rejected with the offset to resume from
+        response = self.client.put(upload_url, content, 'application/octet-stream',
+                                   HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(0, response.json()['offset'])
+        self.assertEqual(0, Apk.objects.all().count())
+
+    def test_chunked_upload_with_wrong_hash(self):
+        content, response = self.start_chunked_upload('a' * 64)
+        self.assertEqual(201, response.status_code)
+        response = self.client.put(response.json()['upload_url'], content,
+                                   'application/octet-stream', HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, Apk.objects.all().count())
+
+    def add_to_other_repo(self, file_name):
+        other_repo = Repository.objects.create(user=self.user, name='Other')
+        with open(os.path.join(settings.TEST_FILES_DIR, file_name), 'rb') as f:
+            uploaded_file = SimpleUploadedFile(file_name, f.read())
+        Upload.create(other_repo, [uploaded_file]).process()
+        return Apk.objects.get()
+
+    def test_upload_precheck(self):
+        apk = self.add_to_other_repo('test.avi')
+        url = reverse('upload_precheck', args=[self.repo.id])
+
+        response = self.client.post(url, {'hash': 'a' * 64})
+        self.assertEqual({'exists': False}, response.json())
+        response = self.client.post(url, {'hash': apk.hash, 'package_id': 'other'})
+        self.assertEqual({'exists': False}, response.json())
+
+        # assert that the existing file was linked into the repository
+        response = self.client.post(url, {'hash': apk.hash, 'package_id': apk.package_id})
+        self.assertEqual(201, response.status_code)
+        self.assertTrue(response.json()['added'])
+        pointer = ApkPointer.objects.get(repo=self.repo)
+        self.assertEqual(pointer.pk, response.json()['apk']['id'])
+        self.assertTrue(os.path.samefile(apk.file.path, pointer.file.path))
+        self.assertEqual(1, Apk.objects.all().count())
+        self.assertTrue(Repository.objects.get(pk=self.repo.pk).update_scheduled)
+
+        # assert that checking again does not add it twice
+        response = self.client.post(url, {'hash': apk.hash})
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.json()['added'])
+        self.assertEqual(1, ApkPointer.objects.filter(repo=self.repo).count())
+
+    def test_upload_precheck_rejected(self):
+        apk = self.add_to_other_repo('test.avi')
+        App.objects.create(repo=self.repo, package_id=apk.package_id, type=APK)
+
+        response = self.client.post(reverse('upload_precheck', args=[self.repo.id]),
+                                    {'hash': apk.hash})
+
+        # assert that no pointer and no link to the file were left behind
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(0, ApkPointer.objects.filter(repo=self.repo).count())
+        self.assertTrue(Apk.objects.filter(pk=apk.pk).exists())
+
+    def upload(self, file_name):
+        """
+        Uploads the given test file by drag and drop and adds it like the background task does.
+
+        :return: The status of the upload after the file was added
+        """
+        with open(os.path.join(settings.TEST_FILES_DIR, file_name), 'rb') as f:
+            response = self.client.post(reverse('repo', kwargs={'repo_id': self.repo.id}),
+                                        {'apks': f}, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                        HTTP_RM_BACKGROUND_TYPE='apks')
+        self.assertEqual(202, response.status_code)
+        tasks.process_upload.now(response.json()['id'])
+
+        status = self.client.get(response.json()['status_url']).json()
+        self.assertTrue(status['finished'])
+        return status
+
+    def test_status(self):
+        with PhaseTimer() as timer:
+            with timed_phase('make_index', 3):
+                pass
+        TaskTiming.record('update_repo', timer, repo=self.repo)
+
+        response = self.client.get(reverse('repo_status', kwargs={'repo_id': self.repo.id}))
+        self.assertEqual(200, response.status_code)
+        self.assertTemplateUsed(response, 'repomaker/repo/status.html')
+        self.assertContains(response, 'make_index')
+
+    def test_status_json(self):
+        with PhaseTimer() as timer:
+            with timed_phase('make_index', 3):
+                pass
+        TaskTiming.record('update_repo', timer, repo=self.repo)
+
+        response = self.client.get(reverse('repo_status_json', kwargs={'repo_id': self.repo.id}))
+        self.assertEqual(200, response.status_code)
+        status = response.json()
+        self.assertEqual(self.repo.id, status['id'])
+        self.assertFalse(status['is_updating'])
+        self.assertEqual(1, len(status['timings']))
+        self.assertEqual('update_repo', status['timings'][0]['task'])
+        self.assertEqual([{'name': 'make_index', 'count': 3,
+                           'duration': timer.phases['make_index']['duration']}],
+                         status['timings'][0]['phases'])
+
+    def test_status_json_other_user(self):
+        self.repo.user = self.user
+        self.repo.save()
+        response = self.client.get(reverse('repo_status_json', kwargs={'repo_id': self.repo.id}))
+        self.assertEqual(403, response.status_code)
+
     def test_delete(self):
         response = self.client.post(reverse('delete_repo', kwargs={'repo_id': self.repo.id}))
         self.assertRedirects(response, '/')
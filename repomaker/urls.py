@@ -12,9 +12,10 @@ from repomaker.views.app import AppDetailView, AppDeleteView, AppEditView, \
 from repomaker.views.gitstorage import GitStorageCreate, GitStorageUpdate, GitStorageDetail, \
     GitStorageDelete
 from repomaker.views.remoterepository import RemoteRepositoryCreateView, AppRemoteAddView, \
-    RemoteAppImportView, RemoteAppImportViewScreenshots
+    RemoteAppImportView, RemoteAppImportViewScreenshots, RemoteRepositoryStatusJsonView
 from repomaker.views.repository import RepositoryCreateView, RepositoryView, RepositoryUpdateView, \
-    RepositoryDeleteView, RepositoryListView
+    RepositoryDeleteView, RepositoryListView, RepositoryStatusView, RepositoryStatusJsonView, \
+    UploadStatusJsonView, ChunkedUploadView, UploadPrecheckView
 from repomaker.views.s3storage import S3StorageCreate, S3StorageDetail, S3StorageUpdate, \
     S3StorageDelete
 from repomaker.views.screenshot import ScreenshotDeleteView
@@ -42,10 +43,22 @@ urlpatterns = [
         name='edit_repo'),
     url(r'^(?P<repo_id>[0-9]+)/delete/$', RepositoryDeleteView.as_view(),
         name='delete_repo'),
+    url(r'^(?P<repo_id>[0-9]+)/status/$', RepositoryStatusView.as_view(),
+        name='repo_status'),
+    url(r'^(?P<repo_id>[0-9]+)/status/json/$', RepositoryStatusJsonView.as_view(),
+        name='repo_status_json'),
+    url(r'^(?P<repo_id>[0-9]+)/upload/(?P<upload_id>[0-9]+)/status/json/$',
+        UploadStatusJsonView.as_view(), name='upload_status_json'),
+    url(r'^(?P<repo_id>[0-9]+)/upload/precheck/$', UploadPrecheckView.as_view(),
+        name='upload_precheck'),
+    url(r'^(?P<repo_id>[0-9]+)/upload/chunked/(?P<chunked_upload_id>[0-9]+)/$',
+        ChunkedUploadView.as_view(), name='chunked_upload'),
 
     # Remote Repo
     url(r'^remote/add$', RemoteRepositoryCreateView.as_view(), name='add_remote_repo'),
     url(r'^remote/(?P<remote_repo_id>[0-9]+)/update/$', views.remote_update, name='remote_update'),
+    url(r'^remote/(?P<remote_repo_id>[0-9]+)/status/json/$',
+        RemoteRepositoryStatusJsonView.as_view(), name='remote_repo_status_json'),
 
     # App
     url(r'^(?P<repo_id>[0-9]+)/app/add/$', AppRemoteAddView.as_view(), name='add_app'),
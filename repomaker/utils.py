@@ -1,5 +1,13 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import SimpleNamespace
+
 import bleach
 from bleach.sanitizer import Cleaner
+from django.db import connection
+from django.utils import timezone
 from html5lib.filters.base import Filter
 
 
@@ -43,3 +51,87 @@ def to_universal_language_code(language):
         return language[:p].lower() + '-' + language[p + 1:].upper()
     else:
         return language
+
+
+class QueryCounter:
+    """
+    Context manager that counts the database queries executed within its block.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._wrapper = None
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self._wrapper = connection.execute_wrapper(self)
+        self._wrapper.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._wrapper.__exit__(exc_type, exc_value, traceback)
+
+
+class PhaseTimer:
+    """
+    Context manager that measures how long its block takes
+    and collects the durations of all phases timed with timed_phase() in the same thread.
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self.start_date = None
+        self.duration = 0
+        self.phases = OrderedDict()
+        self._start = None
+        self._previous = None
+
+    def add_phase(self, name, duration, count=0):
+        """
+        Adds the duration and item count of a phase, phases with the same name add up.
+        """
+        phase = self.phases.setdefault(name, {'duration': 0, 'count': 0})
+        phase['duration'] += duration
+        phase['count'] += count
+
+    def __enter__(self):
+        self.start_date = timezone.now()
+        self._start = time.perf_counter()
+        self._previous = getattr(PhaseTimer._local, 'timer', None)
+        PhaseTimer._local.timer = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._start
+        PhaseTimer._local.timer = self._previous
+
+    @staticmethod
+    def get_current():
+        """
+        Returns the PhaseTimer that is active in the current thread or None.
+        """
+        return getattr(PhaseTimer._local, 'timer', None)
+
+
+@contextmanager
+def timed_phase(name, count=0):
+    """
+    Measures the duration of the block as a phase of the active PhaseTimer, if there is one.
+
+    The yielded object has a count attribute
+    that can be set within the block to the number of processed items.
+    Nested phases are included in the duration of the enclosing phase.
+    """
+    timer = PhaseTimer.get_current()
+    if timer is not None:
+        timer.add_phase(name, 0)  # keep phases in the order they started
+    phase = SimpleNamespace(count=count)
+    start = time.perf_counter()
+    try:
+        yield phase
+    finally:
+        if timer is not None:
+            timer.add_phase(name, time.perf_counter() - start, phase.count)
@@ -7,7 +7,7 @@ from django.db.models import Q
 from django.forms import FileField, ImageField, ClearableFileInput, CharField
 from django.http import Http404, HttpResponseRedirect, HttpResponseServerError, JsonResponse
 from django.urls import reverse_lazy
-from django.utils import formats, translation
+from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation.trans_real import language_code_re
 from django.views.generic import DetailView
@@ -121,37 +121,18 @@ class AppEditView(ApkUploadMixin, LanguageMixin, TemplateResponseMixin, BaseUpda
         return context
 
     def post(self, request, *args, **kwargs):
+        if 'HTTP_RM_CHUNKED_UPLOAD' in request.META:
+            return self.start_chunked_upload(self.get_object())
         if 'apks' in self.request.FILES:
             app = self.get_object()
+            if self.request.is_ajax():
+                return self.get_upload_response(self.add_apks_async(app))
             added_apks = self.add_apks(app)
             if len(added_apks['failed']) > 0:
-                if self.request.is_ajax():
-                    return HttpResponseServerError(self.get_error_msg(added_apks['failed']))
                 self.object = app
                 form = self.get_form()
                 form.add_error('apks', self.get_error_msg(added_apks['failed']))
                 return self.form_invalid(form)
-            if self.request.is_ajax():
-                apk_objects = added_apks['apks']
-                apks = []
-                for apk in apk_objects:
-                    apk_dict = {
-                        'id': ApkPointer.objects.get(app=app, apk=apk).id,
-                        'version': _('Version %(version)s (%(code)s)') % {
-                            'version': apk.version_name,
-                            'code': apk.version_code
-                        },
-                        'released': _('Released %(date)s') % {
-                            'date': formats.date_format(apk.added_date, 'DATE_FORMAT'),
-                        }
-                    }
-                    apks.append(apk_dict)
-                json_response = {
-                    'repo': self.get_repo().id,
-                    'app': app.id,
-                    'apks': apks
-                }
-                return JsonResponse(json_response, safe=False)
             return super().post(request, args, kwargs)
         if 'HTTP_RM_BACKGROUND_TYPE' in request.META:
             if request.META['HTTP_RM_BACKGROUND_TYPE'] == 'screenshots':
@@ -5,15 +5,17 @@ import urllib.parse
 from django.core.exceptions import ValidationError
 from django.db.models import Q
 from django.db.utils import OperationalError
-from django.http import HttpResponseRedirect, Http404, HttpResponse, HttpResponseServerError
+from django.http import HttpResponseRedirect, Http404, HttpResponse, HttpResponseServerError, \
+    HttpResponseForbidden, JsonResponse
+from django.shortcuts import get_object_or_404
 from django.urls import reverse_lazy
 from django.utils.translation import ugettext_lazy as _
-from django.views.generic import DetailView
+from django.views.generic import DetailView, View
 from django.views.generic.edit import CreateView
 from fdroidserver import index
 from modeltranslation.utils import get_language
 
-from repomaker.models import Repository, RemoteRepository, RemoteApp
+from repomaker.models import Repository, RemoteRepository, RemoteApp, TaskTiming
 from repomaker.models.category import Category
 from repomaker.models.screenshot import PHONE, RemoteScreenshot
 from . import BaseModelForm, AppScrollListView, LoginOrSingleUserRequiredMixin, LanguageMixin
@@ -185,3 +187,18 @@ class RemoteAppImportViewScreenshots(RemoteAppImportView):
         context = super().get_context_data(**kwargs)
         context['show_screenshots'] = True
         return context
+
+
+class RemoteRepositoryStatusJsonView(LoginOrSingleUserRequiredMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        remote_repo = get_object_or_404(RemoteRepository, pk=kwargs['remote_repo_id'])
+        if not remote_repo.users.filter(id=request.user.id).exists():
+            return HttpResponseForbidden()
+        timings = TaskTiming.objects.filter(remote_repo=remote_repo)
+        return JsonResponse({
+            'id': remote_repo.pk,
+            'update_scheduled': remote_repo.update_scheduled,
+            'is_updating': remote_repo.is_updating,
+            'timings': [timing.to_dict() for timing in timings],
+        })
@@ -1,17 +1,22 @@
-import collections
 import logging
 
 from django.contrib.auth.mixins import UserPassesTestMixin
+from django.core.exceptions import ValidationError
 from django.db.models import Q
 from django.forms import Textarea
-from django.http import HttpResponseServerError, HttpResponse, Http404
+from django.http import HttpResponseServerError, HttpResponse, Http404, JsonResponse, \
+    HttpResponseBadRequest
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils import formats
 from django.utils.translation import ugettext_lazy as _
-from django.views.generic import ListView
+from django.views.generic import DetailView, ListView, View
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 
-from repomaker.models import Repository, App, Apk
+from repomaker.models import Repository, App, Apk, ApkPointer, TaskTiming, Upload, \
+    ChunkedUpload
 from repomaker.models.storage import StorageManager
+from repomaker.models.upload import ADDED, FAILED, UploadConflictError
 from . import BaseModelForm, AppScrollListView, LoginOrSingleUserRequiredMixin, ErrorView
 
 
@@ -33,10 +38,13 @@ class ApkUploadMixin(RepositoryAuthorizationMixin):
     apks_added = False
 
     def post(self, request, *args, **kwargs):
+        if 'HTTP_RM_CHUNKED_UPLOAD' in request.META:
+            return self.start_chunked_upload()
         if not self.apks_added and 'apks' in self.request.FILES:
+            if self.request.is_ajax():
+                return self.get_upload_response(self.add_apks_async())
             added_apks = self.add_apks()
             if len(added_apks['failed']) > 0:
-                # TODO return list, so JavaScript can handle the individual error properly
                 return HttpResponseServerError(self.get_error_msg(added_apks['failed']))
             return HttpResponse(status=204)
         # noinspection PyUnresolvedReferences
@@ -50,28 +58,9 @@ class ApkUploadMixin(RepositoryAuthorizationMixin):
                  tuples called 'failed', one tuple for each failed APK file where the first element
                  is the name of the APK file and the second an error message
         """
-        files = self.request.FILES.getlist('apks')
-        repo = self.get_repo()
-
-        apks = []
-        failed = []
-        for apk_file in files:
-            apk = Apk.objects.create(file=apk_file)
-            try:
-                apk = apk.initialize(repo, app)  # this also creates a pointer and attaches the app
-                apks.append(apk)
-            except Exception as e:
-                logging.warning(e)
-                if apk.pk:
-                    apk.delete()
-                if isinstance(e, collections.Iterable):
-                    tup = (apk_file, ' '.join(e))
-                else:
-                    tup = (apk_file, str(e))
-                failed.append(tup)
-
-        if len(files) > len(failed):
-            self.get_repo().update_async()  # schedule repository update
+        upload = Upload.create(self.get_repo(), self.request.FILES.getlist('apks'), app)
+        apks = upload.process()
+        failed = [(f['name'], f['error']) for f in upload.get_files() if f['state'] == FAILED]
 
         self.apks_added = True
         return {
@@ -79,6 +68,59 @@ class ApkUploadMixin(RepositoryAuthorizationMixin):
             'failed': failed,
         }
 
+    def add_apks_async(self, app=None):
+        """
+        Stores the uploaded APKs from the request object
+        and adds them to the repository in a background task.
+
+        :return: The Upload that can be used to query the progress
+        """
+        upload = Upload.create(self.get_repo(), self.request.FILES.getlist('apks'), app)
+        upload.process_async()
+        self.apks_added = True
+        return upload
+
+    def start_chunked_upload(self, app=None):
+        """
+        Starts a chunked upload of the file announced in the request object.
+
+        If an APK with the announced sha256 hash exists already,
+        it is added to the repository without uploading it again.
+
+        :return: A response with the URL to upload the chunks to
+                 or with the state of the Upload if the file exists already
+        """
+        name = self.request.POST.get('name', '')
+        file_hash = self.request.POST.get('hash', '')
+        try:
+            size = int(self.request.POST.get('size', ''))
+        except ValueError:
+            return HttpResponseBadRequest(_('Invalid file size'))
+
+        upload = Upload.create_for_existing_file(self.get_repo(), name, file_hash, app)
+        if upload is not None:
+            upload.process_async()
+            return self.get_upload_response(upload)
+        try:
+            chunked_upload = ChunkedUpload.start(self.get_repo(), name, size, file_hash, app)
+        except ValidationError as e:
+            return HttpResponseBadRequest(' '.join(e))
+        json_response = chunked_upload.to_dict()
+        json_response['upload_url'] = reverse('chunked_upload',
+                                              args=[chunked_upload.repo_id, chunked_upload.pk])
+        return JsonResponse(json_response, status=201)
+
+    @staticmethod
+    def get_upload_response(upload):
+        """
+        Returns a response with the state of the given Upload
+        and the URL where the progress of adding its files can be polled.
+        """
+        json_response = upload.to_dict()
+        json_response['status_url'] = reverse('upload_status_json',
+                                              args=[upload.repo_id, upload.pk])
+        return JsonResponse(json_response, status=202)
+
     @staticmethod
     def get_error_msg(failed):
         error_msg = ''
@@ -190,3 +232,132 @@ class RepositoryDeleteView(RepositoryAuthorizationMixin, DeleteView):
 
     def get_success_url(self):
         return '/'
+
+
+class RepositoryStatusView(RepositoryAuthorizationMixin, DetailView):
+    model = Repository
+    pk_url_kwarg = 'repo_id'
+    context_object_name = 'repo'
+    template_name = 'repomaker/repo/status.html'
+
+    def get_context_data(self, **kwargs):
+        context = super(RepositoryStatusView, self).get_context_data(**kwargs)
+        context['timings'] = TaskTiming.objects.filter(repo=self.object)
+        return context
+
+
+class RepositoryStatusJsonView(RepositoryAuthorizationMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        repo = self.get_repo()
+        timings = TaskTiming.objects.filter(repo=repo)
+        return JsonResponse({
+            'id': repo.pk,
+            'update_scheduled': repo.update_scheduled,
+            'is_updating': repo.is_updating,
+            'timings': [timing.to_dict() for timing in timings],
+        })
+
+
+class UploadStatusJsonView(RepositoryAuthorizationMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        upload = get_object_or_404(Upload, pk=kwargs['upload_id'], repo=self.get_repo())
+        json_response = upload.to_dict()
+        if upload.app is not None:
+            # the APKs that were added to the app, so they can be shown right away
+            apk_ids = [f['apk'] for f in upload.get_files() if f['state'] == ADDED]
+            pointers = ApkPointer.objects.filter(app=upload.app, apk__in=apk_ids) \
+                .select_related('apk')
+            json_response['apks'] = [get_apk_pointer_dict(pointer) for pointer in pointers]
+        return JsonResponse(json_response)
+
+
+class UploadPrecheckView(RepositoryAuthorizationMixin, View):
+    """
+    Checks if a file needs to be uploaded at all before uploading it.
+
+    Clients post the sha256 hash of the file and optionally its package ID.
+    If an APK with this hash is stored already, e.g. because it was uploaded to another repository,
+    it is added to this repository right away by linking the existing file.
+    """
+
+    def post(self, request, *args, **kwargs):
+        repo = self.get_repo()
+        apk = Apk.get_by_hash(request.POST.get('hash'), request.POST.get('package_id'))
+        if apk is None:
+            return JsonResponse({'exists': False})
+
+        pointer = ApkPointer.objects.filter(apk=apk, repo=repo).first()
+        if pointer is not None:
+            return JsonResponse({'exists': True, 'added': False,
+                                 'apk': get_apk_pointer_dict(pointer)})
+        try:
+            # the file was scanned before, so this only links it into the repository
+            apk.initialize(repo, scan_result=apk.get_scan_result())
+        except ValidationError as e:
+            return HttpResponseBadRequest(' '.join(e))
+        repo.update_async()  # schedule repository update
+        pointer = ApkPointer.objects.get(apk=apk, repo=repo)
+        return JsonResponse({'exists': True, 'added': True, 'apk': get_apk_pointer_dict(pointer)},
+                            status=201)
+
+
+class ChunkedUploadView(RepositoryAuthorizationMixin, View):
+    """
+    Receives the chunks of a ChunkedUpload with PUT requests.
+
+    Each chunk needs an Upload-Offset header with the position of the chunk in the file.
+    If it does not match the number of bytes received so far
+    or another request appends to the same upload at the moment,
+    the current offset is returned with status 409, so the client can resume from there.
+    """
+
+    def get_chunked_upload(self):
+        return get_object_or_404(ChunkedUpload, pk=self.kwargs['chunked_upload_id'],
+                                 repo=self.get_repo())
+
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(self.get_chunked_upload().to_dict())
+
+    def put(self, request, *args, **kwargs):
+        chunked_upload = self.get_chunked_upload()
+        try:
+            offset = int(request.META.get('HTTP_UPLOAD_OFFSET', ''))
+        except ValueError:
+            return HttpResponseBadRequest(_('Missing Upload-Offset header'))
+        if offset != chunked_upload.offset:
+            return JsonResponse(chunked_upload.to_dict(), status=409)
+
+        try:
+            chunked_upload.append(request)
+            if chunked_upload.offset < chunked_upload.size:
+                return JsonResponse(chunked_upload.to_dict())
+            upload = chunked_upload.finish()
+        except UploadConflictError:
+            # the other request might have finished the upload in the meantime
+            current = ChunkedUpload.objects.filter(pk=chunked_upload.pk).first()
+            return JsonResponse((current or chunked_upload).to_dict(), status=409)
+        except ValidationError as e:
+            logging.warning(e)
+            return HttpResponseBadRequest(' '.join(e))
+        upload.process_async()
+        return ApkUploadMixin.get_upload_response(upload)
+
+
+def get_apk_pointer_dict(apk_pointer):
+    """
+    Returns a dict with the information about the given ApkPointer
+    that is shown in the list of versions of an app.
+    """
+    apk = apk_pointer.apk
+    return {
+        'id': apk_pointer.id,
+        'version': _('Version %(version)s (%(code)s)') % {
+            'version': apk.version_name,
+            'code': apk.version_code
+        },
+        'released': _('Released %(date)s') % {
+            'date': formats.date_format(apk.added_date, 'DATE_FORMAT'),
+        }
+    }
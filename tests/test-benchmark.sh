@@ -0,0 +1,16 @@
+#!/usr/bin/env bash
+#
+# Benchmarks repository updates with synthetic repositories of growing size.
+#
+# Usage: ./tests/test-benchmark.sh [baseline.json]
+#
+# The results are written to benchmark.json or $REPOMAKER_BENCHMARK_OUTPUT.
+# If a baseline from an earlier run is given, regressions are printed
+# and the benchmark fails if more database queries were needed than before.
+# Set REPOMAKER_BENCHMARK_SIZES to benchmark other numbers of apps, e.g. 10,100
+
+if [ -n "$1" ]; then
+    export REPOMAKER_BENCHMARK_BASELINE="$1"
+fi
+
+python3 manage.py test repomaker.tests.benchmark --settings repomaker.settings_test